@@ -0,0 +1,111 @@
+"""
+Primary affinity: lets devices turn down part of the primary role CRUSH gives
+them. Applied after CRUSH and the upmaps, it only reorders a mapping, the set
+of devices is left untouched.
+"""
+
+from collections import Counter
+from parser import Device, DeviceID_T
+from typing import TypedDict
+
+import numpy as np
+import numpy.typing as npt
+
+from batch import IntArray
+from crush import CRUSH_ITEM_NONE
+from hashing import crush_hash_2, crush_hash_2_many
+
+# 16.16 fixed point affinity which is always accepted
+MAX_PRIMARY_AFFINITY = 0x10000
+
+
+def to_fixed_affinity(a: float) -> int:
+    return int(a * MAX_PRIMARY_AFFINITY)
+
+
+def apply_primary_affinity(
+    x: int, osds: list[DeviceID_T], devices: dict[DeviceID_T, Device]
+) -> list[DeviceID_T]:
+    """
+    Ceph's `OSDMap::_apply_primary_affinity`: the first device passing a
+    hash of (x, device) against its affinity becomes the primary and is moved
+    to the front. When every device declines, the first one stays primary.
+    """
+    # holes of `indep` rules are never primary
+    affinities = [
+        to_fixed_affinity(d.info.primary_affinity)
+        if (d := devices.get(o)) is not None
+        else MAX_PRIMARY_AFFINITY
+        for o in osds
+    ]
+    if all(a >= MAX_PRIMARY_AFFINITY for a in affinities):
+        return osds
+
+    pos = 0
+    for i, (o, a) in enumerate(zip(osds, affinities)):
+        if o == CRUSH_ITEM_NONE:
+            continue
+        if a >= MAX_PRIMARY_AFFINITY or (crush_hash_2(x, o) >> 16) < a:
+            pos = i
+            break
+    if pos == 0:
+        return osds
+    return [osds[pos]] + osds[:pos] + osds[pos + 1 :]
+
+
+def affinity_array(devices: dict[DeviceID_T, Device]) -> npt.NDArray[np.int64]:
+    """Fixed point affinity indexed by device id"""
+    res = np.full(max(devices, default=-1) + 1, MAX_PRIMARY_AFFINITY, dtype=np.int64)
+    for d in devices.values():
+        res[d.info.id] = to_fixed_affinity(d.info.primary_affinity)
+    return res
+
+
+def apply_primary_affinity_many(
+    xs: npt.ArrayLike, osds: IntArray, affinity: npt.NDArray[np.int64]
+) -> IntArray:
+    """`apply_primary_affinity` over rows of -1 padded device ids"""
+    x = np.asarray(xs, dtype=np.int64)
+    valid = (osds != -1) & (osds != CRUSH_ITEM_NONE)
+    a = np.where(valid, affinity[np.where(valid, osds, 0)], MAX_PRIMARY_AFFINITY)
+    accepted = valid & (
+        (a >= MAX_PRIMARY_AFFINITY)
+        | ((crush_hash_2_many(x[:, None], osds) >> 16).astype(np.int64) < a)
+    )
+    # rows where nobody accepts keep their first device
+    pos = np.where(accepted.any(axis=1), np.argmax(accepted, axis=1), 0)
+
+    res = osds.copy()
+    rows = np.flatnonzero(pos > 0)
+    for row in rows.tolist():
+        p = pos[row]
+        res[row, 1 : p + 1] = osds[row, :p]
+        res[row, 0] = osds[row, p]
+    return res
+
+
+class JSONPrimaryCount(TypedDict):
+    osd: str
+    affinity: float
+    before: int
+    after: int
+
+
+def primary_report(
+    before: list[list[DeviceID_T]],
+    after: list[list[DeviceID_T]],
+    devices: dict[DeviceID_T, Device],
+) -> list[JSONPrimaryCount]:
+    """Primary count of every device with CRUSH's order and with affinity"""
+    count_before = Counter(m[0] for m in before if len(m) > 0)
+    count_after = Counter(m[0] for m in after if len(m) > 0)
+    return [
+        {
+            "osd": f"osd.{d}",
+            "affinity": devices[d].info.primary_affinity,
+            "before": count_before[d],
+            "after": count_after[d],
+        }
+        for d in sorted(devices)
+    ]
+
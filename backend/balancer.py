@@ -0,0 +1,292 @@
+"""
+`pg_upmap_items` style balancer: moves single replicas of PGs from overfull
+devices to underfull ones without touching the CRUSH map itself.
+
+PGs are mapped once with the batch mapper, afterwards every move only updates
+the deviations of the two devices involved, nothing is remapped.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass
+from parser import BucketT, Device, DeviceID_T
+from typing import TypedDict
+
+import numpy as np
+import numpy.typing as npt
+
+from batch import HOLE, NONE, IntArray
+from crush import CRUSH_ITEM_NONE, RulePlan
+from hierarchy import NO_PARENT, FlatHierarchy
+
+# PG id -> (from, to) device pairs, applied in order on top of CRUSH
+PGUpmapItems = dict[int, list[tuple[DeviceID_T, DeviceID_T]]]
+
+
+def apply_upmap_items(
+    raw: list[DeviceID_T],
+    items: list[tuple[DeviceID_T, DeviceID_T]],
+    devices: dict[DeviceID_T, Device],
+) -> list[DeviceID_T]:
+    """
+    Same rules as Ceph's `OSDMap::_apply_upmap`: a pair is ignored when its
+    target already holds the PG or is out of the cluster
+    """
+    res = list(raw)
+    for src, dst in items:
+        if dst in res:
+            continue
+        d = devices.get(dst)
+        if d is None or d.weight <= 0:
+            continue
+        if src in res:
+            res[res.index(src)] = dst
+    return res
+
+
+class JSONBalance(TypedDict):
+    moves: int
+    items: int
+    deviation_before: float
+    deviation_after: float
+
+
+@dataclass
+class BalanceResult:
+    items: PGUpmapItems
+    # the mappings with `items` applied, same layout as the input ones
+    nodes: IntArray
+    # replicas moved by this run
+    moves: int
+    # max |placements - expected placements| over the devices
+    deviation_before: float
+    deviation_after: float
+
+    def to_json(self) -> JSONBalance:
+        return {
+            "moves": self.moves,
+            "items": sum(len(i) for i in self.items.values()),
+            "deviation_before": self.deviation_before,
+            "deviation_after": self.deviation_after,
+        }
+
+
+def _ancestor_at(flat: FlatHierarchy, i: int, level: int) -> int:
+    while i != NO_PARENT and flat.types[i] != level:
+        i = int(flat.parents[i])
+    return i
+
+
+def _constraints(plan: RulePlan, flat: FlatHierarchy) -> tuple[IntArray, IntArray]:
+    """
+    Failure domain (bucket of the type of the last choose step) and group
+    (bucket of the lowest type of the other choose steps) of every device.
+
+    A replica may only move within its group and to a failure domain no other
+    replica of the PG uses, so that the result is still one the rule could
+    have produced.
+    """
+    hierarchy = BucketT.BUCKETS_HIERARCHY  # type: ignore
+    levels = [hierarchy[t] for t in plan.choose_types()]
+    domain = np.arange(len(flat), dtype=np.int64)
+    group = np.full(len(flat), NONE, dtype=np.int64)
+    for d in np.flatnonzero(flat.ids >= 0).tolist():
+        if len(levels) > 0:
+            domain[d] = _ancestor_at(flat, d, levels[-1])
+        if len(levels) > 1:
+            group[d] = _ancestor_at(flat, d, min(levels[:-1]))
+    return domain, group
+
+
+def _apply_items(
+    flat: FlatHierarchy,
+    xs: list[int],
+    nodes: IntArray,
+    items: PGUpmapItems,
+    candidates: IntArray,
+) -> IntArray:
+    # devices can be in shadow trees as well: stay in the tree of the rule
+    node_of = {DeviceID_T(int(flat.ids[i])): i for i in candidates.tolist()}
+    devices: dict[DeviceID_T, Device] = {
+        d: flat.nodes[i] for d, i in node_of.items()  # type: ignore
+    }
+    res = nodes.copy()
+    for lane, x in enumerate(xs):
+        if (pairs := items.get(x)) is None:
+            continue
+        # holes of `indep` rules keep their position
+        raw = [
+            DeviceID_T(int(flat.ids[i]) if i != HOLE else CRUSH_ITEM_NONE)
+            for i in nodes[lane]
+            if i != NONE
+        ]
+        res[lane, : len(raw)] = [
+            node_of[d] if d != CRUSH_ITEM_NONE else HOLE
+            for d in apply_upmap_items(raw, pairs, devices)
+        ]
+    return res
+
+
+def _record(items: PGUpmapItems, x: int, src: DeviceID_T, dst: DeviceID_T) -> None:
+    pairs = items.setdefault(x, [])
+    for i, (orig, to) in enumerate(pairs):
+        if to == src:
+            # moving a replica which was already moved: retarget the pair
+            if orig == dst:
+                pairs.pop(i)
+            else:
+                pairs[i] = (orig, dst)
+            break
+    else:
+        pairs.append((src, dst))
+    if len(pairs) == 0:
+        del items[x]
+
+
+def _by_group(nodes: list[int], group: IntArray) -> defaultdict[int, list[int]]:
+    res: defaultdict[int, list[int]] = defaultdict(list)
+    for i in nodes:
+        res[int(group[i])].append(i)
+    return res
+
+
+class _Moves:
+    """Mappings being balanced and the incremental bookkeeping around them"""
+
+    def __init__(
+        self,
+        plan: RulePlan,
+        flat: FlatHierarchy,
+        xs: list[int],
+        mapping: IntArray,
+        expected: npt.NDArray[np.float64],
+        items: PGUpmapItems,
+    ):
+        self.flat = flat
+        self.xs = xs
+        self.mapping = mapping
+        self.items = items
+        self.domain, self.group = _constraints(plan, flat)
+
+        placed = mapping[mapping >= 0]
+        counts = np.bincount(placed, minlength=len(flat)).astype(np.float64)
+        self.deviation = counts - expected
+        self.lanes_of: list[set[int]] = [set() for _ in range(len(flat))]
+        for lane, i in zip(*np.nonzero(mapping >= 0)):
+            self.lanes_of[int(mapping[lane, i])].add(int(lane))
+        self.count = 0
+
+    def max_deviation(self) -> float:
+        return float(np.abs(self.deviation).max(initial=0))
+
+    def helps(self, src: int, dst: int) -> bool:
+        # only moves which reduce the spread, guarantees termination
+        return self.deviation[src] - self.deviation[dst] > 1
+
+    def allowed(self, lane: int, src: int, dst: int) -> bool:
+        row = self.mapping[lane]
+        if dst in row or self.group[dst] != self.group[src]:
+            return False
+        domain = self.domain[dst]
+        return not any(self.domain[m] == domain for m in row if m >= 0 and m != src)
+
+    def move(self, lane: int, src: int, dst: int) -> None:
+        row = self.mapping[lane]
+        row[row == src] = dst
+        self.lanes_of[src].discard(lane)
+        self.lanes_of[dst].add(lane)
+        self.deviation[src] -= 1
+        self.deviation[dst] += 1
+        ids = self.flat.ids
+        _record(
+            self.items,
+            self.xs[lane],
+            DeviceID_T(int(ids[src])),
+            DeviceID_T(int(ids[dst])),
+        )
+        self.count += 1
+
+    def drain(self, src: int, under: list[int], limit: float, budget: int) -> None:
+        """Moves replicas off `src` until it is within `limit`"""
+        for lane in sorted(self.lanes_of[src]):
+            if self.deviation[src] <= limit or budget <= 0:
+                return
+            for dst in under:
+                if self.deviation[dst] >= 0 or not self.helps(src, dst):
+                    continue
+                if self.allowed(lane, src, dst):
+                    self.move(lane, src, dst)
+                    budget -= 1
+                    break
+
+    def fill(self, dst: int, over: list[int], limit: float, budget: int) -> None:
+        """Moves replicas to `dst` until it is within `limit`"""
+        for src in over:
+            if self.deviation[dst] >= -limit or budget <= 0:
+                return
+            if self.deviation[src] <= 0 or not self.helps(src, dst):
+                continue
+            for lane in sorted(self.lanes_of[src]):
+                if self.allowed(lane, src, dst):
+                    self.move(lane, src, dst)
+                    budget -= 1
+                    if self.deviation[src] <= 0 or not self.helps(src, dst):
+                        break
+
+
+def calc_pg_upmaps(
+    plan: RulePlan,
+    flat: FlatHierarchy,
+    xs: list[int],
+    nodes: IntArray,
+    max_deviation: float = 1.0,
+    max_moves: int = 1 << 20,
+    items: PGUpmapItems | None = None,
+) -> BalanceResult:
+    """
+    `nodes` are the raw CRUSH mappings of `xs` (see `batch.BatchResult`),
+    `items` the upmaps already in place. Moves single replicas from overfull
+    to underfull devices, most deviating ones first, until every device is
+    within `max_deviation` placements of its weight share, or no allowed
+    move helps anymore.
+    """
+    candidates = flat.devices_under([flat.node_of(t) for t in plan.targets()])
+    items = {x: list(p) for x, p in (items or {}).items()}
+    mapping = _apply_items(flat, xs, nodes, items, candidates)
+
+    weights = np.zeros(len(flat), dtype=np.float64)
+    weights[candidates] = np.maximum(flat.weights[candidates], 0)
+    placed = int((mapping >= 0).sum())
+    total = weights.sum()
+    expected = placed * weights / total if total > 0 else weights
+    # devices which can receive replicas
+    receivers = candidates[weights[candidates] > 0]
+
+    moves = _Moves(plan, flat, xs, mapping, expected, items)
+    deviation_before = moves.max_deviation()
+    # every round sorts the devices once, the deviations are then kept up to
+    # date move by move
+    while moves.count < max_moves and moves.max_deviation() > max_deviation:
+        before = moves.count
+        dev = moves.deviation
+        over = np.argsort(-dev, kind="stable")
+        over = over[dev[over] > 0].tolist()
+        under = receivers[np.argsort(dev[receivers], kind="stable")]
+        under = under[dev[under] < 0].tolist()
+
+        # replicas never leave their group, see `_constraints`
+        under_in = _by_group(under, moves.group)
+        over_in = _by_group(over, moves.group)
+        for src in over:
+            if dev[src] > max_deviation:
+                peers = under_in[moves.group[src]]
+                moves.drain(src, peers, max_deviation, max_moves - moves.count)
+        for dst in under:
+            if dev[dst] < -max_deviation:
+                peers = over_in[moves.group[dst]]
+                moves.fill(dst, peers, max_deviation, max_moves - moves.count)
+        if moves.count == before:
+            break
+
+    return BalanceResult(
+        items, mapping, moves.count, deviation_before, moves.max_deviation()
+    )
@@ -0,0 +1,691 @@
+"""
+Vectorized counterpart of `crush.apply_plan`: maps a whole array of inputs at
+once. Every lane follows exactly the same control flow as the scalar code, the
+branches are expressed with masks and the straw2 selection is computed for all
+lanes sitting in the same bucket with a single NumPy expression.
+"""
+
+from dataclasses import dataclass, field
+from parser import AlgType, Bucket, BucketT, Device, Rule
+
+import numpy as np
+import numpy.typing as npt
+
+from crush import (CRUSH_ITEM_NONE, MappingStats, PlanChoose, PlanEmit,
+                   PlanTake, RulePlan, Tunables, compile_rule)
+from hashing import (crush_hash32_3_many, crush_hash32_4_many, crush_hash_2_many,
+                     crush_ln_many)
+from hierarchy import FlatHierarchy
+
+IntArray = npt.NDArray[np.int64]
+BoolArray = npt.NDArray[np.bool_]
+
+NONE = -1  # empty slot in node index arrays
+HOLE = -2  # position an `indep` step couldn't fill
+
+S64_MIN = np.iinfo(np.int64).min
+
+# upper bound on the size of a (lanes x children) straw2 draw matrix
+_MAX_DRAW_CELLS = 1 << 22
+
+
+@dataclass
+class BatchResult:
+    flat: FlatHierarchy
+    # (len(xs), width) node indices of the emitted devices, NONE padded, with
+    # HOLE at the positions `indep` steps couldn't fill
+    nodes: IntArray
+    # lane -> error, for the inputs `apply` would return a string for
+    errors: dict[int, str]
+
+    def osds(self) -> IntArray:
+        """Device ids, padded with -1, holes are `CRUSH_ITEM_NONE`"""
+        ids = np.where(self.nodes == HOLE, CRUSH_ITEM_NONE, -1)
+        return np.where(self.nodes >= 0, self.flat.ids[self.nodes], ids)
+
+    def devices(self, lane: int) -> list[Device | None] | str:
+        if (e := self.errors.get(lane)) is not None:
+            return e
+        nodes = self.flat.nodes
+        row = self.nodes[lane].tolist()
+        return [
+            nodes[i] if i != HOLE else None for i in row if i != NONE  # type: ignore
+        ]
+
+    def to_list(self) -> list[list[Device | None] | str]:
+        return [self.devices(lane) for lane in range(len(self.nodes))]
+
+
+@dataclass
+class Trace:
+    """
+    (x, node index) pairs of the buckets the descents entered and of the items
+    `Bucket.choose` selected along the way
+    """
+
+    entered: list[tuple[IntArray, IntArray]] = field(default_factory=list)
+    selected: list[tuple[IntArray, IntArray]] = field(default_factory=list)
+
+
+def _compact(a: IntArray) -> IntArray:
+    """Moves NONE slots to the end of every row keeping the order of the rest"""
+    order = np.argsort(a == NONE, axis=1, kind="stable")
+    a = np.take_along_axis(a, order, axis=1)
+    width = int((a != NONE).sum(axis=1).max(initial=0))
+    return a[:, :width]
+
+
+def _straw2_many(
+    flat: FlatHierarchy, b: int, x: IntArray, r: IntArray, pos: IntArray
+) -> IntArray:
+    children = flat.children_of(b).astype(np.int64)
+    ids = flat.ids[children]
+    if (weight_set := flat.weight_sets.get(b)) is None:
+        ws = flat.fixed_weights[children][None, :]
+    else:
+        # (lanes, children): the vector of every lane's position
+        ws = weight_set[np.minimum(pos, len(weight_set) - 1)]
+
+    best = np.zeros(len(x), dtype=np.int64)
+    best_draw = np.full(len(x), S64_MIN, dtype=np.int64)
+    step = max(1, _MAX_DRAW_CELLS // max(1, len(x)))
+    for lo in range(0, len(children), step):
+        w = ws[:, lo : lo + step]
+        u = crush_hash32_3_many(x[:, None], ids[None, lo : lo + step], r[:, None])
+        ln = crush_ln_many(u & 0xFFFF) - 0x1000000000000
+        # ln <= 0: div64_s64 truncates toward zero
+        draw = np.where(w > 0, -(-ln // np.maximum(w, 1)), S64_MIN)
+        i = np.argmax(draw, axis=1)
+        d = draw[np.arange(len(x)), i]
+        # strict comparison: the first child with the highest draw wins
+        better = d > best_draw
+        if lo == 0:
+            better[:] = True
+        best = np.where(better, i + lo, best)
+        best_draw = np.where(better, d, best_draw)
+    return children[best]
+
+
+def _uniform_many(
+    flat: FlatHierarchy, b: int, x: IntArray, r: IntArray
+) -> IntArray:
+    """
+    `Bucket._choose_uniform` for lanes: every lane builds its permutation up
+    to the largest position any lane needs
+    """
+    children = flat.children_of(b).astype(np.int64)
+    size = len(children)
+    pr = r % size
+
+    res = crush_hash32_3_many(x, flat.ids[b], 0).astype(np.int64) % size
+    if not pr.any():
+        # the common r = 0 case only needs the first swap
+        return children[res]
+    step = max(1, _MAX_DRAW_CELLS // size)
+    for lo in range(0, len(x), step):
+        xs, prs = x[lo : lo + step], pr[lo : lo + step]
+        rows = np.arange(len(xs))
+        perm = np.tile(np.arange(size, dtype=np.int64), (len(xs), 1))
+        # no point in swapping the last entry
+        for p in range(min(int(prs.max(initial=0)) + 1, size - 1)):
+            h = crush_hash32_3_many(xs, flat.ids[b], p).astype(np.int64)
+            i = p + h % (size - p)
+            perm[rows, p], perm[rows, i] = perm[rows, i], perm[rows, p]
+        res[lo : lo + step] = perm[rows, prs]
+    return children[res]
+
+
+def _list_many(flat: FlatHierarchy, b: int, x: IntArray, r: IntArray) -> IntArray:
+    children = flat.children_of(b).astype(np.int64)
+    ids = flat.ids[children]
+    weights = flat.fixed_weights[children]
+    sums = np.cumsum(weights)
+
+    res = np.empty(len(x), dtype=np.int64)
+    step = max(1, _MAX_DRAW_CELLS // max(1, len(children)))
+    for lo in range(0, len(x), step):
+        xs, rs = x[lo : lo + step, None], r[lo : lo + step, None]
+        u = crush_hash32_4_many(xs, ids[None, :], rs, flat.ids[b]) & 0xFFFF
+        hit = (u.astype(np.int64) * sums[None, :]) >> 16 < weights[None, :]
+        # the last child which accepts, the first one when none does
+        last = len(children) - 1 - np.argmax(hit[:, ::-1], axis=1)
+        res[lo : lo + step] = np.where(hit.any(axis=1), last, 0)
+    return children[res]
+
+
+def _tree_many(flat: FlatHierarchy, b: int, x: IntArray, r: IntArray) -> IntArray:
+    bucket: Bucket = flat.nodes[b]  # type: ignore
+    nodes = np.array(bucket.fixed_weights()[1], dtype=np.uint64)
+    children = flat.children_of(b).astype(np.int64)
+    if nodes[len(nodes) >> 1] == 0:
+        # see `Bucket._choose_tree`
+        return np.full(len(x), children[0], dtype=np.int64)
+    # every leaf is at the same depth: all lanes descend in lockstep
+    n = np.full(len(x), len(nodes) >> 1, dtype=np.int64)
+    while len(n) > 0 and n[0] & 1 == 0:
+        half = (n & -n) >> 1
+        h = crush_hash32_4_many(x, n, r, flat.ids[b]).astype(np.uint64)
+        t = (h * nodes[n]) >> np.uint64(32)
+        left = n - half
+        n = np.where(t < nodes[left], left, n + half)
+    return children[n >> 1]
+
+
+def _choose_many(
+    flat: FlatHierarchy,
+    cur: IntArray,
+    x: IntArray,
+    r: IntArray,
+    pos: IntArray,
+    trace: Trace | None,
+) -> IntArray:
+    """
+    `Bucket.choose` for every lane, `cur` holds bucket node indices and `pos`
+    the result positions
+    """
+    res = np.empty_like(cur)
+    order = np.argsort(cur, kind="stable")
+    groups, starts = np.unique(cur[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for b, lo, hi in zip(groups.tolist(), starts.tolist(), ends.tolist()):
+        lanes = order[lo:hi]
+        match flat.alg(b):
+            case AlgType.straw2:
+                res[lanes] = _straw2_many(flat, b, x[lanes], r[lanes], pos[lanes])
+            case AlgType.uniform:
+                res[lanes] = _uniform_many(flat, b, x[lanes], r[lanes])
+            case AlgType.list:
+                res[lanes] = _list_many(flat, b, x[lanes], r[lanes])
+            case AlgType.tree:
+                res[lanes] = _tree_many(flat, b, x[lanes], r[lanes])
+
+    if trace is not None:
+        trace.entered.append((x, cur))
+        trace.selected.append((x, res))
+    return res
+
+
+def _descend_many(
+    flat: FlatHierarchy,
+    start: IntArray,
+    x: IntArray,
+    r: IntArray,
+    pos: IntArray,
+    target: int,
+    trace: Trace | None,
+) -> IntArray:
+    """
+    Chooses items starting at `start` until either a bucket of `target` type
+    or a device is reached
+    """
+    cur = start.copy()
+    todo = np.arange(len(cur))
+    while len(todo) > 0:
+        chosen = _choose_many(flat, cur[todo], x[todo], r[todo], pos[todo], trace)
+        cur[todo] = chosen
+        deeper = (flat.ids[chosen] < 0) & (flat.types[chosen] != target)
+        todo = todo[deeper]
+    return cur
+
+
+def _is_out_many(flat: FlatHierarchy, d: IntArray, x: IntArray) -> BoolArray:
+    """`is_out` for every lane, on the 16.16 weights"""
+    w = flat.fixed_weights[d]
+    h = (crush_hash_2_many(x, flat.ids[d]) & 0xFFFF).astype(np.int64)
+    return (w < 0x10000) & (h >= w)
+
+
+def _is_collision_many(out: IntArray, item: IntArray) -> BoolArray:
+    return (out == item[:, None]).any(axis=1)
+
+
+def _add_replicas(
+    stats: MappingStats, x: IntArray, retries: IntArray, skipped: int
+) -> None:
+    """`MappingStats.add_replica` for one replica of every lane"""
+    values, counts = np.unique(retries, return_counts=True)
+    stats.retries.update(dict(zip(values.tolist(), counts.tolist())))
+    retried = retries > 0
+    inputs, inverse = np.unique(x[retried], return_inverse=True)
+    sums = np.bincount(inverse, weights=retries[retried]).astype(np.int64)
+    stats.pg_retries.update(dict(zip(inputs.tolist(), sums.tolist())))
+    stats.skipped += skipped
+
+
+def _choose_leaf_many(
+    flat: FlatHierarchy,
+    x: IntArray,
+    b: IntArray,
+    out2: IntArray,
+    outpos: IntArray,
+    r: IntArray,
+    tries: int,
+    trace: Trace | None,
+    stats: MappingStats | None,
+) -> IntArray:
+    """
+    The recursive `choose_firstn(x, b, "osd", ...)` call made by chooseleaf
+    steps, starting from `r`, returns NONE for lanes that ran out of tries
+    """
+    res = np.full(len(x), NONE, dtype=np.int64)
+    ftotal = np.zeros(len(x), dtype=np.int64)
+    todo = np.arange(len(x))
+    while len(todo) > 0:
+        d = _descend_many(
+            flat, b[todo], x[todo], r[todo] + ftotal[todo], outpos[todo], 0, trace
+        )
+        collision = _is_collision_many(out2[todo], d)
+        rejected = _is_out_many(flat, d, x[todo])
+        failed = collision | rejected
+        if stats is not None:
+            stats.descents += len(todo)
+            stats.collisions += int(collision.sum())
+            stats.rejected_out += int((rejected & ~collision).sum())
+
+        res[todo[~failed]] = d[~failed]
+        retry = failed & (ftotal[todo] < tries)
+        todo = todo[retry]
+        ftotal[todo] += 1
+
+    if stats is not None:
+        _add_replicas(stats, x, ftotal, int((res == NONE).sum()))
+    return res
+
+
+def _choose_firstn_many(
+    flat: FlatHierarchy,
+    x: IntArray,
+    cur: IntArray,
+    target: int,
+    num_replicas: IntArray,
+    tries: int,
+    recurcive_tries: int,
+    recurse_to_leaf: bool,
+    trace: Trace | None,
+    stats: MappingStats | None,
+    vary_r: int = 0,
+    stable: int = 1,
+) -> IntArray:
+    """
+    `crush.choose_firstn` over lanes, returns the out (or out2 for
+    chooseleaf steps) array of every lane
+    """
+    n = len(x)
+    width = int(num_replicas.max(initial=0))
+    out = np.full((n, width), NONE, dtype=np.int64)
+    out2 = np.full((n, width), NONE, dtype=np.int64)
+    outpos = np.zeros(n, dtype=np.int64)
+    ftotal = np.zeros(n, dtype=np.int64)
+    rows = np.arange(n)
+
+    for rep in range(width):
+        todo = rows[num_replicas > rep]
+        replicas, start, skipped = todo, ftotal[todo], 0
+        while len(todo) > 0:
+            r = rep + ftotal[todo]
+            chosen = _descend_many(
+                flat, cur[todo], x[todo], r, outpos[todo], target, trace
+            )
+            is_bucket = flat.ids[chosen] < 0
+
+            failed = _is_collision_many(out[todo], chosen)
+            if stats is not None:
+                stats.descents += len(todo)
+                stats.collisions += int(failed.sum())
+            if target != 0:
+                failed |= ~is_bucket
+            else:
+                dev = ~is_bucket
+                rejected = _is_out_many(flat, chosen[dev], x[todo][dev])
+                if stats is not None:
+                    stats.rejected_out += int((rejected & ~failed[dev]).sum())
+                failed[dev] |= rejected
+
+            ok = ~failed
+            leaf = chosen
+            if recurse_to_leaf:
+                leaf = chosen.copy()
+                inner = np.flatnonzero(ok & is_bucket)
+                # see `choose_firstn` for the tunables
+                sub_r = r[inner] >> (vary_r - 1) if vary_r else np.zeros_like(inner)
+                leaf[inner] = _choose_leaf_many(
+                    flat,
+                    x[todo][inner],
+                    chosen[inner],
+                    out2[todo][inner],
+                    outpos[todo][inner],
+                    sub_r if stable else sub_r + outpos[todo][inner],
+                    recurcive_tries,
+                    trace,
+                    stats,
+                )
+                no_leaf = ok & (leaf == NONE)
+                ok &= ~no_leaf
+                failed |= no_leaf
+
+            placed = todo[ok]
+            out[placed, outpos[placed]] = chosen[ok]
+            if recurse_to_leaf:
+                out2[placed, outpos[placed]] = leaf[ok]
+            outpos[placed] += 1
+
+            retry = failed & (ftotal[todo] < tries)
+            if stats is not None:
+                skipped += int((failed & ~retry).sum())
+            todo = todo[retry]
+            ftotal[todo] += 1
+
+        if stats is not None:
+            _add_replicas(stats, x[replicas], ftotal[replicas] - start, skipped)
+
+    return out2 if recurse_to_leaf else out
+
+
+def _descend_indep_many(
+    flat: FlatHierarchy,
+    start: IntArray,
+    x: IntArray,
+    r: IntArray,
+    ftotal: int,
+    num_replicas: int,
+    pos: IntArray,
+    target: int,
+    trace: Trace | None,
+) -> tuple[IntArray, IntArray]:
+    """
+    `_descend_many` drawing with the r of `choose_indep` in round `ftotal`,
+    which depends on the bucket. Also returns the r of the last choice.
+    """
+    sizes = np.diff(flat.child_offsets)
+    cur = start.copy()
+    last_r = r.copy()
+    todo = np.arange(len(cur))
+    while len(todo) > 0:
+        b = cur[todo]
+        uniform = (flat.algs[b] == AlgType.uniform.value) & (
+            sizes[b] % num_replicas == 0
+        )
+        rb = r[todo] + (num_replicas + uniform) * ftotal
+        chosen = _choose_many(flat, b, x[todo], rb, pos[todo], trace)
+        cur[todo] = chosen
+        last_r[todo] = rb
+        deeper = (flat.ids[chosen] < 0) & (flat.types[chosen] != target)
+        todo = todo[deeper]
+    return cur, last_r
+
+
+def _choose_indep_leaf_many(
+    flat: FlatHierarchy,
+    x: IntArray,
+    b: IntArray,
+    rep: int,
+    parent_r: IntArray,
+    num_replicas: int,
+    tries: int,
+    trace: Trace | None,
+    stats: MappingStats | None,
+) -> IntArray:
+    """
+    The recursive `choose_indep(x, b, "osd", 1, ...)` call made by chooseleaf
+    steps for position `rep`, returns HOLE for lanes that ran out of tries
+    """
+    res = np.full(len(x), HOLE, dtype=np.int64)
+    rounds = np.full(len(x), tries, dtype=np.int64)
+    pos = np.full(len(x), rep, dtype=np.int64)
+    todo = np.arange(len(x))
+    for ftotal in range(tries + 1):
+        if len(todo) == 0:
+            break
+        d, _ = _descend_indep_many(
+            flat,
+            b[todo],
+            x[todo],
+            rep + parent_r[todo],
+            ftotal,
+            num_replicas,
+            pos[todo],
+            0,
+            trace,
+        )
+        rejected = _is_out_many(flat, d, x[todo])
+        if stats is not None:
+            stats.descents += len(todo)
+            stats.rejected_out += int(rejected.sum())
+        res[todo[~rejected]] = d[~rejected]
+        rounds[todo[~rejected]] = ftotal
+        todo = todo[rejected]
+
+    if stats is not None:
+        _add_replicas(stats, x, rounds, int((res == HOLE).sum()))
+    return res
+
+
+def _choose_indep_many(
+    flat: FlatHierarchy,
+    x: IntArray,
+    cur: IntArray,
+    target: int,
+    left: IntArray,
+    num_replicas: int,
+    tries: int,
+    recurse_to_leaf: bool,
+    trace: Trace | None,
+    stats: MappingStats | None,
+) -> IntArray:
+    """
+    `crush.choose_indep` over lanes filling `left` positions each, returns
+    the out (or out2 for chooseleaf steps) array of every lane. Rounds and
+    positions are walked in the scalar order, as a position can collide with
+    the ones filled before it in the same round.
+    """
+    n = len(x)
+    width = int(left.max(initial=0))
+    valid = np.arange(width)[None, :] < left[:, None]
+    out = np.full((n, width), HOLE, dtype=np.int64)
+    out2 = np.full((n, width), HOLE, dtype=np.int64)
+    pending = valid.copy()
+    rounds = np.full((n, width), tries, dtype=np.int64)
+    pos = np.zeros(n, dtype=np.int64)
+
+    for ftotal in range(tries + 1):
+        if not pending.any():
+            break
+        for rep in range(width):
+            lanes = np.flatnonzero(pending[:, rep])
+            if len(lanes) == 0:
+                continue
+            chosen, r = _descend_indep_many(
+                flat,
+                cur[lanes],
+                x[lanes],
+                np.full(len(lanes), rep, dtype=np.int64),
+                ftotal,
+                num_replicas,
+                pos[lanes],
+                target,
+                trace,
+            )
+            is_device = flat.ids[chosen] >= 0
+            # a device where a bucket was expected is final
+            hole = is_device & (target != 0)
+            collision = ~hole & _is_collision_many(out[lanes], chosen)
+            if stats is not None:
+                stats.descents += len(lanes)
+                stats.collisions += int(collision.sum())
+
+            ok = ~hole & ~collision
+            if recurse_to_leaf:
+                leaf = chosen.copy()
+                inner = np.flatnonzero(ok & ~is_device)
+                leaf[inner] = _choose_indep_leaf_many(
+                    flat,
+                    x[lanes][inner],
+                    chosen[inner],
+                    rep,
+                    r[inner],
+                    num_replicas,
+                    0,
+                    trace,
+                    stats,
+                )
+                out2[lanes[ok], rep] = leaf[ok]
+                ok &= leaf != HOLE
+
+            rejected = ok & is_device
+            rejected[rejected] = _is_out_many(
+                flat, chosen[rejected], x[lanes][rejected]
+            )
+            if stats is not None:
+                stats.rejected_out += int(rejected.sum())
+            ok &= ~rejected
+
+            out[lanes[ok], rep] = chosen[ok]
+            settled = lanes[ok | hole]
+            pending[settled, rep] = False
+            rounds[settled, rep] = ftotal
+
+    if stats is not None:
+        for rep in range(width):
+            placed = valid[:, rep]
+            holes = int((out[placed, rep] == HOLE).sum())
+            _add_replicas(stats, x[placed], rounds[placed, rep], holes)
+
+    res = out2 if recurse_to_leaf else out
+    res[~valid] = NONE
+    return res
+
+
+def _apply_indep_many(
+    flat: FlatHierarchy,
+    x: IntArray,
+    c: PlanChoose,
+    i: IntArray,
+    pool_replicas: int,
+    tunables: Tunables,
+    trace: Trace | None,
+    stats: MappingStats | None,
+) -> IntArray:
+    """An `indep` step of `apply_plan_many`, see `crush._apply_indep`"""
+    num_replicas = c.n if c.n > 0 else pool_replicas + c.n
+    if num_replicas <= 0:
+        return i[:, :0]
+
+    n = len(x)
+    rows = np.arange(n)
+    target = BucketT.BUCKETS_HIERARCHY[c.bucket_type]  # type: ignore
+    produced = np.zeros(n, dtype=np.int64)
+    columns: list[IntArray] = []
+    for col in i.T:
+        lanes = rows[(col >= 0) & (flat.ids[col] < 0)]
+        left = np.clip(pool_replicas - produced[lanes], 0, num_replicas)
+        res = _choose_indep_many(
+            flat,
+            x[lanes],
+            col[lanes],
+            target,
+            left,
+            num_replicas,
+            tunables.choose_total_tries,
+            c.is_chooseleaf,
+            trace,
+            stats,
+        )
+        produced[lanes] += left
+        new_col = np.full((n, res.shape[1]), NONE, dtype=np.int64)
+        new_col[lanes] = res
+        columns.append(new_col)
+    return _compact(np.concatenate(columns, axis=1)) if columns else i[:, :0]
+
+
+def apply_plan_many(
+    xs: npt.ArrayLike,
+    plan: RulePlan,
+    flat: FlatHierarchy,
+    pool_replicas: int,
+    tunables: Tunables,
+    trace: Trace | None = None,
+    stats: MappingStats | None = None,
+) -> BatchResult:
+    """
+    `trace`, when given, collects the buckets every input touched and `stats`
+    the retries their descents needed
+    """
+    x = np.asarray(xs, dtype=np.int64)
+    n = len(x)
+    rows = np.arange(n)
+
+    i = np.full((n, 1), flat.node_of(plan.root), dtype=np.int64)
+    o = np.full((n, 0), NONE, dtype=np.int64)
+    errors: dict[int, str] = {}
+
+    for j, s in enumerate(plan.steps):
+        match s:
+            case PlanTake(target=target):
+                i = np.full((n, 1), flat.node_of(target), dtype=np.int64)
+            case PlanChoose(is_indep=True) as c:
+                i = _apply_indep_many(
+                    flat, x, c, i, pool_replicas, tunables, trace, stats
+                )
+            case PlanChoose() as c:
+                target = BucketT.BUCKETS_HIERARCHY[c.bucket_type]  # type: ignore
+                columns: list[IntArray] = []
+                for col in i.T:
+                    lanes = rows[(col >= 0) & (flat.ids[col] < 0)]
+                    starts = col[lanes]
+                    if c.n == 0:
+                        num_replicas = np.diff(flat.child_offsets)[starts]
+                    elif c.n < 0:
+                        num_replicas = np.full(len(lanes), pool_replicas + c.n)
+                    else:
+                        num_replicas = np.full(len(lanes), c.n)
+
+                    res = _choose_firstn_many(
+                        flat,
+                        x[lanes],
+                        starts,
+                        target,
+                        num_replicas.astype(np.int64),
+                        tunables.choose_total_tries,
+                        tunables.recurse_tries,
+                        c.is_chooseleaf,
+                        trace,
+                        stats,
+                        tunables.chooseleaf_vary_r,
+                        tunables.chooseleaf_stable,
+                    )
+                    new_col = np.full((n, res.shape[1]), NONE, dtype=np.int64)
+                    new_col[lanes] = res
+                    columns.append(new_col)
+                i = _compact(np.concatenate(columns, axis=1)) if columns else i[:, :0]
+            case PlanEmit():
+                is_bucket = (i >= 0) & (flat.ids[i] < 0)
+                for lane in np.flatnonzero(is_bucket.any(axis=1)).tolist():
+                    if lane in errors:
+                        continue
+                    buckets = [
+                        f"[{flat.ids[b]}] {flat.nodes[b].name}"  # type: ignore
+                        for b in i[lane][is_bucket[lane]].tolist()
+                    ]
+                    errors[lane] = (
+                        "{}th step of crush rule generated buckets: {}".format(
+                            j, ",".join(buckets)
+                        )
+                    )
+                o = _compact(np.concatenate([o, i], axis=1))
+                i = i[:, :0]
+
+    return BatchResult(flat, o, errors)
+
+
+def apply_many(
+    xs: npt.ArrayLike,
+    root: Bucket,
+    rule: Rule,
+    pool_replicas: int,
+    tunables: Tunables,
+) -> list[list[Device | None] | str]:
+    # builds the plan and the flat hierarchy on every call: use
+    # `apply_plan_many` when mapping repeatedly
+    plan = compile_rule(root, rule)
+    flat = FlatHierarchy.from_root(root, attach=False)
+    return apply_plan_many(xs, plan, flat, pool_replicas, tunables).to_list()
@@ -1,36 +1,45 @@
-from dataclasses import dataclass
-from hashlib import sha256
-from typing import Literal
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Literal, TypedDict
 from hashing import crush_hash_2
 from parser import (
+    AlgType,
     Bucket,
     BucketT,
     StepChoose,
     Device,
     DeviceInfo,
+    ParsingError,
     Rule,
     StepEmit,
     StepTake,
     WeightT,
     OutOfClusterWeight,
+    ParserResult,
     UnitWeight,
+    to_fixed_weight,
 )
 
 
-def bfs(h: Bucket | Device, name: str) -> Bucket | Device | None:
-    q: list[Bucket | Device] = [h]
+class RuleCompilationError(ParsingError): ...
+
+
+# Ceph's id of the holes `indep` steps leave in a mapping
+CRUSH_ITEM_NONE = 0x7FFFFFFF
+
+
+def build_name_index(root: Bucket) -> dict[str, Bucket | Device]:
+    index: dict[str, Bucket | Device] = {}
+    q: list[Bucket | Device] = [root]
     while len(q) > 0:
         s = q.pop()
         match s:
             case Bucket() as b:
-                if b.name == name:
-                    return b
-                for bd in b.children:
-                    q.append(bd)
+                index[b.name] = b
+                q.extend(b.children)
             case Device(DeviceInfo(id=id)) as d:
-                if f"osd.{id}" == name:
-                    return d
-    return None
+                index[f"osd.{id}"] = d
+    return index
 
 
 @dataclass
@@ -38,18 +47,108 @@ class Tunables:
     # Tunable. The default value when the
     # CHOOSE_TRIES or CHOOSELEAF_TRIES steps are omitted in a rule.
     choose_total_tries: int
+    # 1: the inner choose of chooseleaf steps descends once instead of
+    # retrying `choose_total_tries` times, a failure retries the outer choose
+    chooseleaf_descend_once: int = 0
+    # n > 0: the inner choose starts from r >> (n - 1) of the outer one
+    # instead of 0, so that a retried outer choose doesn't retry the same leaf
+    chooseleaf_vary_r: int = 0
+    # 0: the inner choose starts from the result position, which shifts the
+    # leaves of every following replica when one of them is marked out
+    chooseleaf_stable: int = 1
+
+    @classmethod
+    def from_parser_result(
+        cls, r: ParserResult, choose_total_tries: int
+    ) -> "Tunables":
+        """`choose_total_tries` is used unless the map sets it"""
+        return cls(**{"choose_total_tries": choose_total_tries, **r.tunables})
+
+    @property
+    def recurse_tries(self) -> int:
+        """Tries of the inner choose of chooseleaf steps"""
+        return 0 if self.chooseleaf_descend_once else self.choose_total_tries
+
+
+# Ceph's named profiles, "baseline" is what this simulator always did
+TUNABLE_PROFILES: dict[str, Tunables] = {
+    "baseline": Tunables(50),
+    "argonaut": Tunables(19, chooseleaf_stable=0),
+    "bobtail": Tunables(50, chooseleaf_descend_once=1, chooseleaf_stable=0),
+    "firefly": Tunables(
+        50, chooseleaf_descend_once=1, chooseleaf_vary_r=1, chooseleaf_stable=0
+    ),
+    "jewel": Tunables(50, chooseleaf_descend_once=1, chooseleaf_vary_r=1),
+}
+
+
+class JSONMappingStats(TypedDict):
+    descents: int
+    collisions: int
+    rejected_out: int
+    skipped: int
+    retries: dict[str, int]
+    worst_pgs: dict[str, int]
+
+
+@dataclass
+class MappingStats:
+    """
+    Opt-in counters of the work done by `choose_firstn` and `choose_indep`, for
+    one rule. Mapping without them costs a `None` check per event.
+    """
+
+    # descents started from the bucket of a choose step, the ones of
+    # chooseleaf's inner choose included
+    descents: int = 0
+    collisions: int = 0
+    # devices `is_out` rejected
+    rejected_out: int = 0
+    # replicas given up on once out of tries
+    skipped: int = 0
+    # retries needed by a replica -> replicas
+    retries: Counter[int] = field(default_factory=Counter)
+    # input -> retries over all of its replicas, inputs without any are left out
+    pg_retries: Counter[int] = field(default_factory=Counter)
+
+    def add_replica(self, x: int, retries: int, skipped: bool) -> None:
+        self.retries[retries] += 1
+        if retries > 0:
+            self.pg_retries[x] += retries
+        if skipped:
+            self.skipped += 1
+
+    def merge(self, other: "MappingStats") -> None:
+        self.descents += other.descents
+        self.collisions += other.collisions
+        self.rejected_out += other.rejected_out
+        self.skipped += other.skipped
+        self.retries.update(other.retries)
+        self.pg_retries.update(other.pg_retries)
+
+    def to_json(self, worst: int = 10) -> JSONMappingStats:
+        return {
+            "descents": self.descents,
+            "collisions": self.collisions,
+            "rejected_out": self.rejected_out,
+            "skipped": self.skipped,
+            "retries": {str(n): c for n, c in sorted(self.retries.items())},
+            "worst_pgs": {
+                str(x): n for x, n in self.pg_retries.most_common(worst)
+            },
+        }
 
 
 def is_out(weight: WeightT, item: int, x: int) -> bool:
+    """
+    Ceph's `is_out`: a device weighing less than 1 keeps a `weight` share of
+    the inputs, drawn with the CRUSH hash of (x, device)
+    """
     if weight >= UnitWeight:
         return False
     if weight == OutOfClusterWeight:
         return True
-    
-    h = int(sha256(str((x, item)).encode()).hexdigest(), 16)
-    if (h & 0xFFFF) < weight * 0xFFFF:
-        return False
-    return True
+    return (crush_hash_2(x, item) & 0xFFFF) >= to_fixed_weight(weight)
 
 
 def is_collision(out: list[Device] | list[Bucket], outpos: int, id: int) -> bool:
@@ -77,22 +176,33 @@ def choose_firstn(
     out: list[Device] | list[Bucket],
     out2: list[Device],
     outpos: int,
+    stats: MappingStats | None = None,
+    vary_r: int = 0,
+    stable: int = 1,
+    parent_r: int = 0,
 ) -> int:
+    """
+    Ceph's `crush_choose_firstn`, `vary_r` and `stable` are the chooseleaf
+    tunables and `parent_r` the r the inner choose of chooseleaf starts from
+    """
     if num_replicas == 0:
         num_replicas = len(cur.children)
     elif num_replicas < 0:
         num_replicas = max_replicas + num_replicas
 
     ftotal = 0
-    for rep in range(num_replicas):
+    for rep in range(0 if stable else outpos, num_replicas):
         skip_rep = False
+        start = ftotal
         while True:
             item = cur
             repeat_descent = False
-            r = rep + ftotal
+            r = rep + parent_r + ftotal
+            if stats is not None:
+                stats.descents += 1
             while True:
                 repeat_bucket = False
-                bd = item.choose(x, r)
+                bd = item.choose(x, r, outpos)
                 match bd:
                     case Bucket() as b:
                         if b.type != target:
@@ -101,6 +211,8 @@ def choose_firstn(
                             continue
 
                         if is_collision(out, outpos, b.id):
+                            if stats is not None:
+                                stats.collisions += 1
                             if ftotal >= tries:
                                 skip_rep = True
                             else:
@@ -113,7 +225,7 @@ def choose_firstn(
                                 x,
                                 b,
                                 "osd",
-                                1,
+                                1 if stable else outpos + 1,
                                 0,
                                 recurcive_tries,
                                 0,
@@ -121,9 +233,19 @@ def choose_firstn(
                                 out2,
                                 [],
                                 outpos,
+                                stats,
+                                vary_r,
+                                stable,
+                                r >> (vary_r - 1) if vary_r else 0,
                             )
                             if res <= outpos:
-                                skip_rep = True
+                                # no leaf: reject the bucket and retry the outer
+                                # choose, descend_once only bounds the leaf tries
+                                if ftotal >= tries:
+                                    skip_rep = True
+                                else:
+                                    ftotal += 1
+                                    repeat_descent = True
                                 break
                         out.append(b)  # type: ignore by invariant
                         outpos += 1
@@ -133,6 +255,11 @@ def choose_firstn(
                             or is_collision(out, outpos, d.info.id)
                             or is_out(d.weight, d.info.id, x)
                         ):
+                            if stats is not None and target == "osd":
+                                if is_collision(out, outpos, d.info.id):
+                                    stats.collisions += 1
+                                else:
+                                    stats.rejected_out += 1
                             if ftotal >= tries:
                                 skip_rep = True
                             else:
@@ -148,76 +275,250 @@ def choose_firstn(
             if not repeat_descent:
                 break
 
+        if stats is not None:
+            stats.add_replica(x, ftotal - start, skip_rep)
         if skip_rep:
             continue
 
     return outpos
 
 
-def apply(
+def choose_indep(
     x: int,
-    root: Bucket,
-    rule: Rule,
-    pool_replicas: int,
-    tunables: Tunables,
-) -> list[Device] | str:
-    i: list[Device | Bucket] = [root]
-    o: list[Device] = []
-
-    rules = rule.rules
-    new_i: list[Device | Bucket] = []
-    for j in range(len(rules)):
-        s = rules[j]
-        match s:
-            case StepTake() as t:
-                for item in i:
-                    h = bfs(item, t.name)
-                    if h is None:
-                        continue
-                    new_i.append(h)
-            case StepChoose() as c:
-                if c.is_chooseleaf:
-                    for item in i:
-                        if isinstance(item, Device):
-                            continue
+    cur: Bucket,
+    target: BucketT | Literal["osd"],
+    left: int,
+    num_replicas: int,
+    tries: int,
+    recurcive_tries: int,
+    recurse_to_leaf: bool,
+    out: list[Bucket | Device | None],
+    out2: list[Device | None],
+    outpos: int,
+    stats: MappingStats | None = None,
+    parent_r: int = 0,
+) -> None:
+    """
+    Ceph's `crush_choose_indep`: fills the `left` positions of `out` (and of
+    `out2` for chooseleaf) from `outpos`, which have to exist. Every round
+    retries the positions which failed only, so a rejected item doesn't shift
+    the others. Positions still empty after `tries` rounds are holes (None,
+    `CRUSH_ITEM_NONE` in Ceph).
+    """
+    endpos = outpos + left
+    # position -> round it was settled in, hole or not
+    settled: dict[int, int] = {}
+    for rep in range(outpos, endpos):
+        out[rep] = None
+        if recurse_to_leaf:
+            out2[rep] = None
 
-                        out: list[Bucket] | list[Device] = []
-                        out2: list[Device] = []
-                        choose_firstn(
-                            x,
-                            item,
-                            c.bucket_type,
-                            s.n,
-                            pool_replicas,
-                            tunables.choose_total_tries,
-                            tunables.choose_total_tries,
-                            True,
-                            out,
-                            out2,
-                            0,
-                        )
-                        new_i.extend(out2)
-                else:
-                    for item in i:
-                        if isinstance(item, Device):
-                            continue
+    ftotal = 0
+    while len(settled) < left and ftotal <= tries:
+        for rep in range(outpos, endpos):
+            if rep in settled:
+                continue
+            if stats is not None:
+                stats.descents += 1
+            item = cur
+            while True:
+                # uniform buckets would draw the same items again when their
+                # size is a multiple of num_replicas
+                stride = num_replicas
+                if (
+                    item.alg == AlgType.uniform
+                    and len(item.children) % num_replicas == 0
+                ):
+                    stride += 1
+                r = rep + parent_r + stride * ftotal
+                chosen = item.choose(x, r, outpos)
+                if isinstance(chosen, Bucket) and chosen.type != target:
+                    item = chosen
+                    continue
+                if isinstance(chosen, Device) and target != "osd":
+                    settled[rep] = ftotal
+                    break
+                if any(o is chosen for o in out[outpos:endpos]):
+                    if stats is not None:
+                        stats.collisions += 1
+                    break
 
-                        out: list[Bucket] | list[Device] = []
-                        choose_firstn(
+                if recurse_to_leaf:
+                    if isinstance(chosen, Bucket):
+                        choose_indep(
                             x,
-                            item,
-                            c.bucket_type,
-                            s.n,
-                            pool_replicas,
-                            tunables.choose_total_tries,
-                            tunables.choose_total_tries,
+                            chosen,
+                            "osd",
+                            1,
+                            num_replicas,
+                            recurcive_tries,
+                            0,
                             False,
-                            out,
+                            out2,  # type: ignore (only holds devices)
                             [],
-                            0,
+                            rep,
+                            stats,
+                            r,
                         )
-                        new_i.extend(out)
+                        if out2[rep] is None:
+                            break
+                    else:
+                        out2[rep] = chosen
+                if isinstance(chosen, Device) and is_out(
+                    chosen.weight, chosen.info.id, x
+                ):
+                    if stats is not None:
+                        stats.rejected_out += 1
+                    break
+
+                out[rep] = chosen
+                settled[rep] = ftotal
+                break
+        ftotal += 1
+
+    if stats is not None:
+        for rep in range(outpos, endpos):
+            stats.add_replica(x, settled.get(rep, tries), out[rep] is None)
+
+
+@dataclass
+class PlanTake:
+    target: Bucket | Device
+
+
+@dataclass
+class PlanChoose:
+    is_chooseleaf: bool
+    n: int
+    bucket_type: BucketT | Literal["osd"]
+    is_indep: bool = False
+
+
+@dataclass
+class PlanEmit: ...
+
+
+PlanStepT = PlanTake | PlanChoose | PlanEmit
+
+
+@dataclass
+class RulePlan:
+    rule: Rule
+    root: Bucket
+    index: dict[str, Bucket | Device]
+    steps: list[PlanStepT]
+
+    def targets(self) -> list[Bucket | Device]:
+        """Items of the `take` steps"""
+        return [s.target for s in self.steps if isinstance(s, PlanTake)]
+
+    def choose_types(self) -> list[BucketT | Literal["osd"]]:
+        """Types of the `choose` steps, in order"""
+        return [s.bucket_type for s in self.steps if isinstance(s, PlanChoose)]
+
+
+def compile_rule(
+    root: Bucket, rule: Rule, index: dict[str, Bucket | Device] | None = None
+) -> RulePlan:
+    """
+    Resolves `take` targets and validates `choose` steps once, so that mapping
+    a PG only has to walk the resulting plan. `index` can be shared between
+    rules compiled against the same hierarchy.
+    """
+    if index is None:
+        index = build_name_index(root)
+
+    hierarchy = BucketT.BUCKETS_HIERARCHY  # type: ignore
+    # type of the items in the working set; None when it is empty
+    level: BucketT | Literal["osd"] | None = root.type
+    steps: list[PlanStepT] = []
+    for j, s in enumerate(rule.rules):
+        match s:
+            case StepTake(name=name, device_class=device_class):
+                target = index.get(name)
+                if target is None:
+                    raise RuleCompilationError(
+                        f"rule `{rule.name}`, step {j}: unknown item `{name}`"
+                    )
+                if device_class is not None:
+                    # the shadow tree of the class, see `build_shadow_trees`
+                    shadows = target._shadows if isinstance(target, Bucket) else {}
+                    if (shadow := shadows.get(device_class)) is None:
+                        raise RuleCompilationError(
+                            f"rule `{rule.name}`, step {j}: no `{device_class}` "
+                            f"devices under `{name}`"
+                        )
+                    target = shadow
+                steps.append(PlanTake(target))
+                level = target.type if isinstance(target, Bucket) else "osd"
+            case StepChoose() as c:
+                if level is None:
+                    raise RuleCompilationError(
+                        f"rule `{rule.name}`, step {j}: nothing to choose from, "
+                        "expected a `take` step"
+                    )
+                if hierarchy[c.bucket_type] >= hierarchy[level]:
+                    raise RuleCompilationError(
+                        f"rule `{rule.name}`, step {j}: can't choose "
+                        f"`{c.bucket_type}` items from `{level}`"
+                    )
+                steps.append(
+                    PlanChoose(c.is_chooseleaf, c.n, c.bucket_type, c.is_indep)
+                )
+                level = "osd" if c.is_chooseleaf else c.bucket_type
             case StepEmit():
+                steps.append(PlanEmit())
+                level = None
+    return RulePlan(rule, root, index, steps)
+
+
+def apply_plan(
+    x: int,
+    plan: RulePlan,
+    pool_replicas: int,
+    tunables: Tunables,
+    stats: MappingStats | None = None,
+) -> list[Device | None] | str:
+    """
+    Mapping of `x`, a list of devices in which `indep` steps leave None holes,
+    or the error of a rule emitting buckets
+    """
+    i: list[Device | Bucket | None] = [plan.root]
+    o: list[Device | None] = []
+
+    for j, s in enumerate(plan.steps):
+        match s:
+            case PlanTake(target=target):
+                i = [target]
+            case PlanChoose(is_indep=True) as c:
+                i = _apply_indep(x, c, i, pool_replicas, tunables, stats)
+            case PlanChoose() as c:
+                new_i: list[Device | Bucket | None] = []
+                for item in i:
+                    if not isinstance(item, Bucket):
+                        continue
+
+                    out: list[Bucket] | list[Device] = []
+                    out2: list[Device] = []
+                    choose_firstn(
+                        x,
+                        item,
+                        c.bucket_type,
+                        c.n,
+                        pool_replicas,
+                        tunables.choose_total_tries,
+                        tunables.recurse_tries,
+                        c.is_chooseleaf,
+                        out,
+                        out2,
+                        0,
+                        stats,
+                        tunables.chooseleaf_vary_r,
+                        tunables.chooseleaf_stable,
+                    )
+                    new_i.extend(out2 if c.is_chooseleaf else out)
+                i = new_i
+            case PlanEmit():
                 buckets: list[str] = []
                 for item in i:
                     if isinstance(item, Bucket):
@@ -225,11 +526,63 @@ def apply(
 
                 if len(buckets) > 0:
                     return "{}th step of crush rule generated buckets: {}".format(
-                        ",".join(buckets)
+                        j, ",".join(buckets)
                     )
                 o.extend(i)  # type: ignore
                 i = []
-        i = new_i
-        new_i = []
 
     return o
+
+
+def _apply_indep(
+    x: int,
+    c: PlanChoose,
+    i: list[Device | Bucket | None],
+    pool_replicas: int,
+    tunables: Tunables,
+    stats: MappingStats | None,
+) -> list[Device | Bucket | None]:
+    # n <= 0 is relative to the pool size, like firstn steps, and the step
+    # yields at most `pool_replicas` items, holes included
+    num_replicas = c.n if c.n > 0 else pool_replicas + c.n
+    if num_replicas <= 0:
+        return []
+
+    res: list[Device | Bucket | None] = []
+    for item in i:
+        if not isinstance(item, Bucket):
+            continue
+        left = min(num_replicas, pool_replicas - len(res))
+        if left <= 0:
+            break
+        out: list[Bucket | Device | None] = [None] * left
+        out2: list[Device | None] = [None] * left
+        choose_indep(
+            x,
+            item,
+            c.bucket_type,
+            left,
+            num_replicas,
+            tunables.choose_total_tries,
+            # Ceph's chooseleaf_tries: a single descent, whatever the tunables
+            0,
+            c.is_chooseleaf,
+            out,
+            out2,
+            0,
+            stats,
+        )
+        res.extend(out2 if c.is_chooseleaf else out)
+    return res
+
+
+def apply(
+    x: int,
+    root: Bucket,
+    rule: Rule,
+    pool_replicas: int,
+    tunables: Tunables,
+) -> list[Device | None] | str:
+    # compiles the rule on every call: use `compile_rule` + `apply_plan`
+    # when mapping more than a single input
+    return apply_plan(x, compile_rule(root, rule), pool_replicas, tunables)
@@ -0,0 +1,341 @@
+"""
+Offline placement runs over a map file, in the spirit of `crushtool --test`.
+
+    python crushtool.py maps/default_map --num-rep 3 --max-x 1023
+    python crushtool.py map --rule 0 --min-x 0 --max-x 9999999 --no-mappings
+    python crushtool.py old_map --compare new_map --pg-bytes 4294967296
+    python crushtool.py map --max-x 4095 --balance --max-deviation 1
+    python crushtool.py map --max-x 4095 --fit-weight-sets > choose_args
+    python crushtool.py map --max-x 65535 --no-mappings --show-choose-tries
+    python crushtool.py - --no-mappings < map
+
+A map file is loaded from its binary snapshot, `map.snap`, written next to
+it on the first run: the text is only parsed again once it no longer matches
+the snapshot. stdin is parsed as it is read. Inputs are mapped in chunks and
+the mappings are written out as they are computed, so only the per-device
+counters grow with the map, not with the input range.
+
+maps/reweighted_map.mappings records the placements of maps/reweighted_map,
+whose fractional weights go through `is_out`. Changes to the mapper which
+aren't meant to move anything must keep this quiet:
+
+    for r in 0 1; do
+        python crushtool.py maps/reweighted_map --rule $r --num-rep 3 \\
+            --max-x 1023 --no-statistics --no-utilization
+    done | diff - maps/reweighted_map.mappings
+"""
+
+import argparse
+import sys
+from dataclasses import replace
+from parser import Parser, ParserResult, ParsingError, Rule
+from typing import TextIO
+
+import numpy as np
+import numpy.typing as npt
+
+from affinity import (MAX_PRIMARY_AFFINITY, affinity_array,
+                      apply_primary_affinity_many)
+from balancer import calc_pg_upmaps
+from batch import NONE, BatchResult, apply_plan_many
+from crush import (CRUSH_ITEM_NONE, TUNABLE_PROFILES, MappingStats, Tunables,
+                   compile_rule)
+from hierarchy import FlatHierarchy
+from movement import Movement, compare_maps
+from snapshot import load_map
+from weight_sets import fit_weight_sets, format_choose_args
+
+
+def find_rule(r: ParserResult, rule: str | None) -> Rule:
+    """Looks a rule up by id or by name, defaults to the first one"""
+    if rule is None:
+        if len(r.rules) == 0:
+            raise ParsingError("map has no rules")
+        return r.rules[0]
+    for candidate in r.rules:
+        if rule in (candidate.name, str(candidate.id)):
+            return candidate
+    raise ParsingError(f"no rule `{rule}` in the map")
+
+
+class Report:
+    """Counters of a run, O(devices) memory whatever the number of inputs"""
+
+    def __init__(
+        self,
+        flat: FlatHierarchy,
+        num_rep: int,
+        affinity: npt.NDArray[np.int64] | None = None,
+    ):
+        self.flat = flat
+        self.num_rep = num_rep
+        self.inputs = 0
+        self.errors = 0
+        self.placements = np.zeros(len(flat), dtype=np.int64)
+        # result size -> number of inputs, rules may emit more than num_rep items
+        self.sizes = np.zeros(num_rep + 1, dtype=np.int64)
+        # primary counts by device id, without and with primary affinity
+        self.affinity = affinity
+        if affinity is not None:
+            self.primaries_before = np.zeros(len(affinity), dtype=np.int64)
+            self.primaries_after = np.zeros(len(affinity), dtype=np.int64)
+
+    def add(self, xs: range, res: BatchResult) -> None:
+        nodes = res.nodes[res.nodes >= 0]
+        self.placements += np.bincount(nodes, minlength=len(self.flat))
+        sizes = (res.nodes != NONE).sum(axis=1)
+        if len(res.errors) > 0:
+            sizes[list(res.errors)] = 0
+        counts = np.bincount(sizes, minlength=len(self.sizes))
+        counts[: len(self.sizes)] += self.sizes
+        self.sizes = counts
+        self.inputs += len(res.nodes)
+        self.errors += len(res.errors)
+
+        if self.affinity is not None and res.nodes.shape[1] > 0:
+            osds = res.osds()
+            osds[list(res.errors)] = -1
+            after = apply_primary_affinity_many(xs, osds, self.affinity)
+            for counts, primaries in (
+                (self.primaries_before, osds[:, 0]),
+                (self.primaries_after, after[:, 0]),
+            ):
+                placed = (primaries != -1) & (primaries != CRUSH_ITEM_NONE)
+                primaries = primaries[placed]
+                counts += np.bincount(primaries, minlength=len(counts))
+
+    def write_statistics(self, out: TextIO, rule: Rule) -> None:
+        for size in np.flatnonzero(self.sizes).tolist():
+            out.write(
+                f"rule {rule.id} ({rule.name}) num_rep {self.num_rep} "
+                f"result size == {size}:\t{self.sizes[size]}/{self.inputs}\n"
+            )
+        if self.errors > 0:
+            out.write(f"rule {rule.id} ({rule.name}) errors:\t{self.errors}\n")
+
+    def write_utilization(self, out: TextIO, devices: npt.NDArray[np.int64]) -> None:
+        # expected placements are proportional to the weight of the device
+        weights = np.maximum(self.flat.weights[devices], 0)
+        total = weights.sum()
+        actual = self.placements[devices]
+        expected = actual.sum() * weights / total if total > 0 else weights
+        for d, a, e in zip(
+            self.flat.ids[devices].tolist(), actual.tolist(), expected.tolist()
+        ):
+            ratio = f"{a / e:.3f}" if e > 0 else "-"
+            out.write(
+                f"  device {d}:\t stored : {a}\t expected : {e:.2f}\t ratio : {ratio}\n"
+            )
+
+    def write_primaries(self, out: TextIO, devices: npt.NDArray[np.int64]) -> None:
+        assert self.affinity is not None
+        for d in self.flat.ids[devices].tolist():
+            out.write(
+                f"  device {d}:\t primary affinity : "
+                f"{self.affinity[d] / MAX_PRIMARY_AFFINITY:.3f}\t"
+                f" primary : {self.primaries_before[d]} -> {self.primaries_after[d]}\n"
+            )
+
+
+def write_mappings(out: TextIO, rule: Rule, xs: range, res: BatchResult) -> None:
+    osds = res.osds().tolist()
+    lines: list[str] = []
+    for lane, x in enumerate(xs):
+        if (e := res.errors.get(lane)) is not None:
+            lines.append(f"CRUSH rule {rule.id} x {x} error: {e}\n")
+        else:
+            mapping = ",".join(str(d) for d in osds[lane] if d != -1)
+            lines.append(f"CRUSH rule {rule.id} x {x} [{mapping}]\n")
+    out.write("".join(lines))
+
+
+def write_movement(out: TextIO, m: Movement) -> None:
+    out.write(f"remapped PGs:\t{m.remapped}/{m.pgs}\n")
+    out.write(f"primary changed:\t{m.primary_changed}/{m.pgs}\n")
+    out.write(f"moved replicas:\t{m.moved_replicas}\n")
+    out.write(f"bytes to move:\t{m.bytes_to_move}\n")
+    if m.errors > 0:
+        out.write(f"unmappable PGs:\t{m.errors}\n")
+    for d in sorted(m.gained.keys() | m.lost.keys()):
+        out.write(f"  device {d}:\t +{m.gained[d]}\t -{m.lost[d]}\n")
+
+
+def write_choose_tries(out: TextIO, rule: Rule, stats: MappingStats) -> None:
+    prefix = f"rule {rule.id} ({rule.name})"
+    out.write(f"{prefix} descents:\t{stats.descents}\n")
+    out.write(f"{prefix} collisions:\t{stats.collisions}\n")
+    out.write(f"{prefix} rejected out:\t{stats.rejected_out}\n")
+    out.write(f"{prefix} skipped replicas:\t{stats.skipped}\n")
+    # same layout as Ceph's --show-choose-tries: retries -> replicas
+    for n in range(max(stats.retries, default=-1) + 1):
+        out.write(f"{n:2d}:\t{stats.retries[n]}\n")
+    for x, n in stats.pg_retries.most_common(10):
+        out.write(f"  x {x}:\t{n} retries\n")
+
+
+def load(path: str) -> tuple[ParserResult, FlatHierarchy]:
+    """Loads the map from the file, see `load_map`, `-` streams it from stdin"""
+    if path == "-":
+        r = Parser(sys.stdin).parse()
+        return r, FlatHierarchy.from_parser_result(r)
+    return load_map(path)
+
+
+def run(args: argparse.Namespace, out: TextIO) -> None:
+    r, flat = load(args.map)
+    rule = find_rule(r, args.rule)
+    plan = compile_rule(r.root, rule)
+    if args.tunables is not None:
+        tunables = replace(TUNABLE_PROFILES[args.tunables])
+    else:
+        tunables = Tunables.from_parser_result(r, 50)
+    if args.tries is not None:
+        tunables.choose_total_tries = args.tries
+
+    if args.compare is not None:
+        xs = range(args.min_x, args.max_x + 1)
+        m = compare_maps(
+            r,
+            load(args.compare)[0],
+            rule,
+            xs,
+            args.num_rep,
+            tunables,
+            args.pg_bytes,
+            args.chunk_size,
+        )
+        write_movement(out, m)
+        return
+
+    if args.fit_weight_sets:
+        fit = fit_weight_sets(
+            plan,
+            flat,
+            range(args.min_x, args.max_x + 1),
+            args.num_rep,
+            tunables,
+            args.positions,
+            args.iterations,
+        )
+        # replaces the weight sets in effect, which the fit started from
+        args_id = min(r.choose_args, default=0)
+        out.write(format_choose_args(args_id, fit.choose_args))
+        sys.stderr.write(
+            f"max deviation {fit.deviation_before:.2f} -> "
+            f"{fit.deviation_after:.2f} after {fit.iterations} iterations\n"
+        )
+        return
+
+    affinity = affinity_array(r.devices) if args.primaries else None
+    report = Report(flat, args.num_rep, affinity)
+    stats = MappingStats() if args.choose_tries else None
+    if args.balance:
+        # the balancer needs every mapping at once
+        xs = range(args.min_x, args.max_x + 1)
+        res = apply_plan_many(xs, plan, flat, args.num_rep, tunables, stats=stats)
+        balanced = calc_pg_upmaps(plan, flat, list(xs), res.nodes, args.max_deviation)
+        for x, pairs in sorted(balanced.items.items()):
+            flattened = ",".join(f"{src},{dst}" for src, dst in pairs)
+            out.write(f"pg_upmap_items {x} [{flattened}]\n")
+        out.write(
+            f"moved {balanced.moves} replicas, max deviation "
+            f"{balanced.deviation_before:.2f} -> {balanced.deviation_after:.2f}\n"
+        )
+        report.add(xs, BatchResult(flat, balanced.nodes, res.errors))
+        args.mappings = False
+
+    for lo in range(args.min_x, args.max_x + 1, args.chunk_size):
+        if args.balance:
+            break
+        xs = range(lo, min(lo + args.chunk_size, args.max_x + 1))
+        res = apply_plan_many(xs, plan, flat, args.num_rep, tunables, stats=stats)
+        report.add(xs, res)
+        if args.mappings:
+            write_mappings(out, rule, xs, res)
+
+    if args.statistics:
+        report.write_statistics(out, rule)
+    devices = flat.devices_under([flat.node_of(t) for t in plan.targets()])
+    if args.utilization:
+        report.write_utilization(out, devices)
+    if args.primaries:
+        report.write_primaries(out, devices)
+    if stats is not None:
+        write_choose_tries(out, rule, stats)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument(
+        "map", help="text map, as accepted by the websocket server, - for stdin"
+    )
+    p.add_argument("--rule", help="rule id or name, the first rule by default")
+    p.add_argument("--num-rep", type=int, default=3)
+    p.add_argument("--min-x", type=int, default=0)
+    p.add_argument("--max-x", type=int, default=1023)
+    p.add_argument(
+        "--tries",
+        type=int,
+        help="choose_total_tries, the map's or 50 by default",
+    )
+    p.add_argument(
+        "--tunables",
+        choices=TUNABLE_PROFILES,
+        help="tunables profile to use instead of the map's tunables",
+    )
+    p.add_argument("--chunk-size", type=int, default=65536)
+    p.add_argument(
+        "--no-mappings", dest="mappings", action="store_false", help="counters only"
+    )
+    p.add_argument("--no-statistics", dest="statistics", action="store_false")
+    p.add_argument("--no-utilization", dest="utilization", action="store_false")
+    p.add_argument(
+        "--compare",
+        metavar="NEW_MAP",
+        help="report the data movement from `map` to NEW_MAP instead",
+    )
+    p.add_argument(
+        "--pg-bytes", type=int, default=0, help="PG size for the bytes to move"
+    )
+    p.add_argument(
+        "--balance",
+        action="store_true",
+        help="compute pg_upmap_items and report the balanced utilization",
+    )
+    p.add_argument("--max-deviation", type=float, default=1.0)
+    p.add_argument(
+        "--show-primaries",
+        dest="primaries",
+        action="store_true",
+        help="primary counts per device without and with primary affinity",
+    )
+    p.add_argument(
+        "--fit-weight-sets",
+        action="store_true",
+        help="print a choose_args block fitted to equalize utilization",
+    )
+    p.add_argument(
+        "--show-choose-tries",
+        dest="choose_tries",
+        action="store_true",
+        help="descents, collisions and retries of the mapping",
+    )
+    p.add_argument("--positions", type=int, default=1, help="weight set positions")
+    p.add_argument("--iterations", type=int, default=20)
+    args = p.parse_args()
+
+    if args.max_x < args.min_x:
+        p.error("--max-x must not be less than --min-x")
+    if args.chunk_size <= 0:
+        p.error("--chunk-size must be positive")
+
+    try:
+        run(args, sys.stdout)
+    except (OSError, ParsingError) as e:
+        raise SystemExit(f"crushtool: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,31 @@
+import os
 from ctypes import c_uint32, c_uint64
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
 from crush_ln_table import RH_LH_tbl, LL_tbl
 
 CRUSH_HASH_SEED = 1315423911
+M32 = 0xFFFFFFFF
 
 def crush_hashmix(a: int, b: int, c: int) -> tuple[int, int, int]: 
-    a = a-b;  a = a-c;  a = c_uint32(a ^ (c>>13)).value;
-    b = b-c;  b = b-a;  b = c_uint32(b ^ (a<<+8)).value; 
-    c = c-a;  c = c-b;  c = c_uint32(c ^ (b>>13)).value;
-    a = a-b;  a = a-c;  a = c_uint32(a ^ (c>>12)).value;
-    b = b-c;  b = b-a;  b = c_uint32(b ^ (a<<16)).value;
-    c = c-a;  c = c-b;  c = c_uint32(c ^ (b>>+5)).value; 
-    a = a-b;  a = a-c;  a = c_uint32(a ^ (c>>+3)).value; 
-    b = b-c;  b = b-a;  b = c_uint32(b ^ (a<<10)).value;
-    c = c-a;  c = c-b;  c = c_uint32(c ^ (b>>15)).value;
+    a = (a-b-c) & M32;  a = a ^ (c>>13);
+    b = (b-c-a) & M32;  b = (b ^ (a<<8)) & M32;
+    c = (c-a-b) & M32;  c = c ^ (b>>13);
+    a = (a-b-c) & M32;  a = a ^ (c>>12);
+    b = (b-c-a) & M32;  b = (b ^ (a<<16)) & M32;
+    c = (c-a-b) & M32;  c = c ^ (b>>5);
+    a = (a-b-c) & M32;  a = a ^ (c>>3);
+    b = (b-c-a) & M32;  b = (b ^ (a<<10)) & M32;
+    c = (c-a-b) & M32;  c = c ^ (b>>15);
     return a, b, c
     
 
 def crush_hash_2(a: int, b: int) -> int:
-    h = c_uint32(CRUSH_HASH_SEED ^ a ^ b).value
+    a &= M32; b &= M32
+    h = CRUSH_HASH_SEED ^ a ^ b
     x = 231232;
     y = 1232;
     a, b, h = crush_hashmix(a, b, h);
@@ -27,7 +35,8 @@ def crush_hash_2(a: int, b: int) -> int:
 
 
 def crush_hash32_3(a: int, b: int, c: int) -> int:
-    h = c_uint32(CRUSH_HASH_SEED ^ a ^ b ^ c).value
+    a &= M32; b &= M32; c &= M32
+    h = CRUSH_HASH_SEED ^ a ^ b ^ c
     x = 231232;
     y = 1232;
     a, b, h = crush_hashmix(a, b, h);
@@ -38,6 +47,88 @@ def crush_hash32_3(a: int, b: int, c: int) -> int:
     return h
 
 
+def crush_hash32_4(a: int, b: int, c: int, d: int) -> int:
+    a &= M32; b &= M32; c &= M32; d &= M32
+    h = CRUSH_HASH_SEED ^ a ^ b ^ c ^ d
+    x = 231232;
+    y = 1232;
+    a, b, h = crush_hashmix(a, b, h);
+    c, d, h = crush_hashmix(c, d, h);
+    a, x, h = crush_hashmix(a, x, h);
+    y, b, h = crush_hashmix(y, b, h);
+    c, x, h = crush_hashmix(c, x, h);
+    y, d, h = crush_hashmix(y, d, h);
+    return h
+
+
+# Batch versions of the hashes above: uint32 arrays wrap around on their own,
+# so the mix is the same sequence of operations without any masking
+
+U32Array = npt.NDArray[np.uint32]
+
+
+def _as_u32(a: npt.ArrayLike) -> U32Array:
+    # negative ids are reinterpreted as __u32, like in Ceph
+    return np.asarray(a).astype(np.uint32)
+
+
+def crush_hashmix_many(
+    a: U32Array, b: U32Array, c: U32Array
+) -> tuple[U32Array, U32Array, U32Array]:
+    a = a-b-c;  a = a ^ (c>>13);
+    b = b-c-a;  b = b ^ (a<<8);
+    c = c-a-b;  c = c ^ (b>>13);
+    a = a-b-c;  a = a ^ (c>>12);
+    b = b-c-a;  b = b ^ (a<<16);
+    c = c-a-b;  c = c ^ (b>>5);
+    a = a-b-c;  a = a ^ (c>>3);
+    b = b-c-a;  b = b ^ (a<<10);
+    c = c-a-b;  c = c ^ (b>>15);
+    return a, b, c
+
+
+def crush_hash_2_many(a: npt.ArrayLike, b: npt.ArrayLike) -> U32Array:
+    a, b = np.broadcast_arrays(_as_u32(a), _as_u32(b))
+    h = np.uint32(CRUSH_HASH_SEED) ^ a ^ b
+    x = np.full_like(h, 231232)
+    y = np.full_like(h, 1232)
+    a, b, h = crush_hashmix_many(a, b, h)
+    x, a, h = crush_hashmix_many(x, a, h)
+    b, y, h = crush_hashmix_many(b, y, h)
+    return h
+
+
+def crush_hash32_3_many(
+    a: npt.ArrayLike, b: npt.ArrayLike, c: npt.ArrayLike
+) -> U32Array:
+    a, b, c = np.broadcast_arrays(_as_u32(a), _as_u32(b), _as_u32(c))
+    h = np.uint32(CRUSH_HASH_SEED) ^ a ^ b ^ c
+    x = np.full_like(h, 231232)
+    y = np.full_like(h, 1232)
+    a, b, h = crush_hashmix_many(a, b, h)
+    c, x, h = crush_hashmix_many(c, x, h)
+    y, a, h = crush_hashmix_many(y, a, h)
+    b, x, h = crush_hashmix_many(b, x, h)
+    y, c, h = crush_hashmix_many(y, c, h)
+    return h
+
+
+def crush_hash32_4_many(
+    a: npt.ArrayLike, b: npt.ArrayLike, c: npt.ArrayLike, d: npt.ArrayLike
+) -> U32Array:
+    a, b, c, d = np.broadcast_arrays(_as_u32(a), _as_u32(b), _as_u32(c), _as_u32(d))
+    h = np.uint32(CRUSH_HASH_SEED) ^ a ^ b ^ c ^ d
+    x = np.full_like(h, 231232)
+    y = np.full_like(h, 1232)
+    a, b, h = crush_hashmix_many(a, b, h)
+    c, d, h = crush_hashmix_many(c, d, h)
+    a, x, h = crush_hashmix_many(a, x, h)
+    y, b, h = crush_hashmix_many(y, b, h)
+    c, x, h = crush_hashmix_many(c, x, h)
+    y, d, h = crush_hashmix_many(y, d, h)
+    return h
+
+
 def __builtin_clz(x: int) -> int:
     c = 0
     for i in range(31, -1, -1):
@@ -57,7 +148,7 @@ def crush_ln(xin: int) -> int:
 
     # // figure out number of bits we need to shift and
     # // do it in one step instead of iteratively
-    if (x & 0x18000 == 0):
+    if (x & 0x18000) == 0:
         bits = __builtin_clz(x & 0x1FFFF) - 16;
         x <<= bits;
         iexpon = 15 - bits;
@@ -85,3 +176,61 @@ def crush_ln(xin: int) -> int:
     result += lh;
 
     return result;
+
+
+# crush_ln only ever sees `hash & 0xffff`, so every possible result fits in a
+# 65536 entries table. It is computed once and cached next to crush_ln_table.py
+
+CRUSH_LN_CACHE = Path(__file__).with_name("crush_ln_table.npy")
+
+_ln_table: npt.NDArray[np.int64] | None = None
+_ln_list: list[int] | None = None
+
+
+def _build_ln_table() -> npt.NDArray[np.int64]:
+    return np.array([crush_ln(u) for u in range(0x10000)], dtype=np.int64)
+
+
+def _load_ln_table() -> npt.NDArray[np.int64]:
+    try:
+        t = np.load(CRUSH_LN_CACHE, mmap_mode="r")
+        # a stale cache from an older crush_ln must not be picked up
+        if (
+            t.shape == (0x10000,)
+            and t.dtype == np.int64
+            and all(int(t[u]) == crush_ln(u) for u in (0, 1, 0xFF, 0x7FFF, 0xFFFF))
+        ):
+            return t
+    except (OSError, ValueError):
+        pass
+
+    t = _build_ln_table()
+    tmp = CRUSH_LN_CACHE.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            np.save(f, t)
+        os.replace(tmp, CRUSH_LN_CACHE)
+    except OSError:
+        # read-only checkout: keep the table in memory only
+        tmp.unlink(missing_ok=True)
+    return t
+
+
+def crush_ln_table() -> npt.NDArray[np.int64]:
+    global _ln_table
+    if _ln_table is None:
+        _ln_table = _load_ln_table()
+    return _ln_table
+
+
+def crush_ln_lookup(u: int) -> int:
+    """O(1) equivalent of `crush_ln(u)` for 16-bit `u`"""
+    global _ln_list
+    if _ln_list is None:
+        _ln_list = crush_ln_table().tolist()
+    return _ln_list[u]
+
+
+def crush_ln_many(u: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    """Vectorized `crush_ln` for arrays of 16-bit values"""
+    return crush_ln_table()[np.asarray(u)]
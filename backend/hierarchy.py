@@ -0,0 +1,166 @@
+from dataclasses import dataclass, field
+from parser import AlgType, Bucket, BucketT, Device, ParserResult
+
+import numpy as np
+import numpy.typing as npt
+
+NO_PARENT = -1
+
+
+@dataclass
+class FlatHierarchy:
+    """
+    Struct-of-arrays form of a CRUSH hierarchy.
+
+    Nodes are numbered in BFS order starting from the root and the roots of its
+    device class shadow trees (see `build_shadow_trees`). Children of node `i`
+    are `children[child_offsets[i] : child_offsets[i + 1]]` (CSR layout), which
+    is an empty range for devices.
+    """
+
+    # item id: device id (>= 0) or bucket id (< 0)
+    ids: npt.NDArray[np.int32]
+    # position in BucketT.BUCKETS_HIERARCHY, 0 for devices
+    types: npt.NDArray[np.int8]
+    # AlgType value, 0 for devices
+    algs: npt.NDArray[np.int8]
+    weights: npt.NDArray[np.float64]
+    # 16.16 fixed point weights, see `to_fixed_weight`
+    fixed_weights: npt.NDArray[np.int64]
+    parents: npt.NDArray[np.int32]
+    child_offsets: npt.NDArray[np.int32]
+    children: npt.NDArray[np.int32]
+
+    nodes: list[Bucket | Device]
+    # item id -> node index, devices resolve to their node in the main tree
+    index_of: dict[int, int]
+    _node_of: dict[int, int]  # id() of a tree node -> node index
+
+    # bucket node index -> (positions, children) 16.16 fixed point weight set,
+    # see `Bucket.weight_set`
+    weight_sets: dict[int, npt.NDArray[np.int64]] = field(default_factory=dict)
+    # node indices of the root and of its shadow trees
+    roots: list[int] = field(default_factory=lambda: [0])
+
+    @classmethod
+    def from_root(cls, root: Bucket, attach: bool = True) -> "FlatHierarchy":
+        """
+        `attach` makes the devices keep the weights of this copy in sync, leave
+        it off for throwaway copies of a hierarchy something else is mapping
+        """
+        nodes: list[Bucket | Device] = [root, *root._shadows.values()]
+        parents: list[int] = [NO_PARENT] * len(nodes)
+        child_offsets: list[int] = []
+        children: list[int] = []
+
+        i = 0
+        while i < len(nodes):
+            child_offsets.append(len(children))
+            if isinstance(b := nodes[i], Bucket):
+                for c in b.children:
+                    children.append(len(nodes))
+                    nodes.append(c)
+                    parents.append(i)
+            i += 1
+        child_offsets.append(len(children))
+
+        hierarchy = BucketT.BUCKETS_HIERARCHY  # type: ignore
+        ids: list[int] = []
+        types: list[int] = []
+        algs: list[int] = []
+        for n in nodes:
+            match n:
+                case Bucket() as b:
+                    ids.append(b.id)
+                    types.append(hierarchy[b.type])
+                    algs.append(b.alg.value)
+                case Device() as d:
+                    ids.append(d.info.id)
+                    types.append(hierarchy["osd"])
+                    algs.append(0)
+
+        index_of: dict[int, int] = {}
+        for i, item in enumerate(ids):
+            index_of.setdefault(item, i)
+
+        weights = np.array([n.weight for n in nodes], dtype=np.float64)
+        flat = cls(
+            ids=np.array(ids, dtype=np.int32),
+            types=np.array(types, dtype=np.int8),
+            algs=np.array(algs, dtype=np.int8),
+            weights=weights,
+            fixed_weights=(weights * 0x10000).astype(np.int64),
+            parents=np.array(parents, dtype=np.int32),
+            child_offsets=np.array(child_offsets, dtype=np.int32),
+            children=np.array(children, dtype=np.int32),
+            nodes=nodes,
+            index_of=index_of,
+            _node_of={id(n): i for i, n in enumerate(nodes)},
+            roots=list(range(1 + len(root._shadows))),
+        )
+        flat.sync_weight_sets()
+        if not attach:
+            return flat
+        for i, n in enumerate(nodes):
+            if isinstance(n, Device):
+                n._flat = flat  # type: ignore (FlatHierarchy is a friend of Device)
+                n._flat_index = i  # type: ignore
+        return flat
+
+    @classmethod
+    def from_parser_result(
+        cls, r: ParserResult, attach: bool = True
+    ) -> "FlatHierarchy":
+        return cls.from_root(r.root, attach)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def node_of(self, item: Bucket | Device) -> int:
+        return self._node_of[id(item)]
+
+    def is_device(self, i: int) -> bool:
+        return self.ids[i] >= 0
+
+    def alg(self, i: int) -> AlgType:
+        return AlgType(self.algs[i])
+
+    def children_of(self, i: int) -> npt.NDArray[np.int32]:
+        return self.children[self.child_offsets[i] : self.child_offsets[i + 1]]
+
+    def child_weights(self, i: int) -> npt.NDArray[np.int64]:
+        return self.fixed_weights[self.children_of(i)]
+
+    def devices_under(self, roots: list[int]) -> npt.NDArray[np.int64]:
+        """Sorted node indices of the devices in the subtrees of `roots`"""
+        q = list(roots)
+        seen: set[int] = set()
+        res: list[int] = []
+        while len(q) > 0:
+            i = q.pop()
+            if i in seen:
+                continue
+            seen.add(i)
+            if self.is_device(i):
+                res.append(i)
+            else:
+                q.extend(self.children_of(i).tolist())
+        return np.array(sorted(res), dtype=np.int64)
+
+    def sync_weight_sets(self) -> None:
+        """Copies the weight sets of the buckets, after `apply_choose_args`"""
+        self.weight_sets = {}
+        for i, n in enumerate(self.nodes):
+            if isinstance(n, Bucket) and n.weight_set is not None:
+                self.weight_sets[i] = (
+                    np.array(n.weight_set, dtype=np.float64) * 0x10000
+                ).astype(np.int64)
+
+    # O(HierarchyHeight): called by Device.update_weight once the tree itself
+    # has been updated, so both representations always hold the same floats
+    def _sync_weights(self, i: int) -> None:
+        while i != NO_PARENT:
+            w = self.nodes[i].weight
+            self.weights[i] = w
+            self.fixed_weights[i] = int(w * 0x10000)
+            i = int(self.parents[i])
@@ -1,13 +1,22 @@
+import argparse
 import heapq
 import json
-import sys
+import os
 from collections import defaultdict
 from dataclasses import dataclass
-from parser import (Device, OutOfClusterWeight, Parser, ParserResult,
-                    ParsingError)
-from typing import Any, Generator
-
-from crush import Tunables
+from parser import (Device, JSONBucket, MapDiff, OutOfClusterWeight, Parser,
+                    ParserResult, ParsingError)
+from typing import Any
+
+from affinity import apply_primary_affinity, primary_report
+from balancer import apply_upmap_items, calc_pg_upmaps
+from batch import apply_plan_many
+from crush import MappingStats, RulePlan, Tunables, compile_rule
+from hierarchy import FlatHierarchy
+from map_cache import MapCache
+from movement import compare_maps
+from parallel import ParallelMapper
+from placement_cache import PlacementCache
 from mapping import (AliveIntervals, Context, DeviceID_T, EMainloopInteration,
                      EOSDFailed, EOSDRecovered, EPeeringFailure, EPeeringStart,
                      EPeeringSuccess, EPrimaryRecvAcknowledged,
@@ -18,14 +27,6 @@ from mapping import (AliveIntervals, Context, DeviceID_T, EMainloopInteration,
                      PoolParams, WeightT, get_iteration_event)
 
 
-def read_from_stdin_til_eof() -> Generator[str, None, None]:
-    while True:
-        s = sys.stdin.readline()
-        if s == "":
-            return
-        yield s
-
-
 def initQueue(): ...
 
 
@@ -67,6 +68,19 @@ import asyncio
 
 from websockets.asyncio.server import serve
 
+# maps sent by every connection, parsed once per text and kept as snapshots
+# across restarts in the user's cache directory
+map_cache = MapCache(
+    snapshots=os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "ceph-visualization",
+        "snapshots",
+    )
+)
+# processes mapping the PGs of every connection, see `ParallelMapper`. 0 maps
+# them in the server's process
+workers = 0
+
 
 @dataclass
 class SetupResult:
@@ -74,10 +88,30 @@ class SetupResult:
     pgs: PGList
     context: Context
     devices: dict[DeviceID_T, Device]
+    cache: PlacementCache
+    pool: PoolParams
+    # weights devices get back when they recover, see `get_iteration_event`
+    init_weights: dict[DeviceID_T, WeightT]
+
+
+def pool_params(plan: RulePlan, pgs: PGList, k: int, m: int) -> PoolParams:
+    """3 replicas, or `k` + `m` shards for erasure coded rules"""
+    if plan.rule.type == "erasure":
+        return PoolParams(size=k + m, min_size=k + 1, pgs=pgs, k=k, m=m)
+    return PoolParams(size=3, min_size=2, pgs=pgs)
 
 
 # info: a lot of params can be made params to this function
-def setup_event_queue(r: ParserResult, death_proba: float) -> SetupResult:
+def setup_event_queue(
+    r: ParserResult,
+    plan: RulePlan,
+    flat: FlatHierarchy,
+    death_proba: float,
+    pg_count: int = 8,
+    workers: int = 0,
+    k: int = 2,
+    m: int = 1,
+) -> SetupResult:
     context = Context(
         current_time=0,
         timestep=20,
@@ -90,25 +124,34 @@ def setup_event_queue(r: ParserResult, death_proba: float) -> SetupResult:
         death_proba=death_proba,
     )
 
-    init_weights: dict[DeviceID_T, WeightT] = {}
-    for d in r.devices.values():
-        init_weights[d.info.id] = d.weight
-        context.alive_intervals_per_device[d.info.id] = AliveIntervals(
-            d.info.id, context.death_proba, d.weight
+    init_weights: dict[DeviceID_T, WeightT] = dict(r.weights)
+    for d_id, w in init_weights.items():
+        context.alive_intervals_per_device[d_id] = AliveIntervals(
+            d_id, context.death_proba, w
         )
 
-    pgs = PGList(c=[PlacementGroup(PlacementGroupID_T(i)) for i in range(8)])
+    pgs = PGList(c=[PlacementGroup(PlacementGroupID_T(i)) for i in range(pg_count)])
 
-    cfg = PoolParams(size=3, min_size=2, pgs=pgs)
-    tunables = Tunables(5)
-
-    loop: Event = get_iteration_event(
-        r.root, r.devices, init_weights, r.rules[0], tunables, cfg, context
+    cfg = pool_params(plan, pgs, k, m)
+    tunables = Tunables.from_parser_result(r, 5)
+    # large pools can be remapped on a process pool
+    mapper = (
+        ParallelMapper(plan, flat, cfg.size, tunables, workers) if workers > 0 else None
     )
-    return SetupResult([loop], pgs, context, r.devices)
+    cache = PlacementCache(plan, flat, cfg.size, tunables, mapper)
+
+    loop: Event = get_iteration_event(cache, r.devices, init_weights, cfg, context)
+    return SetupResult([loop], pgs, context, r.devices, cache, cfg, init_weights)
 
 
-def adjust_mapping(r: ParserResult, setup: SetupResult):
+def adjust_mapping(
+    r: ParserResult,
+    plan: RulePlan,
+    flat: FlatHierarchy,
+    setup: SetupResult,
+    k: int = 2,
+    m: int = 1,
+):
     context = Context(
         current_time=setup.context.current_time,
         timestep=setup.context.timestep,
@@ -122,19 +165,31 @@ def adjust_mapping(r: ParserResult, setup: SetupResult):
     )
 
     new_loop: list[Event] = []
-    init_weights: dict[DeviceID_T, WeightT] = {}
+    # the tree may be the one the simulation ran on, see `Parser.previous`
+    init_weights: dict[DeviceID_T, WeightT] = dict(r.weights)
     for d in r.devices.values():
-        init_weights[d.info.id] = d.weight
         context.alive_intervals_per_device[d.info.id] = AliveIntervals(
-            d.info.id, context.death_proba, d.weight
+            d.info.id, context.death_proba, init_weights[d.info.id]
         )
 
         oldDevice = setup.devices.get(d.info.id)
         if oldDevice is not None and oldDevice.weight == OutOfClusterWeight:
             d.update_weight(OutOfClusterWeight)
 
-    tunables = Tunables(5)
-    cfg = PoolParams(size=3, min_size=2, pgs=setup.pgs)
+    tunables = Tunables.from_parser_result(r, 5)
+    cfg = pool_params(plan, setup.pgs, k, m)
+    # upmaps to devices which left the map are ignored by `map_pg`
+    cfg.pg_upmap_items = setup.pool.pg_upmap_items
+    # the remaps of the new rule are recovered by the same pool
+    cfg.recovery = setup.pool.recovery
+    mapper = None
+    if (old_mapper := setup.cache.mapper) is not None:
+        old_mapper.close()
+        mapper = ParallelMapper(plan, flat, cfg.size, tunables, old_mapper.workers)
+    cache = PlacementCache(plan, flat, cfg.size, tunables, mapper)
+    # counters are per rule: start over with the new one
+    if setup.cache.mapping_stats is not None:
+        cache.mapping_stats = MappingStats()
 
     new_peerings: set[int] = set()
     failing_ops: set[int] = set()
@@ -145,11 +200,9 @@ def adjust_mapping(r: ParserResult, setup: SetupResult):
                 heapq.heappush(
                     new_loop,
                     get_iteration_event(
-                        r.root,
+                        cache,
                         r.devices,
                         init_weights,
-                        r.rules[0],
-                        tunables,
                         cfg,
                         context,
                     ),
@@ -241,86 +294,245 @@ def adjust_mapping(r: ParserResult, setup: SetupResult):
                 if e.tag.osd not in r.devices:
                     continue
                 heapq.heappush(new_loop, e)
-    return SetupResult(new_loop, setup.pgs, context, r.devices)
+    return SetupResult(
+        new_loop, setup.pgs, context, r.devices, cache, cfg, init_weights
+    )
+
+
+def reweight_mapping(setup: SetupResult, diff: MapDiff) -> None:
+    """
+    Takes up the new weights of a map whose structure didn't change. The
+    parser already reweighted the devices the simulation runs on, the
+    placement cache only remaps the PGs the changes can move.
+    """
+    for d_id, (_, w) in diff.reweighted_devices.items():
+        setup.init_weights[d_id] = w
+        setup.context.alive_intervals_per_device[d_id].init_weight = w
 
 
 async def handler(websocket):  # type: ignore
     setup: SetupResult | None = None
-    async for message in websocket:  # type: ignore
-        m = json.loads(message)  # type: ignore
-        message_type = m["type"]
-        if message_type ==  "rule":
-            try:
-                r = Parser(m["message"]).parse()
-            except ParsingError as e:
+    current: ParserResult | None = None
+    # of `current`, the hierarchy is sent back on every map change
+    hierarchy: JSONBucket | None = None
+    try:
+        async for message in websocket:  # type: ignore
+            m = json.loads(message)  # type: ignore
+            message_type = m["type"]
+            if message_type ==  "rule":
+                try:
+                    c = map_cache.get(m["message"])
+                    r = c.result
+                    plan = c.plan()
+                except ParsingError as e:
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {
+                                "type": "hierarchy_fail",
+                                "data": str(e),
+                            }
+                        )
+                    )
+                else:
+                    hierarchy = r.root.to_json()
+                    current = r
+                    if setup is not None and setup.cache.mapper is not None:
+                        setup.cache.mapper.close()
+                    setup = setup_event_queue(
+                        r,
+                        plan,
+                        c.flat,
+                        setup.context.death_proba if setup is not None else 0.25,
+                        # pools of thousands of PGs are mapped in batches
+                        pg_count=m.get("pg_count", 8),
+                        workers=workers,
+                        # erasure coded profile, for `type erasure` rules
+                        k=m.get("k", 2),
+                        m=m.get("m", 1),
+                    )
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {
+                                "type": "hierarchy_success",
+                                "data": hierarchy,
+                            }
+                        )
+                    )
+            elif message_type ==  "adjust_rule":
+                assert setup is not None and current is not None
+                k = m.get("k", setup.pool.k or 2)
+                shards = m.get("m", setup.pool.m or 1)
+                try:
+                    parser = Parser(m["message"], current)
+                    r = parser.parse()
+                    assert parser.diff is not None
+                    # only weights changed: `current`'s tree was reweighted in place
+                    reweighted = r.root is current.root and (
+                        setup.pool.k == 0 or (setup.pool.k, setup.pool.m) == (k, shards)
+                    )
+                    if not reweighted:
+                        plan = compile_rule(r.root, r.rules[0])
+                except ParsingError as e:
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {
+                                "type": "hierarchy_fail",
+                                "data": str(e),
+                            }
+                        )
+                    )
+                else:
+                    current = r
+                    if reweighted:
+                        reweight_mapping(setup, parser.diff)
+                    else:
+                        hierarchy = r.root.to_json()
+                        setup = adjust_mapping(
+                            r,
+                            plan,
+                            FlatHierarchy.from_parser_result(r),
+                            setup,
+                            k=k,
+                            m=shards,
+                        )
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {
+                                "type": "adjust_hierarchy_success",
+                                "data": hierarchy,
+                                "timestamp": setup.context.current_time,
+                            }
+                        )
+                    )
+            elif message_type == "compare_rule":
+                # data movement `adjust_rule` with the same map would cause
+                assert setup is not None and current is not None
+                try:
+                    r = Parser(m["message"]).parse()
+                    movement = compare_maps(
+                        current,
+                        r,
+                        setup.cache.plan.rule,
+                        [pg.id for pg in setup.pgs],
+                        setup.cache.pool_replicas,
+                        setup.cache.tunables,
+                        m.get("pg_bytes", 0),
+                    )
+                except ParsingError as e:
+                    await websocket.send(  # type: ignore
+                        json.dumps({"type": "compare_fail", "data": str(e)})
+                    )
+                else:
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {"type": "compare_success", "data": movement.to_json()}
+                        )
+                    )
+            elif message_type == "step":
+                assert setup is not None
+                time, messages = process_pending_events(setup.queue)
                 await websocket.send(  # type: ignore
                     json.dumps(
-                        {
-                            "type": "hierarchy_fail",
-                            "data": str(e),
-                        }
+                        {"type": "events", "timestamp": time, "events": messages}
                     )
                 )
-            else:
-                hierarchy = r.root.to_json()
-                setup = setup_event_queue(
-                    r, setup.context.death_proba if setup is not None else 0.25
+            elif message_type == "insert":
+                assert setup is not None
+                for event in setup.pgs.object_insert(setup.context, m["id"]):
+                    heapq.heappush(setup.queue, event)
+            elif message_type == "mode":
+                assert setup is not None
+                new_mode = m["new_mode"]
+                if new_mode == "randomized":
+                    setup.context.update_death_proba(0.25)
+                else:
+                    setup.context.update_death_proba(0)
+            elif message_type == "balance":
+                assert setup is not None
+                cache = setup.cache
+                pgs = [pg.id for pg in setup.pgs]
+                raw = apply_plan_many(
+                    pgs, cache.plan, cache.flat, cache.pool_replicas, cache.tunables
                 )
+                res = calc_pg_upmaps(
+                    cache.plan,
+                    cache.flat,
+                    pgs,
+                    raw.nodes,
+                    m.get("max_deviation", 1),
+                    items=setup.pool.pg_upmap_items,
+                )
+                setup.pool.pg_upmap_items = res.items
                 await websocket.send(  # type: ignore
-                    json.dumps(
-                        {
-                            "type": "hierarchy_success",
-                            "data": hierarchy,
-                        }
-                    )
+                    json.dumps({"type": "balance", "data": res.to_json()})
                 )
-        elif message_type ==  "adjust_rule":
-            assert setup is not None
-            try:
-                r = Parser(m["message"]).parse()
-            except ParsingError as e:
+            elif message_type == "primary_affinity":
+                assert setup is not None
+                device = setup.devices.get(m["osd"])
+                value = m["value"]
+                if device is None or not 0 <= value <= 1:
+                    await websocket.send(  # type: ignore
+                        json.dumps(
+                            {
+                                "type": "primary_affinity_fail",
+                                "data": f"can't set primary affinity of osd.{m['osd']} "
+                                f"to {value}",
+                            }
+                        )
+                    )
+                    continue
+                device.set_primary_affinity(value)
+
+                # the PGs pick their new primary on the next iteration
+                pgs = list(setup.pool.pgs)
+                upmaps = setup.pool.pg_upmap_items
+                before = [
+                    apply_upmap_items(res, upmaps.get(pg.id, []), setup.devices)
+                    for pg, res in zip(pgs, setup.cache.map([pg.id for pg in pgs]))
+                ]
+                after = [
+                    apply_primary_affinity(pg.id, res, setup.devices)
+                    for pg, res in zip(pgs, before)
+                ]
                 await websocket.send(  # type: ignore
                     json.dumps(
                         {
-                            "type": "hierarchy_fail",
-                            "data": str(e),
+                            "type": "primary_affinity",
+                            "data": primary_report(before, after, setup.devices),
                         }
                     )
                 )
-            else:
-                hierarchy = r.root.to_json()
-                setup = adjust_mapping(r, setup)
+            elif message_type == "collect_stats":
+                assert setup is not None
+                # retry counters cost a little on every remap, they are opt-in
+                setup.cache.mapping_stats = MappingStats() if m["enabled"] else None
+            elif message_type == "stats":
+                assert setup is not None
+                mapping_stats = setup.cache.mapping_stats
                 await websocket.send(  # type: ignore
                     json.dumps(
                         {
-                            "type": "adjust_hierarchy_success",
-                            "data": hierarchy,
-                            "timestamp": setup.context.current_time,
+                            "type": "stats",
+                            "data": {
+                                "placement_cache": setup.cache.stats(),
+                                "map_cache": map_cache.stats(),
+                                "recovery": setup.pool.recovery.to_json(),
+                                "mapping": (
+                                    mapping_stats.to_json()
+                                    if mapping_stats is not None
+                                    else None
+                                ),
+                            },
                         }
                     )
                 )
-        elif message_type == "step":
-            assert setup is not None
-            time, messages = process_pending_events(setup.queue)
-            await websocket.send(  # type: ignore
-                json.dumps(
-                    {"type": "events", "timestamp": time, "events": messages}
-                )
-            )
-        elif message_type == "insert":
-            assert setup is not None
-            for event in setup.pgs.object_insert(setup.context, m["id"]):
-                heapq.heappush(setup.queue, event)
-        elif message_type == "mode":
-            assert setup is not None
-            new_mode = m["new_mode"]
-            if new_mode == "randomized":
-                setup.context.update_death_proba(0.25)
             else:
-                setup.context.update_death_proba(0)
-        else:
-            print(m)
-        # await websocket.send(message)
+                print(m)
+            # await websocket.send(message)
+    finally:
+        # the worker processes outlive the connection otherwise
+        if setup is not None and setup.cache.mapper is not None:
+            setup.cache.mapper.close()
 
 
 async def main():
@@ -329,4 +541,15 @@ async def main():
 
 
 if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="websocket server of the simulator")
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="processes mapping the PGs of large pools, none by default",
+    )
+    args = p.parse_args()
+    if args.workers < 0:
+        p.error("--workers must not be negative")
+    workers = args.workers
     asyncio.run(main())
@@ -0,0 +1,256 @@
+"""
+Parsed maps shared by every connection of the server.
+
+A map is parsed, flattened and its rules compiled once per text, whatever
+the number of sessions loading it. The cached tree is never mapped on: the
+simulation changes weights, so each session gets its own copy of the objects
+which carry them. Everything else is shared with the cached map: device
+infos, rules, choose_args, and the structure arrays of the flat hierarchy,
+which are only ever read.
+
+Given a directory, the cache also writes the snapshot of every map it parses
+there, see `snapshot`: a map which was already sent before the server was
+restarted isn't parsed again. The directory is capped like the cache, the
+least recently used snapshots are deleted first.
+"""
+
+import contextlib
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from parser import (Bucket, Device, DeviceID_T, Parser, ParserResult,
+                    paused_gc)
+from typing import TypedDict
+
+from crush import (PlanTake, RuleCompilationError, RulePlan, build_name_index,
+                   compile_rule)
+from hierarchy import NO_PARENT, FlatHierarchy
+from snapshot import read_snapshot, save_snapshot
+
+# memory taken by a node of a parsed map: its tree object, its entries in
+# the indexes and its share of the flat arrays (measured with tracemalloc)
+NODE_BYTES = 512
+
+
+class JSONMapCacheStats(TypedDict):
+    hits: int
+    misses: int
+    # misses loaded from a snapshot
+    snapshot_loads: int
+    evictions: int
+    maps: int
+    bytes: int
+
+
+@dataclass
+class MapCopy:
+    result: ParserResult
+    # attached to the devices of `result`, see `FlatHierarchy.from_root`
+    flat: FlatHierarchy
+    # compiled rules of `result`, or why they don't compile
+    plans: list[RulePlan | str]
+
+    def plan(self, rule: int = 0) -> RulePlan:
+        if isinstance(p := self.plans[rule], str):
+            raise RuleCompilationError(p)
+        return p
+
+
+@dataclass
+class _CachedMap:
+    result: ParserResult
+    flat: FlatHierarchy
+    plans: list[RulePlan | str]
+    size: int
+
+    def copy(self) -> MapCopy:
+        with paused_gc():
+            return self._copy()
+
+    def _copy(self) -> MapCopy:
+        """
+        New tree objects in the order of `flat`, which is the BFS order of
+        the original: every node is created after its parent
+        """
+        flat = self.flat
+        parents = flat.parents.tolist()
+        nodes: list[Bucket | Device] = []
+        for n, p in zip(flat.nodes, parents):
+            parent: Bucket | None = nodes[p] if p != NO_PARENT else None  # type: ignore
+            if isinstance(n, Device):
+                assert parent is not None
+                c: Bucket | Device = Device(n.info, n._weight, parent)
+            else:
+                c = Bucket(n.name, n.type, n.id, n.alg, n.weight)
+                c._parent = parent
+                c.weight_set = n.weight_set
+            if parent is not None:
+                parent.children.append(c)
+            nodes.append(c)
+
+        copy = FlatHierarchy(
+            ids=flat.ids,
+            types=flat.types,
+            algs=flat.algs,
+            weights=flat.weights.copy(),
+            fixed_weights=flat.fixed_weights.copy(),
+            parents=flat.parents,
+            child_offsets=flat.child_offsets,
+            children=flat.children,
+            nodes=nodes,
+            index_of=flat.index_of,
+            _node_of={id(n): i for i, n in enumerate(nodes)},
+            weight_sets=dict(flat.weight_sets),
+            roots=flat.roots,
+        )
+
+        node_of = flat._node_of  # type: ignore (FlatHierarchy is a friend)
+
+        def node(item: Bucket | Device) -> Bucket | Device:
+            return nodes[node_of[id(item)]]
+
+        for i, n in enumerate(flat.nodes):
+            c = nodes[i]
+            if isinstance(n, Device):
+                c._flat = copy  # type: ignore (FlatHierarchy is a friend of Device)
+                c._flat_index = i  # type: ignore
+                if n._shadow is not None:
+                    c._shadow = node(n._shadow)  # type: ignore
+            elif len(n._shadows) > 0:
+                c._shadows = {k: node(s) for k, s in n._shadows.items()}  # type: ignore
+
+        r = self.result
+        devices: dict[DeviceID_T, Device] = {
+            d: nodes[flat.index_of[d]] for d in r.devices  # type: ignore
+        }
+        result = ParserResult(
+            nodes[0],  # type: ignore
+            devices,
+            r.rules,
+            r.choose_args,
+            r.tunables,
+            r.weights,
+            {name: node(b) for name, b in r.buckets.items()},  # type: ignore
+            r.blocks,
+        )
+
+        plans: list[RulePlan | str] = []
+        index: dict[str, Bucket | Device] | None = None
+        for p in self.plans:
+            if isinstance(p, str):
+                plans.append(p)
+                continue
+            # the plans of a map share their index
+            if index is None:
+                index = {name: node(item) for name, item in p.index.items()}
+            steps = [
+                PlanTake(node(s.target)) if isinstance(s, PlanTake) else s
+                for s in p.steps
+            ]
+            plans.append(RulePlan(p.rule, result.root, index, steps))
+        return MapCopy(result, copy, plans)
+
+
+class MapCache:
+    """
+    Parsed maps by SHA-256 of their text, the least recently used ones are
+    dropped once they take more than `max_bytes`
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1 << 30,
+        snapshots: str | None = None,
+        max_snapshot_bytes: int = 1 << 30,
+    ):
+        self.max_bytes = max_bytes
+        # directory of the snapshots of the maps, which holds no more than
+        # `max_snapshot_bytes` of them
+        self.snapshots = snapshots
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.hits = 0
+        self.misses = 0
+        self.snapshot_loads = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._maps: OrderedDict[bytes, _CachedMap] = OrderedDict()
+
+    def stats(self) -> JSONMapCacheStats:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "snapshot_loads": self.snapshot_loads,
+            "evictions": self.evictions,
+            "maps": len(self._maps),
+            "bytes": self.bytes,
+        }
+
+    def get(self, text: str) -> MapCopy:
+        """A copy of what `text` parses into, raises `ParsingError` like `Parser`"""
+        key = hashlib.sha256(text.encode()).digest()
+        if (cached := self._maps.get(key)) is not None:
+            self.hits += 1
+            self._maps.move_to_end(key)
+            return cached.copy()
+
+        self.misses += 1
+        cached = self._load(text, key)
+        if cached.size <= self.max_bytes:
+            self._maps[key] = cached
+            self.bytes += cached.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._maps.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+        return cached.copy()
+
+    def _load(self, text: str, digest: bytes) -> _CachedMap:
+        if self.snapshots is None:
+            return _compile(*_parse(text))
+        path = os.path.join(self.snapshots, digest.hex() + ".snap")
+        if (res := read_snapshot(path, digest, attach=False)) is not None:
+            self.snapshot_loads += 1
+            # the modification time orders the snapshots by last use
+            with contextlib.suppress(OSError):
+                os.utime(path)
+            return _compile(*res)
+        r, flat = _parse(text)
+        save_snapshot(r, flat, digest, path)
+        self._prune_snapshots()
+        return _compile(r, flat)
+
+    def _prune_snapshots(self) -> None:
+        """Deletes the least recently used snapshots past `max_snapshot_bytes`"""
+        assert self.snapshots is not None
+        snapshots: list[tuple[float, int, str]] = []
+        try:
+            with os.scandir(self.snapshots) as entries:
+                for e in entries:
+                    if e.name.endswith(".snap") and e.is_file():
+                        st = e.stat()
+                        snapshots.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            return
+        total = 0
+        for _, size, path in sorted(snapshots, reverse=True):
+            total += size
+            if total > self.max_snapshot_bytes:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+
+def _parse(text: str) -> tuple[ParserResult, FlatHierarchy]:
+    r = Parser(text).parse()
+    return r, FlatHierarchy.from_parser_result(r, attach=False)
+
+
+def _compile(r: ParserResult, flat: FlatHierarchy) -> _CachedMap:
+    index = build_name_index(r.root)
+    plans: list[RulePlan | str] = []
+    for rule in r.rules:
+        try:
+            plans.append(compile_rule(r.root, rule, index))
+        except RuleCompilationError as e:
+            plans.append(str(e))
+    return _CachedMap(r, flat, plans, len(flat) * NODE_BYTES)
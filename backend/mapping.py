@@ -9,14 +9,16 @@ from typing import (
     Iterable,
     Iterator,
     NewType,
+    TypedDict,
 )
-from crush import Tunables, apply
+from affinity import apply_primary_affinity
+from balancer import PGUpmapItems, apply_upmap_items
+from crush import CRUSH_ITEM_NONE
+from placement_cache import PlacementCache
 from parser import (
-    Bucket,
     OutOfClusterWeight,
     Device,
     DeviceID_T,
-    Rule,
     WeightT,
 )
 
@@ -319,6 +321,8 @@ class PlacementGroup:
     )
     last_sync: int = field(init=False, default=-1)
     _maps: list[list[DeviceID_T]] = field(init=False, default_factory=list)
+    # mapping the last map comes from, erasure coded holes included
+    positions: list[DeviceID_T] = field(init=False, default_factory=list)
     is_peering: bool = field(init=False, default=False)
 
     def start_peering(self):
@@ -494,29 +498,89 @@ class PGList:
         return self._col[h].updelsert(context, obj_id, Operation.OpType.DELETE)
 
 
+class JSONRecoveryTraffic(TypedDict):
+    remaps: int
+    shards: int
+    read: float
+    written: float
+
+
+@dataclass
+class RecoveryTraffic:
+    """
+    Data a pool reads and writes to bring remapped PGs up to date, in units
+    of a whole PG. A replica is read from a peer and written in full, an
+    erasure coded PG reads k shards (a whole PG) once to rebuild all of its
+    missing shards, of 1 / k PG each.
+    """
+
+    # peered remaps, the initial placement of a PG excluded
+    remaps: int = 0
+    # replicas or shards rebuilt on a device which didn't hold them
+    shards: int = 0
+    read: float = 0
+    written: float = 0
+
+    def add(self, old: list[DeviceID_T], new: list[DeviceID_T], k: int) -> None:
+        """`k` is the number of data shards, 0 for replicated pools"""
+        if k == 0:
+            moved = sum(1 for d in new if d not in old)
+            self.read += moved
+            self.written += moved
+        else:
+            # a shard is tied to its position
+            moved = sum(
+                1
+                for i, d in enumerate(new)
+                if d != CRUSH_ITEM_NONE and (i >= len(old) or old[i] != d)
+            )
+            self.read += 1 if moved > 0 else 0
+            self.written += moved / k
+        self.remaps += 1
+        self.shards += moved
+
+    def to_json(self) -> JSONRecoveryTraffic:
+        return {
+            "remaps": self.remaps,
+            "shards": self.shards,
+            "read": self.read,
+            "written": self.written,
+        }
+
+
 @dataclass
 class PoolParams:
-    size: int  # replicas count
+    size: int  # replicas count, k + m for erasure coded pools
     min_size: int  # minimum allowed number of replicas returned by CRUSH
     pgs: Iterable[PlacementGroup]
     # pg_count: int  # placement groups' count
+    # overrides of the CRUSH mapping, see `balancer.calc_pg_upmaps`
+    pg_upmap_items: PGUpmapItems = field(default_factory=dict)
+    # data and coding shards of erasure coded pools, k is 0 for replicated ones
+    k: int = 0
+    m: int = 0
+    recovery: RecoveryTraffic = field(default_factory=RecoveryTraffic)
 
 
 def map_pg(
-    root: Bucket,
+    cache: PlacementCache,
     devices: dict[DeviceID_T, Device],
-    rule: Rule,
-    tunables: Tunables,
     cfg: PoolParams,
     context: Context,
 ) -> list[Event]:
     events: list[Event] = []
-    for pg in cfg.pgs:
-        res = apply(pg.id, root, rule, cfg.size, tunables)
-        assert not isinstance(res, str), res
-        res = [d.info.id for d in res]
-        if pg.is_peering or (len(pg.maps) > 0 and pg.maps[-1] == res):
+    pgs = list(cfg.pgs)
+    for pg, res in zip(pgs, cache.map([pg.id for pg in pgs])):
+        if (items := cfg.pg_upmap_items.get(pg.id)) is not None:
+            res = apply_upmap_items(res, items, devices)
+        if cfg.k == 0:
+            # Ceph doesn't reorder erasure coded shards, their position is
+            # their shard id
+            res = apply_primary_affinity(pg.id, res, devices)
+        if pg.is_peering or (len(pg.maps) > 0 and pg.positions == res):
             continue
+        # devices holding the PG, without the holes
+        acting = [d for d in res if d != CRUSH_ITEM_NONE]
 
         prev_maps, success = pg.peer(context)
         devices_used_in_peering: set[DeviceID_T] = set()
@@ -531,7 +595,7 @@ def map_pg(
                     peering_id,
                     pg.id,
                     list(devices_used_in_peering),
-                    res,
+                    acting,
                 ),
                 context.current_time,
                 (lambda x: lambda: x.start_peering())(pg),
@@ -539,12 +603,17 @@ def map_pg(
         )
 
         def success_wrapper(
-            inner_pg: PlacementGroup, ds: list[DeviceID_T]
+            inner_pg: PlacementGroup,
+            ds: list[DeviceID_T],
+            positions: list[DeviceID_T],
         ) -> Callable[[], None]:
             def inner():
                 inner_pg.stop_peering()
                 inner_pg.last_sync = len(inner_pg.maps)
+                if len(inner_pg.maps) > 0:
+                    cfg.recovery.add(inner_pg.positions, positions, cfg.k)
                 inner_pg.maps.append(ds)
+                inner_pg.positions = positions
 
             return inner
 
@@ -559,7 +628,7 @@ def map_pg(
                 Event(
                     EPeeringSuccess(peering_id, pg.id),
                     context.current_time + context.timestep * context.timesteps_to_peer,
-                    success_wrapper(pg, res),
+                    success_wrapper(pg, acting, res),
                 )
             )
         else:
@@ -574,11 +643,9 @@ def map_pg(
 
 
 def get_iteration_event(
-    root: Bucket,
+    cache: PlacementCache,
     devices: dict[DeviceID_T, Device],
     init_weights: dict[DeviceID_T, WeightT],
-    rule: Rule,
-    tunables: Tunables,
     cfg: PoolParams,
     context: Context,
 ) -> Event:
@@ -604,13 +671,11 @@ def get_iteration_event(
                         Event(EOSDFailed(d_id), context.current_time)
                     )
 
-        tag.callback_results.extend(map_pg(root, devices, rule, tunables, cfg, context))
+        tag.callback_results.extend(map_pg(cache, devices, cfg, context))
 
         context.do_time_step()
         tag.callback_results.append(
-            get_iteration_event(
-                root, devices, init_weights, rule, tunables, cfg, context
-            )
+            get_iteration_event(cache, devices, init_weights, cfg, context)
         )
 
     return Event(tag, context.current_time, callback)
@@ -0,0 +1,126 @@
+"""
+Data movement between two maps: which PGs a map change remaps and how many
+replicas every device gains or loses, computed with the batch mapper.
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from parser import DeviceID_T, ParserResult, ParsingError, Rule
+from typing import TypedDict
+
+import numpy as np
+
+from batch import IntArray, apply_plan_many
+from crush import CRUSH_ITEM_NONE, Tunables, compile_rule
+from hierarchy import FlatHierarchy
+
+
+class JSONMovement(TypedDict):
+    pgs: int
+    remapped: int
+    primary_changed: int
+    moved_replicas: int
+    bytes_to_move: int
+    errors: int
+    gained: dict[str, int]
+    lost: dict[str, int]
+
+
+@dataclass
+class Movement:
+    pg_bytes: int
+    pgs: int = 0
+    # PGs whose acting set (order included) differs
+    remapped: int = 0
+    primary_changed: int = 0
+    # replicas which have to be copied to a device which didn't hold them
+    moved_replicas: int = 0
+    # PGs either map failed to place, they are left out of the other counters
+    errors: int = 0
+    gained: Counter[DeviceID_T] = field(default_factory=Counter)
+    lost: Counter[DeviceID_T] = field(default_factory=Counter)
+    # erasure coded mappings: a shard is tied to its position, a device
+    # holding another shard of the PG doesn't save the copy
+    positional: bool = False
+
+    @property
+    def bytes_to_move(self) -> int:
+        return self.moved_replicas * self.pg_bytes
+
+    def add(self, old: IntArray, new: IntArray) -> None:
+        """
+        Accounts for a block of -1 padded device id rows, holes
+        (`CRUSH_ITEM_NONE`) are neither gained nor lost
+        """
+        width = max(old.shape[1], new.shape[1])
+        old = np.pad(old, ((0, 0), (0, width - old.shape[1])), constant_values=-1)
+        new = np.pad(new, ((0, 0), (0, width - new.shape[1])), constant_values=-1)
+
+        self.pgs += len(old)
+        self.remapped += int((old != new).any(axis=1).sum())
+        if width > 0:
+            self.primary_changed += int((old[:, 0] != new[:, 0]).sum())
+
+        if self.positional:
+            in_old = in_new = new == old
+        else:
+            in_old = (new[:, :, None] == old[:, None, :]).any(axis=2)
+            in_new = (old[:, :, None] == new[:, None, :]).any(axis=2)
+        gained = new[(new != -1) & (new != CRUSH_ITEM_NONE) & ~in_old]
+        lost = old[(old != -1) & (old != CRUSH_ITEM_NONE) & ~in_new]
+        self.moved_replicas += len(gained)
+        for counter, ids in ((self.gained, gained), (self.lost, lost)):
+            devices, counts = np.unique(ids, return_counts=True)
+            counter.update(dict(zip(devices.tolist(), counts.tolist())))
+
+    def to_json(self) -> JSONMovement:
+        return {
+            "pgs": self.pgs,
+            "remapped": self.remapped,
+            "primary_changed": self.primary_changed,
+            "moved_replicas": self.moved_replicas,
+            "bytes_to_move": self.bytes_to_move,
+            "errors": self.errors,
+            "gained": {str(d): c for d, c in sorted(self.gained.items())},
+            "lost": {str(d): c for d, c in sorted(self.lost.items())},
+        }
+
+
+def _same_rule(r: ParserResult, rule: Rule) -> Rule:
+    for candidate in r.rules:
+        if candidate.id == rule.id:
+            return candidate
+    raise ParsingError(f"new map has no rule with id {rule.id}")
+
+
+def compare_maps(
+    old: ParserResult,
+    new: ParserResult,
+    rule: Rule,
+    xs: range | list[int],
+    pool_replicas: int,
+    tunables: Tunables,
+    pg_bytes: int = 0,
+    chunk_size: int = 65536,
+) -> Movement:
+    """
+    Maps `xs` through `rule` of the old map and the rule with the same id of
+    the new one
+    """
+    old_plan = compile_rule(old.root, rule)
+    new_plan = compile_rule(new.root, _same_rule(new, rule))
+    # `old` may be the map a simulation is running on: its devices must keep
+    # syncing the simulation's flat hierarchy
+    old_flat = FlatHierarchy.from_parser_result(old, attach=False)
+    new_flat = FlatHierarchy.from_parser_result(new, attach=False)
+
+    res = Movement(pg_bytes, positional=rule.type == "erasure")
+    for lo in range(0, len(xs), chunk_size):
+        chunk = xs[lo : lo + chunk_size]
+        a = apply_plan_many(chunk, old_plan, old_flat, pool_replicas, tunables)
+        b = apply_plan_many(chunk, new_plan, new_flat, pool_replicas, tunables)
+        ok = np.ones(len(chunk), dtype=np.bool_)
+        ok[list(a.errors.keys() | b.errors.keys())] = False
+        res.errors += len(chunk) - int(ok.sum())
+        res.add(a.osds()[ok], b.osds()[ok])
+    return res
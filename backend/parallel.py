@@ -0,0 +1,169 @@
+"""
+Process pool counterpart of `batch.apply_plan_many` for large pools.
+
+The hierarchy and the rule are shipped to every worker once, when the pool
+starts. Afterwards a task only carries the map epoch, the weights which differ
+from the shipped map and the inputs to map. Every worker rebuilds the flat
+hierarchy in the same BFS order, so node indices are interchangeable between
+processes and the merged result is identical to the serial one.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from parser import Bucket, Device, Rule, WeightT
+
+import numpy as np
+
+from batch import NONE, BatchResult, IntArray, Trace, apply_plan_many
+from crush import MappingStats, RulePlan, Tunables, compile_rule
+from hierarchy import FlatHierarchy
+
+# node index -> weight, for the nodes whose weight differs from the shipped map
+WeightOverlay = dict[int, float]
+
+
+@dataclass
+class _WorkerState:
+    plan: RulePlan
+    flat: FlatHierarchy
+    base: list[float]
+    epoch: int
+    overlay: WeightOverlay
+
+
+_state: _WorkerState | None = None
+
+
+def _set_node_weight(flat: FlatHierarchy, i: int, w: float) -> None:
+    # bucket weights are shipped as well: rebuilding them from device deltas
+    # could round differently and change straw2 draws
+    match flat.nodes[i]:
+        case Bucket() as b:
+            b.weight = WeightT(w)
+        case Device() as d:
+            d._weight = WeightT(w)  # type: ignore
+    # the epoch isn't bumped: list and tree weights must be rebuilt
+    if (parent := flat.nodes[i]._parent) is not None:
+        parent._alg_weights = None  # type: ignore
+    flat.weights[i] = w
+    flat.fixed_weights[i] = int(w * 0x10000)
+
+
+def _init_worker(root: Bucket, rule: Rule, base: list[float]) -> None:
+    global _state
+    flat = FlatHierarchy.from_root(root)
+    # workers are started lazily, the map may have changed since `base` was taken
+    for i in np.flatnonzero(flat.weights != base).tolist():
+        _set_node_weight(flat, i, base[i])
+    _state = _WorkerState(compile_rule(root, rule), flat, base, -1, {})
+
+
+def _map_chunk(
+    epoch: int,
+    overlay: WeightOverlay,
+    xs: range | IntArray,
+    pool_replicas: int,
+    tunables: Tunables,
+    with_trace: bool,
+    with_stats: bool = False,
+) -> tuple[IntArray, dict[int, str], Trace | None, MappingStats | None]:
+    state = _state
+    assert state is not None, "worker was not initialized"
+
+    if state.epoch != epoch:
+        for i in state.overlay.keys() | overlay.keys():
+            _set_node_weight(state.flat, i, overlay.get(i, state.base[i]))
+        state.epoch = epoch
+        state.overlay = overlay
+
+    trace = Trace() if with_trace else None
+    stats = MappingStats() if with_stats else None
+    res = apply_plan_many(
+        xs, state.plan, state.flat, pool_replicas, tunables, trace, stats
+    )
+    return res.nodes, res.errors, trace, stats
+
+
+class ParallelMapper:
+    def __init__(
+        self,
+        plan: RulePlan,
+        flat: FlatHierarchy,
+        pool_replicas: int,
+        tunables: Tunables,
+        workers: int | None = None,
+        chunk_size: int = 8192,
+    ):
+        self.plan = plan
+        self.flat = flat
+        self.pool_replicas = pool_replicas
+        self.tunables = tunables
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        self._base = flat.weights.copy()
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(plan.root, plan.rule, self._base.tolist()),
+        )
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self) -> "ParallelMapper":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _overlay(self) -> WeightOverlay:
+        changed = np.flatnonzero(self.flat.weights != self._base)
+        return {i: float(self.flat.weights[i]) for i in changed.tolist()}
+
+    def map(
+        self,
+        xs: range | IntArray,
+        trace: Trace | None = None,
+        stats: MappingStats | None = None,
+    ) -> BatchResult:
+        epoch = self.plan.root.epoch
+        overlay = self._overlay()
+        chunks = [
+            xs[lo : lo + self.chunk_size] for lo in range(0, len(xs), self.chunk_size)
+        ]
+        futures = [
+            self._pool.submit(
+                _map_chunk,
+                epoch,
+                overlay,
+                chunk,
+                self.pool_replicas,
+                self.tunables,
+                trace is not None,
+                stats is not None,
+            )
+            for chunk in chunks
+        ]
+
+        nodes: list[IntArray] = []
+        errors: dict[int, str] = {}
+        offset = 0
+        for chunk, f in zip(chunks, futures):
+            chunk_nodes, chunk_errors, chunk_trace, chunk_stats = f.result()
+            nodes.append(chunk_nodes)
+            errors.update({offset + lane: e for lane, e in chunk_errors.items()})
+            if trace is not None and chunk_trace is not None:
+                trace.entered.extend(chunk_trace.entered)
+                trace.selected.extend(chunk_trace.selected)
+            if stats is not None and chunk_stats is not None:
+                stats.merge(chunk_stats)
+            offset += len(chunk)
+
+        width = max((n.shape[1] for n in nodes), default=0)
+        merged = np.full((offset, width), NONE, dtype=np.int64)
+        row = 0
+        for n in nodes:
+            merged[row : row + len(n), : n.shape[1]] = n
+            row += len(n)
+        return BatchResult(self.flat, merged, errors)
@@ -1,5 +1,7 @@
 """
-device: device osd.{INT} [class STR] 
+tunable: tunable <name> <value>
+
+device: device osd.{INT} [class STR] [primary_affinity FLOAT]
 
 bucket: [bucket-type] [bucket-name] (STR) {
     "id" [a unique negative numeric ID] 
@@ -18,15 +20,35 @@ rule: "rule" <rulename> {
     step [choose|chooseleaf] [firstn|indep] <N> <bucket-type>
     step emit
 }
+
+choose_args: "choose_args" <id> {
+    {
+        bucket_id <bucket ID>
+        weight_set [
+            [ <weight of every item of the bucket> ]
+            ...
+        ]
+    }
+    ...
+}
 """
 
+import gc
+import hashlib
+import io
 import platform
-import random
-from dataclasses import dataclass, field
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
 from enum import Enum, StrEnum, auto
-from hashlib import sha256
-from typing import (Any, Generator, Literal, NewType, NoReturn, Optional, Self,
-                    TypedDict)
+from itertools import accumulate, count
+from typing import (TYPE_CHECKING, Any, Generator, Iterable, Iterator, Literal,
+                    NewType, NoReturn, Optional, Self, TypedDict)
+
+from hashing import crush_hash32_3, crush_hash32_4, crush_ln_lookup
+
+if TYPE_CHECKING:
+    from hierarchy import FlatHierarchy
 
 assert platform.system() == "Linux", "Systems other than GNU/Linux are NOT supported"
 
@@ -81,10 +103,51 @@ OutOfClusterWeight = WeightT(0.0)
 UnitWeight = WeightT(1.0)
 
 
+def to_fixed_weight(w: WeightT) -> int:
+    """Converts a weight to the 16.16 fixed point representation used by Ceph"""
+    return int(w * 0x10000)
+
+
+S64_MIN = -(1 << 63)
+
+# `Bucket._perm_n` when only the first entry of the permutation is known
+_PERM_FIRST_ONLY = -1
+
+
+# Ceph's tree buckets number their nodes in order: item i is the leaf 2i + 1
+# and the children of a node of height h (trailing zeros) are n -+ 2^(h - 1)
+def _tree_height(n: int) -> int:
+    return (n & -n).bit_length() - 1
+
+
+def _tree_parent(n: int) -> int:
+    h = _tree_height(n)
+    return n - (1 << h) if n & (1 << (h + 1)) else n + (1 << h)
+
+
+def tree_node_weights(weights: list[int]) -> list[int]:
+    """Node weights of a tree bucket, inner nodes hold the sum of their subtree"""
+    depth = max(len(weights) - 1, 0).bit_length() + 1
+    nodes = [0] * (1 << depth)
+    for i, w in enumerate(weights):
+        n = 2 * i + 1
+        nodes[n] += w
+        for _ in range(1, depth):
+            n = _tree_parent(n)
+            nodes[n] += w
+    return nodes
+
+
+DefaultPrimaryAffinity = 1.0
+
+
 @dataclass
 class DeviceInfo:
     id: DeviceID_T
     device_class: str | None = None
+    # probability of accepting the primary role CRUSH gives the device, see
+    # `affinity.apply_primary_affinity`
+    primary_affinity: float = DefaultPrimaryAffinity
 
 
 class JSONOSD(TypedDict):
@@ -97,6 +160,16 @@ class Device:
     info: DeviceInfo
     _weight: WeightT
     _parent: "Bucket" = field(repr=False, compare=False)
+    # array-backed copy of the hierarchy this device is a part of, if any
+    _flat: "FlatHierarchy | None" = field(
+        init=False, default=None, repr=False, compare=False
+    )
+    _flat_index: int = field(init=False, default=-1, repr=False, compare=False)
+    # copy of this device in the shadow tree of its class, see
+    # `build_shadow_trees`
+    _shadow: "Device | None" = field(
+        init=False, default=None, repr=False, compare=False
+    )
 
     def to_json(self) -> JSONOSD:
         return {"name": f"osd.{self.info.id}", "type": "osd"}
@@ -108,6 +181,16 @@ class Device:
     def update_weight(self, w: WeightT) -> None:
         self._parent._update_weight(w - self._weight)  # type: ignore (Device is a friend of the Bucket class)
         self._weight = w
+        if self._flat is not None:
+            self._flat._sync_weights(self._flat_index)  # type: ignore (Device is a friend of FlatHierarchy)
+        if self._shadow is not None:
+            self._shadow.update_weight(w)
+
+    def set_primary_affinity(self, a: float) -> None:
+        # the info may be shared with other copies of the map, see `map_cache`
+        self.info = replace(self.info, primary_affinity=a)
+        if self._shadow is not None:
+            self._shadow.info = self.info
 
 
 class AlgType(Enum):
@@ -132,7 +215,31 @@ class Bucket:
     # hash: int = 0 # will NOT have hash field
     weight: WeightT = OutOfClusterWeight
     children: list[Self | Device] = field(default_factory=list)
-    _parent: Self | None = field(init=False, default=None, repr=False)
+    _parent: Self | None = field(init=False, default=None, repr=False, compare=False)
+    # bumped on every weight change in the subtree, the root's epoch is the
+    # epoch of the whole map
+    epoch: int = field(init=False, default=0, repr=False, compare=False)
+    # choose_args weights of the children, one vector per result position.
+    # Only straw2 draws use them, the bucket's own weight is left untouched
+    weight_set: list[list[WeightT]] | None = field(
+        init=False, default=None, repr=False, compare=False
+    )
+    # device class -> copy of this bucket in the class' shadow tree
+    _shadows: dict[str, Self] = field(
+        init=False, default_factory=dict, repr=False, compare=False
+    )
+    # Ceph's crush_work_bucket: permutation of the children for the input
+    # `_perm_x`, valid up to `_perm_n`, see `_choose_uniform`
+    _perm_x: int | None = field(init=False, default=None, repr=False, compare=False)
+    _perm_n: int = field(init=False, default=0, repr=False, compare=False)
+    _perm: list[int] = field(
+        init=False, default_factory=list, repr=False, compare=False
+    )
+    # (epoch, children weights, list: their running sums | tree: node weights),
+    # see `fixed_weights`
+    _alg_weights: tuple[int, list[int], list[int]] | None = field(
+        init=False, default=None, repr=False, compare=False
+    )
 
     def to_json(self) -> JSONBucket:
         children_json = [child.to_json() for child in self.children]
@@ -141,10 +248,12 @@ class Bucket:
     # O(HierarchyHeight) weight update
     def _update_weight(self, delta: float) -> None:
         self.weight += delta  # type: ignore
+        self.epoch += 1
         if self._parent is not None:
             self._parent._update_weight(delta)
 
     def update_subtree_weights(self) -> None:
+        self._alg_weights = None
         self.weight = OutOfClusterWeight
         for c in self.children:
             match c:
@@ -154,28 +263,119 @@ class Bucket:
                 case Device() as d:
                     self.weight += d.weight
 
-    def choose(self, x: int, r: int) -> Self | Device:
+    def choose(self, x: int, r: int, position: int = 0) -> Self | Device:
+        """`position` is the slot of the result being chosen, see `weight_set`"""
         match self.alg:
             case AlgType.uniform:
                 return self._choose_uniform(x, r)
+            case AlgType.list:
+                return self._choose_list(x, r)
+            case AlgType.tree:
+                return self._choose_tree(x, r)
             case AlgType.straw2:
-                return self._choose_straw2(x, r)
-            case _:
-                raise NotImplementedError()
-
-    def _choose_uniform(self, pg_id: int, failed_attempts: int) -> Self | Device:
-        s = int(sha256(str((pg_id, abs(self.id), failed_attempts)).encode()).hexdigest(), 16)
-        return self.children[s % len(self.children)]
-
-    def _choose_straw2(self, pg_id: int, failed_attempts: int) -> Self | Device:
-        ws = [c.weight for c in self.children]
-        if sum(ws) == 0:
-            ws[0] = UnitWeight
-
-        h = int(sha256(str((pg_id, abs(self.id), failed_attempts)).encode()).hexdigest(), 16)
-        random.seed(h)
-        res = random.choices(self.children, ws)
-        return res[0]
+                return self._choose_straw2(x, r, position)
+
+    def fixed_weights(self) -> tuple[list[int], list[int]]:
+        """
+        16.16 weights of the children and what list (running sums) and tree
+        (node weights) buckets draw against, cached until the subtree's next
+        weight change
+        """
+        if self._alg_weights is None or self._alg_weights[0] != self.epoch:
+            weights = [to_fixed_weight(c.weight) for c in self.children]
+            if self.alg == AlgType.tree:
+                derived = tree_node_weights(weights)
+            else:
+                derived = list(accumulate(weights))
+            self._alg_weights = (self.epoch, weights, derived)
+        return self._alg_weights[1], self._alg_weights[2]
+
+    # Ceph's bucket_perm_choose: r picks a position in a permutation of the
+    # children seeded by x. The permutation is computed lazily up to the
+    # position needed and kept for the retries of the same input.
+    def _choose_uniform(self, x: int, r: int) -> Self | Device:
+        size = len(self.children)
+        pr = r % size
+        if self._perm_x != x or self._perm_n == 0:
+            self._perm_x = x
+            if pr == 0:
+                # the common r = 0 case only needs the first swap
+                s = crush_hash32_3(x, self.id, 0) % size
+                self._perm = [s]
+                self._perm_n = _PERM_FIRST_ONLY
+                return self.children[s]
+            self._perm = list(range(size))
+            self._perm_n = 0
+        elif self._perm_n == _PERM_FIRST_ONLY:
+            s = self._perm[0]
+            self._perm = list(range(size))
+            self._perm[0], self._perm[s] = s, 0
+            self._perm_n = 1
+
+        perm = self._perm
+        while self._perm_n <= pr:
+            p = self._perm_n
+            # no point in swapping the last entry
+            if p < size - 1:
+                i = crush_hash32_3(x, self.id, p) % (size - p)
+                if i:
+                    perm[p], perm[p + i] = perm[p + i], perm[p]
+            self._perm_n += 1
+        return self.children[perm[pr]]
+
+    # Ceph's bucket_list_choose: walking from the last child, each one is
+    # taken with probability weight / (sum of the weights up to it), so
+    # items appended to the bucket only take placements from the others
+    def _choose_list(self, x: int, r: int) -> Self | Device:
+        weights, sums = self.fixed_weights()
+        for i in range(len(self.children) - 1, -1, -1):
+            c = self.children[i]
+            c_id = c.id if isinstance(c, Bucket) else c.info.id
+            w = crush_hash32_4(x, c_id, r, self.id) & 0xFFFF
+            if (w * sums[i]) >> 16 < weights[i]:
+                return c
+        return self.children[0]
+
+    # Ceph's bucket_tree_choose: descends from the root node, going left
+    # with probability weight(left) / weight(node), O(log n) draws
+    def _choose_tree(self, x: int, r: int) -> Self | Device:
+        _, nodes = self.fixed_weights()
+        n = len(nodes) >> 1
+        # every draw is 0 and goes right, possibly to a padding leaf: like
+        # list and straw2 buckets, fall back to the first child
+        if nodes[n] == 0:
+            return self.children[0]
+        while n & 1 == 0:
+            half = 1 << (_tree_height(n) - 1)
+            t = (crush_hash32_4(x, n, r, self.id) * nodes[n]) >> 32
+            n = n - half if t < nodes[n - half] else n + half
+        return self.children[n >> 1]
+
+    # Ceph's bucket_straw2_choose: every child draws ln(hash) / weight,
+    # the highest draw wins
+    def _choose_straw2(self, x: int, r: int, position: int = 0) -> Self | Device:
+        if self.weight_set is None:
+            weights = [c.weight for c in self.children]
+        else:
+            # positions past the last vector reuse it
+            weights = self.weight_set[min(position, len(self.weight_set) - 1)]
+
+        high = 0
+        high_draw = S64_MIN
+        for i, c in enumerate(self.children):
+            w = to_fixed_weight(weights[i])
+            if w == 0:
+                draw = S64_MIN
+            else:
+                c_id = c.id if isinstance(c, Bucket) else c.info.id
+                u = crush_hash32_3(x, c_id & 0xFFFFFFFF, r) & 0xFFFF
+                ln = crush_ln_lookup(u) - 0x1000000000000
+                # ln <= 0: div64_s64 truncates toward zero
+                draw = -(-ln // w)
+            if i == 0 or draw > high_draw:
+                high = i
+                high_draw = draw
+        return self.children[high]
 
 
 @dataclass
@@ -189,6 +389,8 @@ class StepChoose:
     is_chooseleaf: bool
     n: int
     bucket_type: BucketT | Literal["osd"]
+    # `indep`: results keep their position, failures leave holes
+    is_indep: bool = False
 
 
 @dataclass
@@ -208,30 +410,450 @@ class Rule:
 
     rules: list[StepT]
 
+    type: Literal["replicated", "erasure"] = "replicated"
+
+
+# bucket id -> weight set, see `Bucket.weight_set`
+ChooseArgs = dict[BucketID_T, list[list[WeightT]]]
+
+
+def apply_choose_args(root: Bucket, args: ChooseArgs) -> None:
+    """
+    Replaces the weight sets of every bucket of the hierarchy and of its
+    shadow trees
+    """
+    q = [root, *root._shadows.values()]
+    while len(q) > 0:
+        b = q.pop()
+        b.weight_set = args.get(b.id)
+        q.extend(c for c in b.children if isinstance(c, Bucket))
+
+
+def _clone_class(
+    b: Bucket, device_class: str, ids: Iterator[int], res: list[Bucket]
+) -> Bucket | None:
+    # shadow buckets and original devices, in the order of `b.children`
+    kept: list[Bucket | Device] = []
+    for c in b.children:
+        match c:
+            case Bucket():
+                if (shadow := _clone_class(c, device_class, ids, res)) is not None:
+                    kept.append(shadow)
+            case Device() if c.info.device_class == device_class:
+                kept.append(c)
+    if len(kept) == 0:
+        return None
+
+    shadow = Bucket(f"{b.name}~{device_class}", b.type, BucketID_T(next(ids)), b.alg)
+    for c in kept:
+        match c:
+            case Bucket():
+                c._parent = shadow
+                shadow.children.append(c)
+            case Device():
+                c._shadow = Device(c.info, c.weight, shadow)
+                shadow.children.append(c._shadow)
+    b._shadows[device_class] = shadow
+    res.append(shadow)
+    return shadow
+
+
+def build_shadow_trees(root: Bucket) -> list[Bucket]:
+    """
+    Ceph's device class shadow trees: for every device class, a copy of the
+    hierarchy holding only the devices of that class, with subtree weights
+    recomputed. Buckets without such devices are left out, the others are
+    named `{bucket}~{class}` and get ids below the ones in use.
+
+    `Bucket._shadows` resolves a bucket to its copies and devices update
+    their copy along with themselves. Returns every shadow bucket.
+    """
+    classes: set[str] = set()
+    min_id = 0
+    q = [root]
+    while len(q) > 0:
+        b = q.pop()
+        min_id = min(min_id, b.id)
+        for c in b.children:
+            match c:
+                case Bucket():
+                    q.append(c)
+                case Device(DeviceInfo(device_class=str() as device_class)):
+                    classes.add(device_class)
+
+    res: list[Bucket] = []
+    ids = count(min_id - 1, -1)
+    for device_class in sorted(classes):
+        if (shadow := _clone_class(root, device_class, ids, res)) is not None:
+            shadow.update_subtree_weights()
+    return res
+
+
+# tunables `crush.Tunables` models
+SupportedTunables = (
+    "choose_total_tries",
+    "chooseleaf_descend_once",
+    "chooseleaf_vary_r",
+    "chooseleaf_stable",
+)
+# found in the maps Ceph exports, accepted and ignored
+IgnoredTunables = (
+    "choose_local_tries",
+    "choose_local_fallback_tries",
+    "straw_calc_version",
+    "allowed_bucket_algs",
+)
+
+
+@contextmanager
+def paused_gc() -> Iterator[None]:
+    """
+    For code which builds trees: all of their objects stay alive, collections
+    while they are built would only traverse them over and over
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+@dataclass(frozen=True)
+class MapBlock:
+    """
+    A span of the text of a map: the tunables and the devices, a bucket block
+    with the blank lines before it, or everything after the last bucket. The
+    blocks of a map add up to its whole text.
+    """
+
+    # bucket name, empty for the first and the last block
+    name: str
+    size: int  # characters
+    digest: bytes
+
+    @classmethod
+    def of(cls, name: str, text: str) -> "MapBlock":
+        return cls(name, len(text), _digest(text))
+
+    def matches(self, text: str, pos: int) -> bool:
+        """Whether the block is found as is at `pos` in `text`"""
+        end = pos + self.size
+        return end <= len(text) and _digest(text[pos:end]) == self.digest
+
 
 @dataclass
 class ParserResult:
     root: Bucket
     devices: dict[DeviceID_T, Device]
     rules: list[Rule]
+    # choose_args id -> weight sets. The simulator runs a single pool, the set
+    # with the lowest id is the one applied to the hierarchy
+    choose_args: dict[int, ChooseArgs] = field(default_factory=dict)
+    # name -> value of the `SupportedTunables` the map sets, see `crush.Tunables`
+    tunables: dict[str, int] = field(default_factory=dict)
+    # device id -> weight the map declares, the tree's can be changed afterwards
+    # (e.g. the simulation marks devices out)
+    weights: dict[DeviceID_T, WeightT] = field(default_factory=dict)
+    # name -> bucket of the hierarchy, shadow buckets aside
+    buckets: dict[str, Bucket] = field(default_factory=dict, repr=False)
+    # the text of the map cut at its bucket blocks, see `Parser.previous`
+    blocks: list[MapBlock] = field(default_factory=list, repr=False)
+
+
+@dataclass
+class MapDiff:
+    """
+    Changes between two parses of a map, devices are matched by id and buckets
+    by name. Weights are the ones the maps declare.
+    """
+
+    added_devices: list[DeviceID_T] = field(default_factory=list)
+    removed_devices: list[DeviceID_T] = field(default_factory=list)
+    # device id -> (old, new) weight
+    reweighted_devices: dict[DeviceID_T, tuple[WeightT, WeightT]] = field(
+        default_factory=dict
+    )
+    added_buckets: list[str] = field(default_factory=list)
+    removed_buckets: list[str] = field(default_factory=list)
+    # buckets whose subtree weight changed, children before their parents
+    reweighted_buckets: list[str] = field(default_factory=list)
+    # buckets with another id, type, alg or other items
+    changed_buckets: list[str] = field(default_factory=list)
+    # classes or primary affinities of devices, rules, choose_args or tunables
+    settings_changed: bool = False
+
+    @property
+    def weights_only(self) -> bool:
+        return not (
+            self.added_devices
+            or self.removed_devices
+            or self.added_buckets
+            or self.removed_buckets
+            or self.changed_buckets
+            or self.settings_changed
+        )
+
+
+def _item_ids(b: Bucket) -> list[int]:
+    return [c.id if isinstance(c, Bucket) else c.info.id for c in b.children]
+
+
+def _declared_weights(r: ParserResult) -> dict[str, tuple[Bucket, float]]:
+    # name -> (bucket, sum of the declared weights of its devices), children first
+    res: dict[str, tuple[Bucket, float]] = {}
+
+    def walk(b: Bucket) -> float:
+        w = 0.0
+        for c in b.children:
+            w += walk(c) if isinstance(c, Bucket) else r.weights[c.info.id]
+        res[b.name] = (b, w)
+        return w
+
+    walk(r.root)
+    return res
+
+
+def diff_maps(old: ParserResult, new: ParserResult) -> MapDiff:
+    """Changes from `old` to `new`, both trees are left untouched"""
+    res = MapDiff(
+        added_devices=sorted(new.weights.keys() - old.weights.keys()),
+        removed_devices=sorted(old.weights.keys() - new.weights.keys()),
+    )
+    for d in sorted(old.weights.keys() & new.weights.keys()):
+        if (w := old.weights[d]) != new.weights[d]:
+            res.reweighted_devices[d] = (w, new.weights[d])
+        if old.devices[d].info != new.devices[d].info:
+            res.settings_changed = True
+
+    old_buckets = _declared_weights(old)
+    new_buckets = _declared_weights(new)
+    res.added_buckets = [b for b in new_buckets if b not in old_buckets]
+    res.removed_buckets = [b for b in old_buckets if b not in new_buckets]
+    for name, (b, w) in new_buckets.items():
+        if (old_b := old_buckets.get(name)) is None:
+            continue
+        a, old_w = old_b
+        if (a.id, a.type, a.alg, _item_ids(a)) != (b.id, b.type, b.alg, _item_ids(b)):
+            res.changed_buckets.append(name)
+        if old_w != w:
+            res.reweighted_buckets.append(name)
+
+    res.settings_changed |= (
+        old.rules != new.rules
+        or old.choose_args != new.choose_args
+        or old.tunables != new.tunables
+    )
+    return res
 
 
 class ParsingError(Exception): ...
 
 
-class Parser:
-    def __init__(self, text: str):
-        self.text = text
-        self.cursor = 0
+# a token is a run of non-blank characters, braces also end the token before
+# them: blocks open with `name {` as well as `name{`
+_TOKEN = re.compile(r"[^\s{}]+|[{}]\S*")
+_WORD = re.compile(r"[^\W\d_][\w.-]*")
+_FLOAT = re.compile(r"\d+\.?\d*|\.\d+")
+_BUCKET_TYPES = {t.value: t for t in BucketT}
+# the line closing a bucket block
+_BLOCK_END = re.compile(r"^[^\S\n]*\}[^\S\n]*(?:\n|\Z)", re.M)
+
+
+def tokenize(lines: Iterable[str]) -> Iterator[tuple[int, str, list[str]]]:
+    """
+    (row, line, tokens) of every non-blank line, then an EOF entry with no
+    tokens. Statements of the map never span lines, so the parser consumes a
+    line at a time; columns are only recovered from the line for errors.
+    """
+    row = 0
+    line = ""
+    for row, line in enumerate(lines, 1):
+        if "{" in line or "}" in line:
+            tokens = _TOKEN.findall(line)
+        else:
+            tokens = line.split()
+        if len(tokens) > 0:
+            yield row, line, tokens
+    if line.endswith("\n") or row == 0:
+        yield row + 1, "", []
+    else:
+        yield row, line, []
+
 
-        self.last_newline_pos = -1
-        self.row = 1
-        self.col = 1
+class Parser:
+    def __init__(
+        self, source: str | Iterable[str], previous: ParserResult | None = None
+    ):
+        """
+        `source` is the whole map or its lines, e.g. an open file or
+        `sys.stdin`: lines are only read as the parser gets to them.
+
+        `previous` is what the map was last parsed into. When only weights of
+        items changed since, the bucket blocks which are the same are not
+        parsed again and the previous tree is reweighted in place: the new
+        result shares it, the previous one must not be used anymore. `diff`
+        tells what changed either way.
+        """
+        self.previous = previous
+        # the whole map, to be matched against the blocks of `previous`
+        self._text: str | None = None
+        if previous is not None:
+            source = source if isinstance(source, str) else "".join(source)
+            self._text = source
+        self._lines = tokenize(self._record(source))
+        self.row = 0
+        self.line = ""
+        self.tokens: list[str] = []
+        # (token, length) of a word that is a prefix of its token, see `read_word`
+        self._unspaced: tuple[int, int] | None = None
+        # the block being read, see `MapBlock`: the digest and size of its
+        # lines but the last one and the blank ones right before it, which are
+        # held back as they may start the next block (see `parse_buckets`)
+        self._block_hash = hashlib.sha256()
+        self._block_size = 0
+        self._held: list[str] = []
+        self._blocks: list[MapBlock] = []
+        # set once `iterparse` got to the end of the map
+        self.result: ParserResult | None = None
+        # set by `parse` when there is a `previous` result
+        self.diff: MapDiff | None = None
 
     def parse(self) -> ParserResult:
-        self.skip_whitespace_lns()
+        with paused_gc():
+            if self.previous is not None:
+                assert self._text is not None
+                if (r := self._reweight(self._text, self.previous)) is not None:
+                    return r
+            for _ in self.iterparse():
+                pass
+        assert self.result is not None
+        if self.previous is not None:
+            self.diff = diff_maps(self.previous, self.result)
+        return self.result
+
+    def _reweight(self, text: str, previous: ParserResult) -> ParserResult | None:
+        """
+        Matches `text` against the blocks of `previous`. Bucket blocks which
+        changed are parsed on their own and must declare the same items, the
+        rest of the map must be unchanged. The devices are only reweighted
+        once all of it checked out: None leaves `previous` untouched.
+        """
+        if len(previous.blocks) < 2:
+            return None
+        head, *buckets, tail = previous.blocks
+        if not head.matches(text, 0):
+            return None
+
+        pos = head.size
+        blocks = [head]
+        weights: dict[DeviceID_T, WeightT] = {}
+        for block in buckets:
+            if block.matches(text, pos):
+                blocks.append(block)
+                pos += block.size
+                continue
 
-        seen_devices = {"osd." + str(d.id): d for d in self.parse_devices()}
+            if (end := _BLOCK_END.search(text, pos)) is None:
+                return None
+            span = text[pos : end.end()]
+            bucket = previous.buckets[block.name]
+            if (block_weights := _block_weights(span, bucket)) is None:
+                return None
+            weights.update(block_weights)
+            blocks.append(MapBlock.of(block.name, span))
+            pos = end.end()
+        if pos + tail.size != len(text) or not tail.matches(text, pos):
+            return None
+        blocks.append(tail)
+
+        diff = MapDiff()
+        declared = dict(previous.weights)
+        # bucket name -> change of its subtree weight
+        deltas: dict[str, float] = {}
+        for d_id, w in weights.items():
+            if (old := declared[d_id]) == w:
+                continue
+            declared[d_id] = w
+            diff.reweighted_devices[d_id] = (old, w)
+            d = previous.devices[d_id]
+            # weights given to the tree since the previous parse are kept
+            if d.weight == old:
+                d.update_weight(w)
+            b: Bucket | None = d._parent
+            while b is not None:
+                deltas[b.name] = deltas.get(b.name, 0.0) + w - old
+                b = b._parent
+        diff.reweighted_buckets = [name for name, dw in deltas.items() if dw != 0]
+
+        self.diff = diff
+        self.result = ParserResult(
+            previous.root,
+            previous.devices,
+            previous.rules,
+            previous.choose_args,
+            previous.tunables,
+            declared,
+            previous.buckets,
+            blocks,
+        )
+        return self.result
+
+    def _record(self, source: str | Iterable[str]) -> Iterator[str]:
+        # the map may not even be read: see `_reweight`
+        lines = io.StringIO(source) if isinstance(source, str) else source
+        held = self._held
+        for line in lines:
+            if len(held) == 1 and not held[0].isspace():
+                # most lines: the previous one can't start the next block
+                prev = held.pop()
+                self._block_hash.update(prev.encode())
+                self._block_size += len(prev)
+            elif held and not held[-1].isspace():
+                self._hash_lines(len(held))
+            held.append(line)
+            yield line
+
+    def _hash_lines(self, n: int) -> None:
+        """Adds the first `n` held lines to the block being read"""
+        for line in self._held[:n]:
+            self._block_hash.update(line.encode())
+            self._block_size += len(line)
+        del self._held[:n]
+
+    def _end_block(self, name: str, pending: int = 0) -> None:
+        """
+        Closes the block of the lines read so far but the last `pending`
+        ones, which belong to the next block
+        """
+        self._hash_lines(len(self._held) - pending)
+        self._blocks.append(
+            MapBlock(name, self._block_size, self._block_hash.digest())
+        )
+        self._block_hash = hashlib.sha256()
+        self._block_size = 0
+
+    def iterparse(self) -> Generator[DeviceInfo | Bucket, None, None]:
+        """
+        Yields the devices and then the buckets as they are declared, the
+        whole map is in `result` once the generator is exhausted. Buckets
+        come with their children, their weights are only summed at the end.
+
+        Besides the tree, only the indexes of the names and ids seen so far
+        are kept: the lines which were parsed can be let go of.
+        """
+        self.next_line(0, required=False)
+
+        tunables = dict(self.parse_tunables())
+        seen_devices: dict[str, DeviceInfo] = {}
+        for d in self.parse_devices():
+            seen_devices["osd." + str(d.id)] = d
+            yield d
 
         buckets: list[Bucket] = []
         seen_buckets: set[str] = set()
@@ -246,11 +868,12 @@ class Parser:
             if b.type == "root":
                 if root_node is not None:
                     self.report_error_with_line(
-                        f"root node already registered: {root_node.name}"
+                        f"root node already registered: {root_node.name}", 1
                     )
                 root_node = b
 
             devices.update(b_devices)
+            yield b
         if root_node is None:
             self.report_error_with_line("no root node found")
 
@@ -271,186 +894,187 @@ class Parser:
             self.report_error("found disconected nodes: " + ",".join(seen_buckets_c))
 
         rules = list(self.parse_rules(seen_buckets))
+        weights = {d_id: d.weight for d_id, d in devices.items()}
+        by_name = {b.name: b for b in buckets}
         root_node.update_subtree_weights()
+        # shadow ids are deterministic: choose_args can refer to them
+        buckets.extend(build_shadow_trees(root_node))
+
+        choose_args = dict(self.parse_choose_args({b.id: b for b in buckets}))
+        if len(choose_args) > 0:
+            apply_choose_args(root_node, choose_args[min(choose_args)])
+        self._end_block("")
+
+        self.result = ParserResult(
+            root_node,
+            devices,
+            rules,
+            choose_args,
+            tunables,
+            weights,
+            by_name,
+            self._blocks,
+        )
 
-        return ParserResult(root_node, devices, rules)
-
-    def skip_n(self, n: int) -> None:
-        self.advance(n)
-
-    def read_num(self) -> str | None:
-        new = self.cursor
-        while new < len(self.text) and self.text[new].isnumeric():
-            new += 1
-
-        if new == self.cursor:
+    def next_line(self, i: int, required: bool = True) -> None:
+        """
+        Moves to the next non-blank line, the statement on the current one
+        ended before its `i`-th token
+        """
+        if self._unspaced is not None:
+            self.report_unspaced()
+        if i < len(self.tokens) or (required and not self.line.endswith("\n")):
+            self.report_error_with_line("new line chars not found", i)
+        self.row, self.line, self.tokens = next(self._lines)
+
+    def read_word(self, i: int) -> str | None:
+        """
+        Longest word the `i`-th token starts with. When it isn't the whole
+        token, the missing blank after it is reported as soon as the parser
+        reads on: the word may still be rejected with a more useful message
+        """
+        if self._unspaced is not None:
+            self.report_unspaced()
+        if i >= len(self.tokens):
             return None
-
-        if new >= len(self.text) or self.text[new].isspace():
-            return self.text[self.cursor : new]
+        t = self.tokens[i]
+        if (m := _WORD.match(t)) is None:
+            return None
+        if m.end() < len(t):
+            self._unspaced = (i, m.end())
+            return m.group()
+        return t
+
+    def report_unspaced(self) -> NoReturn:
+        assert self._unspaced is not None
+        self.report_error_with_line("expected a blank space", *self._unspaced)
+
+    def read_num(self, i: int) -> str | None:
+        if self._unspaced is not None:
+            self.report_unspaced()
+        if i < len(self.tokens) and (t := self.tokens[i]).isdecimal():
+            return t
         return None
 
-    def read_float(self) -> str | None:
-        new = self.cursor
-        while new < len(self.text) and self.text[new].isnumeric():
-            new += 1
-        nonempty_prefix = new != self.cursor
-
-        if new < len(self.text) and self.text[new] == ".":
-            new += 1
-
-        suf_start = new
-        while new < len(self.text) and self.text[new].isnumeric():
-            new += 1
-        nonempty_suffix = suf_start != new
-
-        if (nonempty_prefix or nonempty_suffix) and (
-            new >= len(self.text) or self.text[new].isspace()
-        ):
-            return self.text[self.cursor : new]
+    def read_float(self, i: int) -> str | None:
+        if self._unspaced is not None:
+            self.report_unspaced()
+        if i < len(self.tokens) and _FLOAT.fullmatch(t := self.tokens[i]):
+            return t
         return None
 
-    def match_prefix(self, target: str) -> bool:
-        return self.text[self.cursor : self.cursor + len(target)] == target
-
-    def match_substr(self, target: str) -> bool:
-        if self.cursor >= len(self.text):
-            return False
-        if self.cursor + len(target) >= len(self.text):
-            return self.text[self.cursor : self.cursor + len(target)] == target
-        return (
-            self.text[self.cursor + len(target)].isspace()
-            and self.text[self.cursor : self.cursor + len(target)] == target
-        )
+    def read_bucket_type(self, i: int) -> BucketT | None:
+        if (t := self.token(i)) is not None:
+            return _BUCKET_TYPES.get(t)
+        return None
 
-    def read_word(self) -> str | None:
-        new = self.cursor
-        if new >= len(self.text) or not self.text[new].isalpha():
-            return None
-        new += 1
-        while new < len(self.text) and (
-            self.text[new].isalnum() or self.text[new] in "-_."
-        ):
-            new += 1
-        return self.text[self.cursor : new]
+    def token(self, i: int) -> str | None:
+        if self._unspaced is not None:
+            self.report_unspaced()
+        if i < len(self.tokens):
+            return self.tokens[i]
+        return None
 
     def report_error(self, msg: str) -> NoReturn:
         raise ParsingError(msg)
 
-    def report_error_with_line(self, msg: str) -> NoReturn:
-        if self.cursor < len(self.text):
-            right_newline = self.cursor + self.text[self.cursor :].find("\n")
+    def report_error_with_line(self, msg: str, i: int = 0, offset: int = 0) -> NoReturn:
+        """
+        Points at `offset` characters into the `i`-th token of the current
+        line, or at its end
+        """
+        line = self.line.rstrip("\n")
+        if i < len(self.tokens):
+            col = [m.start() for m in _TOKEN.finditer(line)][i] + offset
         else:
-            right_newline = len(self.text)
+            col = len(line.rstrip("\r"))
 
         col_prefix = f"{self.row} | "
         formated_msg = "{}{}\n{}^\n{}{}\n".format(
             col_prefix,
-            self.text[self.last_newline_pos + 1 : right_newline],
-            " " * (len(col_prefix) + self.col - 1),
+            line,
+            " " * (len(col_prefix) + col),
             " " * len(col_prefix),
             msg,
         )
 
         self.report_error(formated_msg)
 
-    def read_bucket_type(self) -> BucketT | None:
-        for t in BucketT:
-            if self.match_substr(t):
-                return t
-        return None
-
-    def advance(self, n: int = 1) -> None:
-        self.cursor += n
-        self.col += n
-
-    def skip_whitespace_lns(self) -> None:
-        while self.cursor < len(self.text) and self.text[self.cursor].isspace():
-            if self.text[self.cursor] == "\n":
-                self.last_newline_pos = self.cursor
-                self.row += 1
-                self.col = 0
-            self.advance()
-
-    def skip_whitespace_lns_required(self) -> None:
-        found = False
-        while self.cursor < len(self.text) and self.text[self.cursor].isspace():
-            if self.text[self.cursor] == "\n":
-                found = True
-                self.last_newline_pos = self.cursor
-                self.row += 1
-                self.col = 0
-            self.advance()
-        if not found:
-            self.report_error_with_line("new line chars not found")
-
-    def skip_whitespace_to_token_this_line(self) -> None:
-        new = self.cursor
-        while new < len(self.text) and self.text[new] in (" ", "\t"):
-            new += 1
-        if (
-            new == self.cursor
-            and not self.text[self.cursor].isspace()
-            and self.text[self.cursor] not in "{}"
-        ):
-            self.report_error_with_line("expected a blank space")
-        self.advance(new - self.cursor)
+    def parse_tunables(self) -> Generator[tuple[str, int], None, None]:
+        seen: set[str] = set()
+        while self.token(0) == "tunable":
+            name = self.read_word(1)
+            if name is None:
+                self.report_error_with_line("expected a tunable name", 1)
+            if name not in SupportedTunables and name not in IgnoredTunables:
+                self.report_error_with_line(f"unknown tunable `{name}`", 1)
+            if name in seen:
+                self.report_error_with_line(f"tunable `{name}` is already set", 1)
+            seen.add(name)
+
+            value = self.read_num(2)
+            if value is None:
+                self.report_error_with_line("expected a non negative tunable value", 2)
+
+            if name in SupportedTunables:
+                yield name, int(value)
+            self.next_line(3)
 
     def parse_devices(self) -> Generator[DeviceInfo, None, None]:
         device_nums: set[str] = set()
         seen_ids: set[str] = set()
         while True:
-            if not self.match_substr("device"):
-                maybe_type = self.read_bucket_type()
-                if maybe_type is not None:
+            tokens = self.tokens
+            n = len(tokens)
+            if n == 0 or tokens[0] != "device":
+                if self.read_bucket_type(0) is not None:
                     return
                 self.report_error_with_line(
                     """expected "device" or buckets description"""
                 )
 
-            self.skip_n(len("device"))
-            self.skip_whitespace_to_token_this_line()
-
-            device_num = self.read_num()
+            device_num = self.read_num(1)
             if device_num is None:
-                self.report_error_with_line("expected a device number")
+                self.report_error_with_line("expected a device number", 1)
 
             if device_num in device_nums:
                 self.report_error_with_line(
-                    "device with this number is already defined"
+                    "device with this number is already defined", 1
                 )
             device_nums.add(device_num)
 
-            self.skip_n(len(device_num))
-            self.skip_whitespace_to_token_this_line()
+            if n < 3 or not tokens[2].startswith("osd."):
+                self.report_error_with_line("expected osd id declaration", 2)
 
-            if not self.match_prefix("osd."):
-                self.report_error_with_line("expected osd id declaration")
-
-            self.skip_n(len("osd."))
-            osd_id = self.read_num()
-            if osd_id is None:
-                self.report_error_with_line("bad osd declaration: expected a number")
+            osd_id = tokens[2][len("osd.") :]
+            if not osd_id.isdecimal():
+                self.report_error_with_line(
+                    "bad osd declaration: expected a number", 2, len("osd.")
+                )
             if osd_id in seen_ids:
-                self.report_error_with_line("osd id already registered")
+                self.report_error_with_line("osd id already registered", 2, len("osd."))
             seen_ids.add(osd_id)
 
-            self.skip_n(len(osd_id))
-            self.skip_whitespace_to_token_this_line()
-
-            if not self.match_substr("class"):
-                yield DeviceInfo(DeviceID_T(int(osd_id)))
-                self.skip_whitespace_lns_required()
-                continue
+            i = 3
+            class_name: str | None = None
+            if i < n and tokens[i] == "class":
+                class_name = self.read_word(i + 1)
+                if class_name is None:
+                    self.report_error_with_line("expected a device class", i + 1)
+                i += 2
+
+            affinity = DefaultPrimaryAffinity
+            if i < n and tokens[i] == "primary_affinity":
+                a = self.read_float(i + 1)
+                if a is None or not 0 <= float(a) <= 1:
+                    self.report_error_with_line(
+                        "expected a primary affinity between 0 and 1", i + 1
+                    )
+                affinity = float(a)
+                i += 2
 
-            self.skip_n(len("class"))
-            self.skip_whitespace_to_token_this_line()
-            class_name = self.read_word()
-            if class_name is None:
-                self.report_error_with_line("expected a device class")
-            self.skip_n(len(class_name))
-            yield DeviceInfo(DeviceID_T(int(osd_id)), class_name)
-            self.skip_whitespace_lns_required()
+            yield DeviceInfo(DeviceID_T(int(osd_id)), class_name, affinity)
+            self.next_line(i)
 
     def parse_buckets(
         self, seen_devices: dict[str, DeviceInfo]
@@ -459,28 +1083,25 @@ class Parser:
         seen_buckets: dict[str, Bucket] = {}
         child2parent: dict[str, str] = {}
 
+        # the first bucket block starts with the current line and the blank
+        # ones before it, like the blocks which follow
+        self._end_block("", len(self._held))
         while True:
-            bucket_type = self.read_bucket_type()
+            bucket_type = self.read_bucket_type(0)
             if bucket_type is None:
-                if self.match_substr("rule"):
+                if self.token(0) == "rule":
                     return
                 self.report_error_with_line("expected a bucket type")
 
-            self.skip_n(len(bucket_type))
-            self.skip_whitespace_to_token_this_line()
-
-            bucket_name = self.read_word()
+            bucket_name = self.read_word(1)
             if bucket_name is None:
-                self.report_error_with_line("expected a bucket name")
+                self.report_error_with_line("expected a bucket name", 1)
 
             if bucket_name in seen_buckets:
                 self.report_error_with_line(
-                    f"bucket with name `{bucket_name}` already exists"
+                    f"bucket with name `{bucket_name}` already exists", 1
                 )
 
-            self.skip_n(len(bucket_name))
-            self.skip_whitespace_to_token_this_line()
-
             b, devices = self.parse_bucket_block(
                 bucket_name,
                 bucket_type,
@@ -490,9 +1111,10 @@ class Parser:
                 seen_ids,
             )
             seen_buckets[b.name] = b
+            self._end_block(b.name)
 
             yield b, devices
-            self.skip_whitespace_lns_required()
+            self.next_line(1)
 
     def parse_bucket_block(
         self,
@@ -503,95 +1125,77 @@ class Parser:
         child2parent: dict[str, str],
         seen_ids: set[str],
     ) -> tuple[Bucket, dict[DeviceID_T, Device]]:
-        if not self.match_substr("{"):
-            self.report_error_with_line("expected a bucket block start")
-        self.skip_n(1)
-        self.skip_whitespace_lns_required()
+        if self.token(2) != "{":
+            self.report_error_with_line("expected a bucket block start", 2)
+        self.next_line(3)
 
         b_id: BucketID_T | None = None
         b_alg: AlgType | None = None
         b_hash: Optional[int] = None
 
         while True:
-            field = self.read_word()
+            tokens = self.tokens
+            field = self.read_word(0)
             if field is None:
-                if self.match_substr("}"):
+                if self.token(0) == "}":
                     self.report_error_with_line("found bucket with no children")
                 self.report_error_with_line("expected a bucket field")
             if field == "id":
                 if b_id is not None:
                     self.report_error_with_line("found double declaration of a field")
 
-                self.skip_n(len(field))
-                self.skip_whitespace_to_token_this_line()
-
-                if not self.match_prefix("-"):
+                if (t := self.token(1)) is None or not t.startswith("-"):
                     self.report_error_with_line(
-                        "expected a bucket ID (which are always negative)"
+                        "expected a bucket ID (which are always negative)", 1
                     )
-                self.skip_n(1)
 
-                bucket_id = self.read_num()
-                if bucket_id is None:
+                bucket_id = t[1:]
+                if not bucket_id.isdecimal():
                     self.report_error_with_line(
-                        "expected a bucket ID (which are always negative)"
+                        "expected a bucket ID (which are always negative)", 1, 1
                     )
 
                 if bucket_id in seen_ids:
                     self.report_error_with_line(
-                        f"bucket with id `{bucket_id}` already exists"
+                        f"bucket with id `{bucket_id}` already exists", 1, 1
                     )
                 seen_ids.add(bucket_id)
 
-                self.skip_n(len(bucket_id))
                 b_id = BucketID_T(-int(bucket_id))
             elif field == "alg":
                 if b_alg is not None:
                     self.report_error_with_line("found double declaration of a field")
 
-                self.skip_n(len(field))
-                self.skip_whitespace_to_token_this_line()
-
-                alg = self.read_word()
+                alg = self.read_word(1)
                 if alg is None:
                     self.report_error_with_line(
-                        "expected algorith types: uniform, straw2"
+                        "expected algorith types: uniform, list, tree, straw2", 1
                     )
-                self.skip_n(len(alg))
 
                 if alg == "uniform":
                     b_alg = AlgType.uniform
+                elif alg == "list":
+                    b_alg = AlgType.list
+                elif alg == "tree":
+                    b_alg = AlgType.tree
                 elif alg == "straw2":
                     b_alg = AlgType.straw2
                 else:
                     self.report_error_with_line(
-                        "only uniform & straw2 algs are allowed"
+                        "unknown alg type: only uniform, list, tree, straw2 are allowed",
+                        1,
+                        len(alg),
                     )
-
-                # elif alg == "list":
-                #     b_alg = AlgType.list
-                # elif alg == "tree":
-                #     b_alg = AlgType.tree
-                # elif alg == "straw2":
-                #     b_alg = AlgType.straw2
-                # else:
-                #     self.report_error_with_line(
-                #         "unknown alg type: only uniform, list, tree, straw2 are allowed"
-                #     )
             elif field == "hash":
                 if b_hash is not None:
                     self.report_error_with_line("found double declaration of a field")
 
-                self.skip_n(len(field))
-                self.skip_whitespace_to_token_this_line()
-
-                hash = self.read_num()
+                hash = self.read_num(1)
                 if hash is None:
-                    self.report_error_with_line("expected hash")
+                    self.report_error_with_line("expected hash", 1)
                 if hash != "0":
-                    self.report_error_with_line("only `0` hash is supported")
+                    self.report_error_with_line("only `0` hash is supported", 1)
 
-                self.skip_n(len(hash))
                 b_hash = 0
             elif field == "item":
                 if b_id is None:
@@ -607,9 +1211,8 @@ class Parser:
                 )
                 res.children = items
 
-                if not self.match_substr("}"):
+                if self.token(0) != "}":
                     self.report_error_with_line("expected a bucket block end")
-                self.skip_n(1)
 
                 return (
                     res,
@@ -617,7 +1220,7 @@ class Parser:
                 )
             else:
                 self.report_error_with_line("unknown field")
-            self.skip_whitespace_lns_required()
+            self.next_line(2)
 
     def parse_bucket_items(
         self,
@@ -634,7 +1237,6 @@ class Parser:
             match item_res:
                 case Bucket() | Device():
                     res.append(item_res)
-                    self.skip_whitespace_lns_required()
                 case None:
                     break
         return res
@@ -646,66 +1248,63 @@ class Parser:
         seen_devices: dict[str, DeviceInfo],
         child2parent: dict[str, str],
     ) -> (Bucket | Device) | None:
-        item_decl = self.read_word()
-        if item_decl != "item":
-            if self.match_substr("}"):
+        tokens = self.tokens
+        n = len(tokens)
+        if n == 0 or tokens[0] != "item":
+            if n > 0 and tokens[0] == "}":
                 return None
-            self.report_error_with_line("expected an item declaration")
-        self.skip_n(len(item_decl))
-        self.skip_whitespace_to_token_this_line()
+            if self.read_word(0) != "item":
+                self.report_error_with_line("expected an item declaration")
 
-        item_name = self.read_word()
-        if item_name is None:
-            self.report_error_with_line("expected an item name")
+        # names of declared items are known to be words
+        item_name = tokens[1] if n > 1 else ""
+        if item_name not in seen_buckets and item_name not in seen_devices:
+            item_name = self.read_word(1)
+            if item_name is None:
+                self.report_error_with_line("expected an item name", 1)
 
         weight_is_requried = True
         if (b := seen_buckets.get(item_name)) is not None:
             if b.type >= parent.type:
                 self.report_error_with_line(
-                    f"hierarchy violation: {item_name}({b.type}) is a child of {parent}({parent.type})"
+                    f"hierarchy violation: {item_name}({b.type}) is a child of {parent}({parent.type})",
+                    1,
                 )
             weight_is_requried = False
         elif item_name not in seen_devices:
-            self.report_error_with_line("unknown item")
+            self.report_error_with_line("unknown item", 1)
 
         if (p := child2parent.get(item_name)) is not None:
-            self.report_error_with_line(f"item already registered at {p}")
+            self.report_error_with_line(f"item already registered at {p}", 1)
         child2parent[item_name] = parent.name
 
-        self.skip_n(len(item_name))
-        self.skip_whitespace_to_token_this_line()
-
         weight: WeightT | None = None
-        while True:
-            key = self.read_word()
+        i = 2
+        while i < n:
+            key = tokens[i] if tokens[i] == "weight" else self.read_word(i)
             if key is None:
-                if self.cursor >= len(self.text):
-                    self.report_error_with_line("unexpected EOF")
-                if self.text[self.cursor].isspace():  # \n
-                    break
-                self.report_error_with_line("bad field name")
+                self.report_error_with_line("bad field name", i)
 
             if key == "weight":
                 if not weight_is_requried:
-                    self.report_error_with_line("can't assign weight to a bucket")
+                    self.report_error_with_line("can't assign weight to a bucket", i)
 
-                self.skip_n(len(key))
-                self.skip_whitespace_to_token_this_line()
-
-                w = self.read_float()
+                w = self.read_float(i + 1)
                 if w is None:
-                    self.report_error_with_line("expected a float number")
+                    self.report_error_with_line("expected a float number", i + 1)
                 weight = WeightT(float(w))
-
-                self.skip_n(len(w))
-                self.skip_whitespace_to_token_this_line()
+                i += 2
             else:
-                self.report_error_with_line("unexpected attribute")
+                self.report_error_with_line("unexpected attribute", i)
+        if not self.line.endswith("\n"):
+            self.report_error_with_line("unexpected EOF", i)
 
         if weight_is_requried and weight is None:
-            self.report_error_with_line("no weight was declared")
+            self.report_error_with_line("no weight was declared", i)
+        self.next_line(i)
 
-        if (b := seen_buckets.get(item_name)) is not None:
+        if b is not None:
+            b._parent = parent
             return b
         assert weight is not None
         return Device(seen_devices[item_name], weight, parent)
@@ -714,107 +1313,88 @@ class Parser:
         seen_ids: set[int] = set()
         seen_names: set[str] = set()
         while True:
-            if self.cursor >= len(self.text):
+            if len(self.tokens) == 0 or self.tokens[0] == "choose_args":
                 return
 
-            if not self.match_substr(target="rule"):
+            if self.tokens[0] != "rule":
                 self.report_error_with_line("expected a rule declaration")
-            self.skip_n(len("rule"))
-            self.skip_whitespace_to_token_this_line()
 
-            rule_name = self.read_word()
+            rule_name = self.read_word(1)
             if rule_name is None:
-                self.report_error_with_line("expected a rule name")
-            self.skip_n(len(rule_name))
-            self.skip_whitespace_to_token_this_line()
+                self.report_error_with_line("expected a rule name", 1)
 
             rule = self.parse_rule_block(rule_name, seen_buckets)
             if rule.id in seen_ids:
-                self.report_error_with_line(f"rule with id `{rule.id}` already exists")
+                self.report_error_with_line(
+                    f"rule with id `{rule.id}` already exists", 1
+                )
             if rule.name in seen_names:
                 self.report_error_with_line(
-                    f"rule with name `{rule.name}` alread exists"
+                    f"rule with name `{rule.name}` alread exists", 1
                 )
 
             seen_ids.add(rule.id)
             seen_names.add(rule.name)
 
             yield rule
-            self.skip_whitespace_lns_required()
+            self.next_line(1)
 
     def parse_rule_block(self, name: str, seen_buckets: set[str]) -> Rule:
-        if not self.match_substr("{"):
-            self.report_error_with_line("expected a rule block")
-        self.skip_n(1)
-        self.skip_whitespace_lns_required()
+        if self.token(2) != "{":
+            self.report_error_with_line("expected a rule block", 2)
+        self.next_line(3)
 
         rule_id: int | None = None
         rule_min_size = 1
         rule_max_size = 10
+        rule_type: Literal["replicated", "erasure"] = "replicated"
         while True:
-            key = self.read_word()
+            key = self.read_word(0)
             if key is None:
                 self.report_error_with_line("expected a rule attribute")
 
             if key == "id":
-                self.skip_n(len(key))
-                self.skip_whitespace_to_token_this_line()
-
-                found_id = self.read_num()
+                found_id = self.read_num(1)
                 if found_id is None:
-                    self.report_error_with_line("expected a rule id")
+                    self.report_error_with_line("expected a rule id", 1)
                 rule_id = int(found_id)
-
-                self.skip_n(len(found_id))
-                self.skip_whitespace_lns_required()
+                self.next_line(2)
             elif key == "type":
-                self.skip_n(len(key))
-                self.skip_whitespace_to_token_this_line()
-
-                rule_type = self.read_word()
-                if rule_type is None:
-                    self.report_error_with_line('expected "replacated" rule type')
-                elif rule_type != "replicated":
+                found_type = self.read_word(1)
+                if found_type is None:
+                    self.report_error_with_line("expected a rule type", 1)
+                if found_type not in ("replicated", "erasure"):
                     self.report_error_with_line(
-                        'not "replacated" rules are not supported'
+                        'only "replicated" and "erasure" rules are supported', 1
                     )
-
-                self.skip_n(len(rule_type))
-                self.skip_whitespace_lns_required()
+                rule_type = found_type  # type: ignore (checked above)
+                self.next_line(2)
             elif key == "min_size":
-                self.skip_n(len(key))
-                self.skip_whitespace_to_token_this_line()
-
-                found_min_size = self.read_num()
+                found_min_size = self.read_num(1)
                 if found_min_size is None:
-                    self.report_error_with_line("expected min_size")
+                    self.report_error_with_line("expected min_size", 1)
                 rule_min_size = int(found_min_size)
-                self.skip_n(len(found_min_size))
-                self.skip_whitespace_lns_required()
+                self.next_line(2)
             elif key == "max_size":
-                self.skip_n(len(key))
-                self.skip_whitespace_to_token_this_line()
-
-                found_max_size = self.read_num()
+                found_max_size = self.read_num(1)
                 if found_max_size is None:
-                    self.report_error_with_line("expected max_size")
+                    self.report_error_with_line("expected max_size", 1)
                 rule_max_size = int(found_max_size)
-                self.skip_n(len(found_max_size))
-                self.skip_whitespace_lns_required()
+                self.next_line(2)
             elif key == "step":
                 rules = self.parse_rule_steps(seen_buckets)
-                if not self.match_substr("}"):
+                if self.token(0) != "}":
                     self.report_error_with_line("expected an end of rule declaration")
-                self.skip_n(1)
 
                 if rule_id is None:
-                    self.report_error_with_line("no rule's id was declared")
+                    self.report_error_with_line("no rule's id was declared", 1)
                 return Rule(
                     name=name,
                     id=rule_id,
                     min_size=rule_min_size,
                     max_size=rule_max_size,
                     rules=rules,
+                    type=rule_type,
                 )
             else:
                 self.report_error_with_line("unexpected rule field")
@@ -822,18 +1402,14 @@ class Parser:
     def parse_rule_steps(self, seen_buckets: set[str]) -> list[StepT]:
         rules: list[StepT] = []
         while True:
-            if not self.match_substr("step"):
-                if self.match_substr("}"):
+            if self.tokens[:1] != ["step"]:
+                if self.tokens[:1] == ["}"]:
                     break
                 self.report_error_with_line("expected rule `take` step")
-            self.skip_n(len("step"))
-            self.skip_whitespace_to_token_this_line()
 
-            choice = self.read_word()
+            choice = self.read_word(1)
             if choice is None:
-                self.report_error_with_line("expected step type")
-            self.skip_n(len(choice))
-            self.skip_whitespace_to_token_this_line()
+                self.report_error_with_line("expected step type", 1)
             match choice:
                 case "take":
                     rules.append(self.parse_step_take(seen_buckets))
@@ -841,10 +1417,9 @@ class Parser:
                     rules.append(self.parse_step_choose(choice != "choose"))
                 case "emit":
                     rules.append(StepEmit())
+                    self.next_line(2)
                 case _:
-                    self.report_error_with_line("unexpected step type")
-
-            self.skip_whitespace_lns_required()
+                    self.report_error_with_line("unexpected step type", 2)
 
         if len(rules) == 0:
             self.report_error_with_line("rule with no steps")
@@ -853,61 +1428,214 @@ class Parser:
         return rules
 
     def parse_step_take(self, seen_buckets: set[str]) -> StepTake:
-        bucket = self.read_word()
+        bucket = self.read_word(2)
         if bucket is None:
-            self.report_error_with_line("expected bucket name")
+            self.report_error_with_line("expected bucket name", 2)
         if bucket not in seen_buckets:
-            self.report_error_with_line("unknown bucket name")
-
-        self.skip_n(len(bucket))
-        self.skip_whitespace_to_token_this_line()
+            self.report_error_with_line("unknown bucket name", 2)
 
-        class_opt = self.read_word()
+        class_opt = self.read_word(3)
         if class_opt is None:
+            self.next_line(3)
             return StepTake(bucket)
 
         if class_opt != "class":
             self.report_error_with_line(
-                "expected to see class option on the same line with `take` step"
+                "expected to see class option on the same line with `take` step", 3
             )
-        self.skip_n(len(class_opt))
-        self.skip_whitespace_to_token_this_line()
 
-        cls = self.read_word()
+        cls = self.read_word(4)
         if cls is None:
-            self.report_error_with_line("expected a device class")
-        self.skip_n(len(cls))
+            self.report_error_with_line("expected a device class", 4)
+        self.next_line(5)
 
         return StepTake(bucket, cls)
 
     def parse_step_choose(self, is_chooseleaf: bool) -> StepChoose:
-        choice_opt = self.read_word()
+        choice_opt = self.read_word(2)
         if choice_opt is None:
-            self.report_error_with_line("expected `firstn` option")
-        if choice_opt != "firstn":
-            self.report_error_with_line("only `firstn` option is supported")
-        self.skip_n(len(choice_opt))
-        self.skip_whitespace_to_token_this_line()
+            self.report_error_with_line("expected `firstn` or `indep` option", 2)
+        if choice_opt not in ("firstn", "indep"):
+            self.report_error_with_line(
+                "only `firstn` and `indep` options are supported", 2
+            )
 
-        N = self.read_num()
+        N = self.read_num(3)
         if N is None:
-            self.report_error_with_line("expected a number")
-        self.skip_n(len(N))
-        self.skip_whitespace_to_token_this_line()
+            self.report_error_with_line("expected a number", 3)
 
-        if not self.match_substr("type"):
-            self.report_error_with_line("expected a `type` keyword")
-        self.skip_n(len("type"))
-        self.skip_whitespace_to_token_this_line()
+        if self.token(4) != "type":
+            self.report_error_with_line("expected a `type` keyword", 4)
 
-        bucket_type: (BucketT | None) | Literal["osd"] = self.read_bucket_type()
+        bucket_type: (BucketT | None) | Literal["osd"] = self.read_bucket_type(5)
         if bucket_type is None:
-            if not self.match_substr("osd"):
-                self.report_error_with_line("expected a bucket type")
+            if self.token(5) != "osd":
+                self.report_error_with_line("expected a bucket type", 5)
             bucket_type = "osd"
-
-        self.skip_n(len(bucket_type))
+        self.next_line(6)
 
         return StepChoose(
-            is_chooseleaf=is_chooseleaf, n=int(N), bucket_type=bucket_type
+            is_chooseleaf=is_chooseleaf,
+            n=int(N),
+            bucket_type=bucket_type,
+            is_indep=choice_opt == "indep",
+        )
+
+    def parse_choose_args(
+        self, buckets: dict[BucketID_T, Bucket]
+    ) -> Generator[tuple[int, ChooseArgs], None, None]:
+        seen_ids: set[int] = set()
+        while True:
+            if len(self.tokens) == 0:
+                return
+
+            if self.tokens[0] != "choose_args":
+                self.report_error_with_line("expected a choose_args declaration")
+
+            args_id = self.read_num(1)
+            if args_id is None:
+                self.report_error_with_line("expected a choose_args id", 1)
+            if int(args_id) in seen_ids:
+                self.report_error_with_line(
+                    f"choose_args with id `{args_id}` already exists", 1
+                )
+            seen_ids.add(int(args_id))
+
+            if self.token(2) != "{":
+                self.report_error_with_line("expected a choose_args block", 2)
+            self.next_line(3)
+
+            args: ChooseArgs = {}
+            while self.token(0) != "}":
+                b, weight_set = self.parse_choose_arg(buckets)
+                if b.id in args:
+                    self.report_error_with_line(
+                        f"weight set of `{b.name}` is already declared", 1
+                    )
+                args[b.id] = weight_set
+                self.next_line(1)
+
+            yield int(args_id), args
+            # what follows the closing brace is read as the next declaration
+            if self.token(1) is not None:
+                self.report_error_with_line("expected a choose_args declaration", 1)
+            self.next_line(1, required=False)
+
+    def parse_choose_arg(
+        self, buckets: dict[BucketID_T, Bucket]
+    ) -> tuple[Bucket, list[list[WeightT]]]:
+        if self.token(0) != "{":
+            self.report_error_with_line("expected a bucket's choose_args block")
+        self.next_line(1)
+
+        b: Bucket | None = None
+        weight_set: list[list[WeightT]] | None = None
+        while True:
+            tokens = self.tokens
+            key = self.read_word(0)
+            if key is None:
+                if self.token(0) != "}":
+                    self.report_error_with_line("expected a choose_args field")
+                break
+
+            if key == "bucket_id":
+                if b is not None:
+                    self.report_error_with_line("found double declaration of a field")
+
+                if (t := self.token(1)) is None or not t.startswith("-"):
+                    self.report_error_with_line(
+                        "expected a bucket ID (which are always negative)", 1
+                    )
+                bucket_id = t[1:]
+                if not bucket_id.isdecimal():
+                    self.report_error_with_line(
+                        "expected a bucket ID (which are always negative)", 1, 1
+                    )
+                b = buckets.get(BucketID_T(-int(bucket_id)))
+                if b is None:
+                    self.report_error_with_line(
+                        f"unknown bucket id `-{bucket_id}`", 1, 1
+                    )
+                if b.alg != AlgType.straw2:
+                    self.report_error_with_line(
+                        "weight sets are only supported by straw2 buckets", 1, 1
+                    )
+                self.next_line(2)
+            elif key == "weight_set":
+                if weight_set is not None:
+                    self.report_error_with_line("found double declaration of a field")
+                if b is None:
+                    self.report_error_with_line("expected `bucket_id` first")
+                weight_set = self.parse_weight_set(len(b.children))
+            elif key == "ids":
+                self.report_error_with_line("only `weight_set` is supported")
+            else:
+                self.report_error_with_line("unknown field")
+
+        if b is None or weight_set is None:
+            self.report_error_with_line("expected `bucket_id` and `weight_set`")
+        return b, weight_set
+
+    def parse_weight_set(self, size: int) -> list[list[WeightT]]:
+        if self.token(1) != "[":
+            self.report_error_with_line("expected a weight set", 1)
+        self.next_line(2)
+
+        res: list[list[WeightT]] = []
+        while self.token(0) != "]":
+            tokens = self.tokens
+            if self.token(0) != "[":
+                self.report_error_with_line("expected a weight vector")
+
+            weights: list[WeightT] = []
+            i = 1
+            while self.token(i) != "]":
+                w = self.read_float(i)
+                if w is None:
+                    self.report_error_with_line("expected a float number", i)
+                weights.append(WeightT(float(w)))
+                i += 1
+            if len(weights) != size:
+                self.report_error_with_line(
+                    f"expected {size} weights, one per bucket item", i
+                )
+            res.append(weights)
+            self.next_line(i + 1)
+
+        if len(res) == 0:
+            self.report_error_with_line("expected at least one weight vector")
+        self.next_line(1)
+        return res
+
+
+def _block_weights(text: str, b: Bucket) -> dict[DeviceID_T, WeightT] | None:
+    """
+    Weights of the devices of the bucket block `text`, None unless it declares
+    `b` again with the same items
+    """
+    p = Parser(text)
+    # the items are looked up among the ones of `b`, the buckets are stand-ins
+    # which the parser can link to its copy of `b`
+    seen_devices: dict[str, DeviceInfo] = {}
+    seen_buckets: dict[str, Bucket] = {}
+    for c in b.children:
+        match c:
+            case Bucket():
+                seen_buckets[c.name] = Bucket(c.name, c.type, c.id, c.alg)
+            case Device():
+                seen_devices["osd." + str(c.info.id)] = c.info
+    try:
+        p.next_line(0, required=False)
+        if p.read_bucket_type(0) != b.type or p.read_word(1) != b.name:
+            return None
+        res, devices = p.parse_bucket_block(
+            b.name, b.type, seen_devices, seen_buckets, {}, set()
         )
+        p.next_line(1)
+    except ParsingError:
+        return None
+    if len(p.tokens) > 0 or (res.id, res.alg) != (b.id, b.alg):
+        return None
+    if _item_ids(res) != _item_ids(b):
+        return None
+    return {d_id: d.weight for d_id, d in devices.items()}
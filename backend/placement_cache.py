@@ -0,0 +1,198 @@
+from parser import AlgType, Bucket, DeviceID_T
+from typing import TypedDict
+
+import numpy as np
+
+from batch import IntArray, Trace, apply_plan_many
+from crush import MappingStats, RulePlan, Tunables
+from hierarchy import NO_PARENT, FlatHierarchy
+from parallel import ParallelMapper
+
+
+class JSONCacheStats(TypedDict):
+    epoch: int
+    hits: int
+    misses: int
+    cached: int
+
+
+class PlacementCache:
+    """
+    Remembers the mapping of every input together with the buckets its descent
+    entered and the items it selected, so that a weight change only remaps
+    the inputs which could possibly be affected by it:
+
+    * a weight decrease can only change the outcome of the descents which
+      selected the device or one of its ancestors,
+    * a weight increase can attract any descent which entered one of the
+      ancestors of the device.
+
+    Both only hold for straw2 buckets, whose children draw independently of
+    each other's weights. The draws of list and tree buckets depend on the
+    running sums and node weights any change of a child shifts, so every
+    descent which entered one of them is remapped.
+    """
+
+    def __init__(
+        self,
+        plan: RulePlan,
+        flat: FlatHierarchy,
+        pool_replicas: int,
+        tunables: Tunables,
+        mapper: ParallelMapper | None = None,
+    ):
+        self.plan = plan
+        self.flat = flat
+        self.pool_replicas = pool_replicas
+        self.tunables = tunables
+        # remaps the misses on a process pool when set
+        self.mapper = mapper
+        # counts the retries of the descents of the misses when set
+        self.mapping_stats: MappingStats | None = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self._results: dict[int, list[DeviceID_T]] = {}
+        # (x, node) pairs of all cached descents, see `batch.Trace`
+        self._entered = _Pairs()
+        self._selected = _Pairs()
+
+        self._epoch = self.epoch
+        self._bucket_epochs = {
+            i: n.epoch for i, n in enumerate(flat.nodes) if isinstance(n, Bucket)
+        }
+        self._weights = flat.weights.copy()
+
+    @property
+    def epoch(self) -> int:
+        return self.plan.root.epoch
+
+    def stats(self) -> JSONCacheStats:
+        return {
+            "epoch": self.epoch,
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached": len(self._results),
+        }
+
+    def map(self, xs: list[int]) -> list[list[DeviceID_T]]:
+        self._invalidate_dirty()
+
+        missing = sorted({x for x in xs if x not in self._results})
+        self.misses += len(missing)
+        self.hits += len(xs) - len(missing)
+        if len(missing) > 0:
+            self._compute(missing)
+        return [self._results[x] for x in xs]
+
+    def invalidate(self, xs: IntArray | None = None) -> None:
+        """Drops the given inputs, or everything"""
+        if xs is None:
+            self._results.clear()
+            self._entered = _Pairs()
+            self._selected = _Pairs()
+            return
+        for x in xs.tolist():
+            self._results.pop(x, None)
+        self._entered.drop(xs)
+        self._selected.drop(xs)
+
+    def _compute(self, xs: list[int]) -> None:
+        trace = Trace()
+        stats = self.mapping_stats
+        if self.mapper is not None:
+            mapping = self.mapper.map(np.array(xs, dtype=np.int64), trace, stats)
+        else:
+            mapping = apply_plan_many(
+                xs,
+                self.plan,
+                self.flat,
+                self.pool_replicas,
+                self.tunables,
+                trace,
+                stats,
+            )
+        assert len(mapping.errors) == 0, next(iter(mapping.errors.values()))
+        for x, row in zip(xs, mapping.osds().tolist()):
+            self._results[x] = [DeviceID_T(d) for d in row if d != -1]
+        self._entered.extend(trace.entered)
+        self._selected.extend(trace.selected)
+
+    def _dirty_devices(self) -> list[int]:
+        # only subtrees whose epoch moved since the last call are walked
+        res: list[int] = []
+        q = list(self.flat.roots)
+        while len(q) > 0:
+            b = q.pop()
+            epoch = self.flat.nodes[b].epoch  # type: ignore
+            if self._bucket_epochs[b] == epoch:
+                continue
+            self._bucket_epochs[b] = epoch
+            for c in self.flat.children_of(b).tolist():
+                if self.flat.is_device(c):
+                    if self.flat.weights[c] != self._weights[c]:
+                        res.append(c)
+                else:
+                    q.append(c)
+        return res
+
+    def _shared_draws(self, b: int) -> bool:
+        return self.flat.alg(b) in (AlgType.list, AlgType.tree)
+
+    def _invalidate_dirty(self) -> None:
+        if self._epoch == self.epoch:
+            return
+        self._epoch = self.epoch
+
+        entered: list[int] = []
+        selected: list[int] = []
+        for d in self._dirty_devices():
+            path = [d]
+            while (p := int(self.flat.parents[path[-1]])) != NO_PARENT:
+                path.append(p)
+
+            if self.flat.weights[d] < self._weights[d]:
+                selected.extend(path)
+                entered.extend(p for p in path[1:] if self._shared_draws(p))
+            else:
+                entered.extend(path[1:])
+            self._weights[d] = self.flat.weights[d]
+
+        if len(entered) == 0 and len(selected) == 0:
+            return
+        dirty = np.union1d(
+            self._entered.touching(np.array(entered, dtype=np.int64)),
+            self._selected.touching(np.array(selected, dtype=np.int64)),
+        )
+        self.invalidate(dirty)
+
+
+class _Pairs:
+    """Append-only (x, node) pairs with vectorized lookup and removal"""
+
+    def __init__(self):
+        self._chunks: list[tuple[IntArray, IntArray]] = []
+        self._x = np.empty(0, dtype=np.int64)
+        self._node = np.empty(0, dtype=np.int64)
+
+    def extend(self, pairs: list[tuple[IntArray, IntArray]]) -> None:
+        self._chunks.extend(pairs)
+
+    def _flush(self) -> None:
+        if len(self._chunks) == 0:
+            return
+        self._x = np.concatenate([self._x] + [x for x, _ in self._chunks])
+        self._node = np.concatenate([self._node] + [n for _, n in self._chunks])
+        self._chunks = []
+
+    def touching(self, nodes: IntArray) -> IntArray:
+        """Inputs paired with any of `nodes`"""
+        self._flush()
+        return np.unique(self._x[np.isin(self._node, nodes)])
+
+    def drop(self, xs: IntArray) -> None:
+        self._flush()
+        keep = ~np.isin(self._x, xs)
+        self._x = self._x[keep]
+        self._node = self._node[keep]
@@ -0,0 +1,417 @@
+"""
+Binary snapshots of parsed maps, loaded instead of parsing the text again.
+
+A snapshot records the SHA-256 of the text it was parsed from and is only
+used for that text: any edit of the map makes it stale and the text is parsed
+instead. The hierarchy is stored the way `FlatHierarchy` lays it out, shadow
+trees included, as little-endian arrays read straight from a memory map:
+
+    header      magic, version, digest of the text, array lengths
+    nodes       ids, types, algs, weights, child offsets, names, classes,
+                primary affinities and the node each shadow node copies
+    order       main tree buckets and devices in the order the map declares
+    blocks      names, sizes and digests, see `parser.MapBlock`
+    strings     offsets and UTF-8 bytes of the names, classes and settings
+
+Rules, choose_args and tunables are a few lines of any map: they are a single
+JSON string of the table.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+from parser import (AlgType, Bucket, BucketID_T, BucketT, ChooseArgs, Device,
+                    DeviceID_T, DeviceInfo, MapBlock, Parser, ParserResult,
+                    Rule, StepChoose, StepEmit, StepT, StepTake, WeightT,
+                    apply_choose_args, paused_gc)
+from typing import Any, BinaryIO
+
+import numpy as np
+import numpy.typing as npt
+
+from hierarchy import NO_PARENT, FlatHierarchy
+
+MAGIC = b"CRUSHMAP"
+# bumped on every change of the layout, older snapshots are stale
+VERSION = 1
+
+# magic, version, digest, then the lengths of the arrays
+_HEADER = struct.Struct("<8sI32s7q")
+
+# (name, dtype, length) of the arrays in file order, the dtypes of the flat
+# hierarchy are `FlatHierarchy`'s
+_ARRAYS: list[tuple[str, str, str]] = [
+    ("ids", "<i4", "nodes"),
+    ("types", "<i1", "nodes"),
+    ("algs", "<i1", "nodes"),
+    ("weights", "<f8", "nodes"),
+    ("child_offsets", "<i4", "offsets"),
+    ("names", "<i4", "nodes"),
+    # device class of the devices of the main tree and of the shadow buckets
+    ("classes", "<i4", "nodes"),
+    ("affinities", "<f8", "nodes"),
+    # node a shadow bucket or device is the copy of
+    ("shadow_of", "<i4", "nodes"),
+    ("bucket_order", "<i4", "buckets"),
+    ("device_order", "<i4", "devices"),
+    ("block_names", "<i4", "blocks"),
+    ("block_sizes", "<i8", "blocks"),
+    ("block_digests", "u1", "digest_bytes"),
+    ("string_offsets", "<i8", "string_offsets"),
+    ("string_bytes", "u1", "string_bytes"),
+]
+
+_TYPES: dict[int, BucketT] = {
+    v: t for t, v in BucketT.BUCKETS_HIERARCHY.items() if t != "osd"  # type: ignore
+}
+_NONE = -1
+
+
+def snapshot_path(path: str) -> str:
+    """Where the snapshot of the map at `path` is written"""
+    return path + ".snap"
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class _Strings:
+    def __init__(self) -> None:
+        self.index: dict[str, int] = {}
+
+    def add(self, s: str | None) -> int:
+        if s is None:
+            return _NONE
+        return self.index.setdefault(s, len(self.index))
+
+
+def _step_to_json(s: StepT) -> list[Any]:
+    match s:
+        case StepTake():
+            return ["take", s.name, s.device_class]
+        case StepChoose():
+            return ["choose", s.is_chooseleaf, s.n, s.bucket_type, s.is_indep]
+        case StepEmit():
+            return ["emit"]
+
+
+def _step_from_json(s: list[Any]) -> StepT:
+    match s:
+        case ["take", name, device_class]:
+            return StepTake(name, device_class)
+        case ["choose", is_chooseleaf, n, bucket_type, is_indep]:
+            t = "osd" if bucket_type == "osd" else BucketT(bucket_type)
+            return StepChoose(is_chooseleaf, n, t, is_indep)
+        case _:
+            return StepEmit()
+
+
+def _settings_to_json(r: ParserResult) -> str:
+    rules = [
+        [rule.name, rule.id, rule.min_size, rule.max_size, rule.type]
+        + [[_step_to_json(s) for s in rule.rules]]
+        for rule in r.rules
+    ]
+    # JSON keys are strings, keep the ids as numbers
+    choose_args = [
+        [args_id, [[b, ws] for b, ws in args.items()]]
+        for args_id, args in r.choose_args.items()
+    ]
+    return json.dumps([rules, choose_args, r.tunables])
+
+
+def _settings_from_json(
+    s: str,
+) -> tuple[list[Rule], dict[int, ChooseArgs], dict[str, int]]:
+    rules, choose_args, tunables = json.loads(s)
+    return (
+        [
+            Rule(name, id, min_size, max_size, [_step_from_json(s) for s in steps], t)
+            for name, id, min_size, max_size, t, steps in rules
+        ],
+        {
+            args_id: {BucketID_T(b): ws for b, ws in args}
+            for args_id, args in choose_args
+        },
+        tunables,
+    )
+
+
+def write_snapshot(
+    r: ParserResult, flat: FlatHierarchy, digest: bytes, f: BinaryIO
+) -> None:
+    """
+    Writes the snapshot of `r`, which must be fresh from the parser: the
+    weights of the tree are the ones stored. `flat` is its flat hierarchy and
+    `digest` the SHA-256 of the text
+    """
+    strings = _Strings()
+    names = [_NONE] * len(flat)
+    classes = [_NONE] * len(flat)
+    affinities = [0.0] * len(flat)
+    shadow_of = [_NONE] * len(flat)
+    for i, n in enumerate(flat.nodes):
+        match n:
+            case Bucket():
+                names[i] = strings.add(n.name)
+                for device_class, s in n._shadows.items():
+                    shadow = flat.node_of(s)
+                    classes[shadow] = strings.add(device_class)
+                    shadow_of[shadow] = i
+            case Device() if i == flat.index_of[n.info.id]:
+                classes[i] = strings.add(n.info.device_class)
+                affinities[i] = n.info.primary_affinity
+                if n._shadow is not None:
+                    shadow_of[flat.node_of(n._shadow)] = i
+
+    arrays: dict[str, Any] = {
+        "ids": flat.ids,
+        "types": flat.types,
+        "algs": flat.algs,
+        "weights": flat.weights,
+        "child_offsets": flat.child_offsets,
+        "names": names,
+        "classes": classes,
+        "affinities": affinities,
+        "shadow_of": shadow_of,
+        "bucket_order": [flat.node_of(b) for b in r.buckets.values()],
+        "device_order": [flat.index_of[d] for d in r.devices],
+        "block_names": [strings.add(b.name) for b in r.blocks],
+        "block_sizes": [b.size for b in r.blocks],
+        "block_digests": b"".join(b.digest for b in r.blocks),
+    }
+    # the settings are the last string
+    strings.add(_settings_to_json(r))
+    encoded = [s.encode() for s in strings.index]
+    string_offsets = [0]
+    for s in encoded:
+        string_offsets.append(string_offsets[-1] + len(s))
+    arrays["string_offsets"] = string_offsets
+    arrays["string_bytes"] = b"".join(encoded)
+
+    f.write(
+        _HEADER.pack(
+            MAGIC,
+            VERSION,
+            digest,
+            len(flat),
+            len(flat.roots),
+            len(r.buckets),
+            len(r.devices),
+            len(r.blocks),
+            len(encoded),
+            string_offsets[-1],
+        )
+    )
+    pos = _HEADER.size
+    for name, dtype, _ in _ARRAYS:
+        f.write(b"\0" * (_align(pos) - pos))
+        pos = _align(pos)
+        a = arrays[name]
+        data = a if isinstance(a, bytes) else np.asarray(a, dtype=dtype).tobytes()
+        f.write(data)
+        pos += len(data)
+
+
+def _read_arrays(buf: mmap.mmap, digest: bytes) -> dict[str, Any] | None:
+    """
+    Copies of the arrays of the snapshot, bytes for the `u1` ones. None when
+    the snapshot is stale or truncated
+    """
+    if len(buf) < _HEADER.size:
+        return None
+    magic, version, snapshot_digest, *lengths = _HEADER.unpack_from(buf)
+    if (magic, version, snapshot_digest) != (MAGIC, VERSION, digest):
+        return None
+    nodes, roots, buckets, devices, blocks, strings, string_bytes = lengths
+    counts = {
+        "nodes": nodes,
+        "offsets": nodes + 1,
+        "buckets": buckets,
+        "devices": devices,
+        "blocks": blocks,
+        "digest_bytes": 32 * blocks,
+        "string_offsets": strings + 1,
+        "string_bytes": string_bytes,
+    }
+
+    spans: list[tuple[str, str, int, int]] = []
+    pos = _HEADER.size
+    for name, dtype, length in _ARRAYS:
+        pos = _align(pos)
+        spans.append((name, dtype, counts[length], pos))
+        pos += counts[length] * np.dtype(dtype).itemsize
+    if pos > len(buf):
+        return None
+
+    res: dict[str, Any] = {"roots": roots}
+    for name, dtype, count, pos in spans:
+        a: npt.NDArray[Any] = np.frombuffer(buf, dtype, count, pos)
+        # the views must be let go of before the map is closed
+        res[name] = a.tobytes() if dtype == "u1" else a.copy()
+    return res
+
+
+def read_snapshot(
+    path: str, digest: bytes, attach: bool = True
+) -> tuple[ParserResult, FlatHierarchy] | None:
+    """
+    What the map with SHA-256 `digest` parses into and its flat hierarchy,
+    see `FlatHierarchy.from_root` for `attach`. None when the snapshot at
+    `path` is missing, stale or from another version of the format
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                a = _read_arrays(buf, digest)
+    except OSError:
+        return None
+    if a is None:
+        return None
+
+    with paused_gc():
+        return _load(a, attach)
+
+
+def _load(a: dict[str, Any], attach: bool) -> tuple[ParserResult, FlatHierarchy]:
+    raw, offsets = a["string_bytes"], a["string_offsets"].tolist()
+    strings = [raw[i:j].decode() for i, j in zip(offsets, offsets[1:])]
+    rules, choose_args, tunables = _settings_from_json(strings[-1])
+
+    # BFS order: the children of a node are the nodes after the roots, in
+    # order, and each node comes after its parent
+    roots: int = a["roots"]
+    child_offsets: npt.NDArray[np.int32] = a["child_offsets"]
+    n = len(a["ids"])
+    parents = np.full(n, NO_PARENT, dtype=np.int32)
+    parents[roots:] = np.repeat(np.arange(n, dtype=np.int32), np.diff(child_offsets))
+
+    shadow_of = a["shadow_of"].tolist()
+    classes = a["classes"].tolist()
+    nodes: list[Bucket | Device] = []
+    for i, (item, t, alg, w, p, name, c, affinity) in enumerate(
+        zip(
+            a["ids"].tolist(),
+            a["types"].tolist(),
+            a["algs"].tolist(),
+            a["weights"].tolist(),
+            parents.tolist(),
+            a["names"].tolist(),
+            classes,
+            a["affinities"].tolist(),
+        )
+    ):
+        parent: Bucket | None = nodes[p] if p != NO_PARENT else None  # type: ignore
+        if item >= 0:
+            assert parent is not None
+            if (o := shadow_of[i]) != _NONE:
+                info = nodes[o].info  # type: ignore
+            else:
+                device_class = strings[c] if c != _NONE else None
+                info = DeviceInfo(DeviceID_T(item), device_class, affinity)
+            node: Bucket | Device = Device(info, WeightT(w), parent)
+        else:
+            node = Bucket(strings[name], _TYPES[t], BucketID_T(item), AlgType(alg), w)
+            node._parent = parent
+        if parent is not None:
+            parent.children.append(node)
+        nodes.append(node)
+
+    for i in np.flatnonzero(a["shadow_of"] != _NONE).tolist():
+        match original := nodes[shadow_of[i]]:
+            case Bucket():
+                original._shadows[strings[classes[i]]] = nodes[i]  # type: ignore
+            case Device():
+                original._shadow = nodes[i]  # type: ignore
+
+    root: Bucket = nodes[0]  # type: ignore
+    if len(choose_args) > 0:
+        apply_choose_args(root, choose_args[min(choose_args)])
+
+    devices: dict[DeviceID_T, Device] = {
+        nodes[i].info.id: nodes[i] for i in a["device_order"].tolist()  # type: ignore
+    }
+    digests = a["block_digests"]
+    result = ParserResult(
+        root,
+        devices,
+        rules,
+        choose_args,
+        tunables,
+        {d_id: d.weight for d_id, d in devices.items()},
+        {nodes[i].name: nodes[i] for i in a["bucket_order"].tolist()},  # type: ignore
+        [
+            MapBlock(strings[name], size, digests[32 * i : 32 * (i + 1)])
+            for i, (name, size) in enumerate(
+                zip(a["block_names"].tolist(), a["block_sizes"].tolist())
+            )
+        ],
+    )
+
+    ids = a["ids"]
+    index_of: dict[int, int] = {}
+    for i, item in enumerate(ids.tolist()):
+        index_of.setdefault(item, i)
+    weights = a["weights"]
+    flat = FlatHierarchy(
+        ids=ids,
+        types=a["types"],
+        algs=a["algs"],
+        weights=weights,
+        fixed_weights=(weights * 0x10000).astype(np.int64),
+        parents=parents,
+        child_offsets=child_offsets,
+        children=np.arange(roots, n, dtype=np.int32),
+        nodes=nodes,
+        index_of=index_of,
+        _node_of={id(n): i for i, n in enumerate(nodes)},
+        roots=list(range(roots)),
+    )
+    flat.sync_weight_sets()
+    if attach:
+        for i, n in enumerate(nodes):
+            if isinstance(n, Device):
+                n._flat = flat  # type: ignore (FlatHierarchy is a friend of Device)
+                n._flat_index = i  # type: ignore
+    return result, flat
+
+
+def save_snapshot(
+    r: ParserResult, flat: FlatHierarchy, digest: bytes, path: str
+) -> None:
+    """
+    `write_snapshot` to `path` through a temporary file, readers never see a
+    partial snapshot. A snapshot which can't be written is skipped
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp, "wb") as f:
+            write_snapshot(r, flat, digest, f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def load_map(path: str, attach: bool = True) -> tuple[ParserResult, FlatHierarchy]:
+    """
+    Parses the map at `path` through its snapshot when it is up to date,
+    writes the snapshot when it isn't
+    """
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").digest()
+    if (res := read_snapshot(snapshot_path(path), digest, attach)) is not None:
+        return res
+    with open(path) as f:
+        r = Parser(f).parse()
+    flat = FlatHierarchy.from_parser_result(r, attach)
+    save_snapshot(r, flat, digest, snapshot_path(path))
+    return r, flat
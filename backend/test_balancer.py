@@ -0,0 +1,47 @@
+from pathlib import Path
+from parser import BucketT, Parser
+
+from balancer import apply_upmap_items, calc_pg_upmaps
+from batch import BatchResult, apply_plan_many
+from crush import Tunables, compile_rule
+from hierarchy import NO_PARENT, FlatHierarchy
+
+MAPS = Path(__file__).with_name("maps")
+
+
+def _ancestor(flat: FlatHierarchy, node: int, bucket_type: str) -> int:
+    level = BucketT.BUCKETS_HIERARCHY[bucket_type]  # type: ignore
+    while flat.types[node] != level:
+        node = int(flat.parents[node])
+        assert node != NO_PARENT
+    return node
+
+
+def test_upmaps_keep_failure_domains() -> None:
+    r = Parser((MAPS / "reweighted_map").read_text()).parse()
+    flat = FlatHierarchy.from_parser_result(r)
+    xs = list(range(4096))
+    for rule in r.rules:
+        plan = compile_rule(r.root, rule)
+        raw = apply_plan_many(xs, plan, flat, 3, Tunables(50))
+        res = calc_pg_upmaps(plan, flat, xs, raw.nodes, 1.0)
+        assert res.moves > 0
+        assert res.deviation_after < res.deviation_before
+        if rule.type == "replicated":
+            assert res.deviation_after <= 1.0
+
+        before = raw.osds().tolist()
+        after = BatchResult(flat, res.nodes, {}).osds().tolist()
+        for x, raw_row, row, nodes, raw_nodes in zip(
+            xs, before, after, res.nodes.tolist(), raw.nodes.tolist()
+        ):
+            # the upmaps give the balanced mapping back on top of CRUSH
+            items = res.items.get(x, [])
+            assert apply_upmap_items(raw_row, items, r.devices) == row
+            # one replica per host, and indep replicas stay in their rack
+            hosts = [_ancestor(flat, n, "host") for n in nodes if n >= 0]
+            assert len(set(hosts)) == len(hosts)
+            if rule.type == "erasure":
+                assert [_ancestor(flat, n, "rack") for n in nodes] == [
+                    _ancestor(flat, n, "rack") for n in raw_nodes
+                ]
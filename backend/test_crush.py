@@ -0,0 +1,100 @@
+from pathlib import Path
+from parser import Parser
+
+import pytest
+
+from batch import apply_plan_many
+from crush import TUNABLE_PROFILES, Device, Tunables, apply_plan, compile_rule
+from hierarchy import FlatHierarchy
+
+MAPS = Path(__file__).with_name("maps")
+
+
+def _golden(name: str) -> list[list[int]]:
+    lines = (MAPS / f"{name}.mappings").read_text().splitlines()
+    return [[int(d) for d in line.split("[")[1][:-1].split(",") if d] for line in lines]
+
+
+def test_chooseleaf_without_descend_once() -> None:
+    # hosts of mostly out devices and 2 tries: the leaf choose runs out of tries
+    # often, which must retry the host rather than leave the replica out
+    r = Parser((MAPS / "descend_once_map").read_text()).parse()
+    plan = compile_rule(r.root, r.rules[0])
+    tunables = Tunables.from_parser_result(r, 50)
+    assert tunables.chooseleaf_descend_once == 0
+    expected = _golden("descend_once_map")
+
+    scalar = []
+    for x in range(len(expected)):
+        res = apply_plan(x, plan, 3, tunables)
+        assert not isinstance(res, str)
+        scalar.append([d.info.id for d in res if isinstance(d, Device)])
+    assert scalar == expected
+
+    flat = FlatHierarchy.from_parser_result(r)
+    res = apply_plan_many(range(len(expected)), plan, flat, 3, tunables)
+    assert [[d for d in row if d != -1] for row in res.osds().tolist()] == expected
+
+
+# a take of the hdd shadow tree, next to the rules of the map
+CLASS_RULE = """
+rule hdd {
+    id 2
+    type replicated
+    step take default class hdd
+    step choose firstn 0 type rack
+    step chooseleaf firstn 1 type host
+    step emit
+}
+"""
+
+
+@pytest.mark.parametrize("profile", [None, *TUNABLE_PROFILES])
+def test_batch_matches_scalar(profile: str | None) -> None:
+    # reweighted_map has uniform, list, tree and straw2 buckets, fractional
+    # weights and an indep rule
+    r = Parser((MAPS / "reweighted_map").read_text() + CLASS_RULE).parse()
+    flat = FlatHierarchy.from_parser_result(r)
+    if profile is None:
+        tunables = Tunables.from_parser_result(r, 50)
+    else:
+        tunables = TUNABLE_PROFILES[profile]
+    xs = range(512)
+    assert len(r.rules) == 3
+    for rule in r.rules:
+        plan = compile_rule(r.root, rule)
+        batch = apply_plan_many(xs, plan, flat, 3, tunables).to_list()
+        assert batch == [apply_plan(x, plan, 3, tunables) for x in xs], rule.name
+
+
+def test_tree_bucket_without_weight() -> None:
+    # a failed host: every draw of its tree walks right, to a padding leaf when
+    # the children are not a power of two
+    text = (MAPS / "reweighted_map").read_text()
+    host = text[text.index("host host-2 {") :]
+    host = host[: host.index("}") + 1]
+    assert "alg tree" in host
+    text = text.replace(
+        host,
+        "host host-2 {\n    id -3\n    alg tree\n"
+        + "".join(f"    item osd.{d} weight 0.00\n" for d in (8, 9, 10))
+        + "}",
+    )
+    text = text.replace("id -8\n    alg straw2", "id -8\n    alg uniform")
+    r = Parser(text).parse()
+    flat = FlatHierarchy.from_parser_result(r)
+    tunables = Tunables(50)
+
+    b = r.buckets["host-2"]
+    assert b.choose(1, 0, 0) is b.children[0]
+    xs = range(512)
+    for rule in r.rules:
+        plan = compile_rule(r.root, rule)
+        batch = apply_plan_many(xs, plan, flat, 3, tunables).to_list()
+        assert batch == [apply_plan(x, plan, 3, tunables) for x in xs]
+        # the rack still places replicas on host-3
+        assert any(
+            isinstance(d, Device) and d.info.id in (12, 13, 14, 15)
+            for res in batch
+            for d in res
+        )
@@ -0,0 +1,50 @@
+import hashlib
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+from snapshot import read_snapshot, snapshot_path
+
+HERE = Path(__file__).parent
+MAPS = HERE / "maps"
+
+
+def _mappings(path: Path) -> str:
+    # the check documented in crushtool.py
+    return "".join(
+        subprocess.run(
+            [
+                sys.executable,
+                str(HERE / "crushtool.py"),
+                str(path),
+                "--rule",
+                str(rule),
+                "--num-rep",
+                "3",
+                "--max-x",
+                "1023",
+                "--no-statistics",
+                "--no-utilization",
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        for rule in (0, 1)
+    )
+
+
+def test_reweighted_map_mappings(tmp_path: Path) -> None:
+    expected = (MAPS / "reweighted_map.mappings").read_text()
+    path = tmp_path / "reweighted_map"
+    shutil.copy(MAPS / "reweighted_map", path)
+    snap = snapshot_path(str(path))
+
+    # parsed from the text, which writes the snapshot
+    assert _mappings(path) == expected
+    digest = hashlib.sha256(path.read_bytes()).digest()
+    assert read_snapshot(snap, digest) is not None
+
+    # loaded from the snapshot
+    assert _mappings(path) == expected
@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+
+from hashing import (
+    crush_hash32_3,
+    crush_hash32_3_many,
+    crush_hash32_4,
+    crush_hash32_4_many,
+    crush_hash_2,
+    crush_hash_2_many,
+    crush_ln,
+    crush_ln_lookup,
+    crush_ln_many,
+)
+
+EDGES = [0, 1, 0xFFFF, 0x10000, 0x18000, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF]
+
+
+def _inputs(arity: int) -> list[tuple[int, ...]]:
+    rng = random.Random(42)
+    values = [tuple(rng.getrandbits(32) for _ in range(arity)) for _ in range(2000)]
+    values += [(e,) * arity for e in EDGES]
+    values += [tuple(rng.choice(EDGES) for _ in range(arity)) for _ in range(200)]
+    return values
+
+
+def _check(scalar, many, arity: int) -> None:
+    values = _inputs(arity)
+    got = many(*(np.array(col, dtype=np.int64) for col in zip(*values)))
+    assert got.dtype == np.uint32
+    assert got.tolist() == [scalar(*v) for v in values]
+
+
+def test_hash_2_many() -> None:
+    _check(crush_hash_2, crush_hash_2_many, 2)
+
+
+def test_hash32_3_many() -> None:
+    _check(crush_hash32_3, crush_hash32_3_many, 3)
+
+
+def test_hash32_4_many() -> None:
+    _check(crush_hash32_4, crush_hash32_4_many, 4)
+
+
+def test_hash_many_negative_ids() -> None:
+    # bucket ids are negative and hashed as __u32
+    ids = list(range(-20, 0))
+    got = crush_hash32_3_many(7, ids, 3).tolist()
+    assert got == [crush_hash32_3(7, i & 0xFFFFFFFF, 3) for i in ids]
+
+
+def test_ln_many() -> None:
+    # crush_ln only sees 16 bits of the hash, so this covers every input
+    u = np.arange(0x10000)
+    expected = [crush_ln(int(x)) for x in u]
+    assert crush_ln_many(u).tolist() == expected
+    assert [crush_ln_lookup(int(x)) for x in u] == expected
+
+
+def test_ln_many_masked_edges() -> None:
+    hashes = [0, 0xFFFFFFFF, 0x10000, 0x18000, 0x1FFFF, 0xFFFF0000]
+    u = [h & 0xFFFF for h in hashes]
+    assert crush_ln_many(u).tolist() == [crush_ln(x) for x in u]
@@ -0,0 +1,74 @@
+import os
+from pathlib import Path
+from parser import Parser
+
+from batch import apply_plan_many
+from crush import RulePlan, Tunables, compile_rule
+from hierarchy import FlatHierarchy
+from map_cache import MapCache
+
+MAPS = Path(__file__).with_name("maps")
+
+
+def _texts(n: int) -> list[str]:
+    # the same map with different weights
+    text = (MAPS / "reweighted_map").read_text()
+    return [
+        text.replace("item osd.0 weight 1.00", f"item osd.0 weight {i + 2}.00")
+        for i in range(n)
+    ]
+
+
+def _mappings(plan: RulePlan, flat: FlatHierarchy) -> list[list[int]]:
+    return apply_plan_many(range(1024), plan, flat, 3, Tunables(50)).osds().tolist()
+
+
+def test_copies_do_not_share_weights() -> None:
+    text = (MAPS / "reweighted_map").read_text()
+    cache = MapCache()
+    a = cache.get(text)
+    b = cache.get(text)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a session marks devices out of its copy only
+    out = (0, 5, 17)
+    for d in out:
+        a.result.devices[d].update_weight(0.0)
+    assert all(b.result.devices[d].weight > 0 for d in out)
+    assert b.result.root.weight != a.result.root.weight
+    assert (b.flat.weights != a.flat.weights).any()
+
+    fresh = Parser(text).parse()
+    flat = FlatHierarchy.from_parser_result(fresh)
+    plan = compile_rule(fresh.root, fresh.rules[0])
+    expected = _mappings(plan, flat)
+    assert _mappings(b.plan(), b.flat) == expected
+    c = cache.get(text)
+    assert _mappings(c.plan(), c.flat) == expected
+    for d in out:
+        fresh.devices[d].update_weight(0.0)
+    assert _mappings(a.plan(), a.flat) == _mappings(plan, flat) != expected
+
+
+def test_snapshot_directory_is_capped(tmp_path: Path) -> None:
+    texts = _texts(4)
+    MapCache(snapshots=str(tmp_path)).get(texts[0])
+    (snap,) = tmp_path.iterdir()
+    size = snap.stat().st_size
+
+    # room for two snapshots
+    cache = MapCache(snapshots=str(tmp_path), max_snapshot_bytes=2 * size + size // 2)
+    cache.get(texts[1])
+    # loading a snapshot makes it the most recently used one
+    cache.get(texts[0])
+    assert cache.snapshot_loads == 1
+    cache.get(texts[2])
+    cache.get(texts[3])
+    assert len(os.listdir(tmp_path)) == 2
+
+    # texts[0] and texts[1] were the least recently used
+    restarted = MapCache(snapshots=str(tmp_path))
+    for text in texts:
+        restarted.get(text)
+    assert restarted.snapshot_loads == 2
+    assert restarted.misses == 4
@@ -0,0 +1,66 @@
+from pathlib import Path
+from parser import Parser, ParserResult
+
+from batch import apply_plan_many
+from crush import Tunables, compile_rule
+from hierarchy import FlatHierarchy
+
+MAPS = Path(__file__).with_name("maps")
+
+
+def _mappings(r: ParserResult) -> list[list[list[int]]]:
+    flat = FlatHierarchy.from_parser_result(r)
+    return [
+        apply_plan_many(
+            range(1024), compile_rule(r.root, rule), flat, 3, Tunables(50)
+        )
+        .osds()
+        .tolist()
+        for rule in r.rules
+    ]
+
+
+def test_reweight_matches_fresh_parse() -> None:
+    text = (MAPS / "reweighted_map").read_text()
+    edited = (
+        text.replace("item osd.1 weight 0.25", "item osd.1 weight 1.00")
+        .replace("item osd.9 weight 0.90", "item osd.9 weight 0.00")
+        .replace("item osd.23 weight 0.75", "item osd.23 weight 2.50")
+    )
+    previous = Parser(text).parse()
+    parser = Parser(edited, previous)
+    r = parser.parse()
+    fresh = Parser(edited).parse()
+
+    # reweighted in place
+    assert r.root is previous.root
+    assert parser.diff is not None
+    assert parser.diff.reweighted_devices == {
+        1: (0.25, 1.0),
+        9: (0.9, 0.0),
+        23: (0.75, 2.5),
+    }
+    assert r.weights == fresh.weights
+    assert {d: r.devices[d].weight for d in r.devices} == {
+        d: fresh.devices[d].weight for d in fresh.devices
+    }
+    assert r.blocks == fresh.blocks
+    assert _mappings(r) == _mappings(fresh)
+
+
+def test_reweight_falls_back_to_parse() -> None:
+    text = (MAPS / "reweighted_map").read_text()
+    # an item moves: not a weight-only edit
+    edited = text.replace("    item osd.3 weight 0.50\n", "").replace(
+        "    item osd.7 weight 0.00\n",
+        "    item osd.7 weight 0.00\n    item osd.3 weight 0.50\n",
+    )
+    previous = Parser(text).parse()
+    parser = Parser(edited, previous)
+    r = parser.parse()
+    fresh = Parser(edited).parse()
+
+    assert r.root is not previous.root
+    assert parser.diff is not None and parser.diff.reweighted_buckets != []
+    assert r.blocks == fresh.blocks
+    assert _mappings(r) == _mappings(fresh)
@@ -0,0 +1,64 @@
+from pathlib import Path
+from parser import Parser, ParserResult
+
+from batch import apply_plan_many
+from crush import Tunables, compile_rule
+from hierarchy import FlatHierarchy
+from placement_cache import PlacementCache
+
+MAPS = Path(__file__).with_name("maps")
+XS = list(range(4096))
+
+
+def _cache(r: ParserResult, rule: int) -> PlacementCache:
+    flat = FlatHierarchy.from_parser_result(r)
+    plan = compile_rule(r.root, r.rules[rule])
+    return PlacementCache(plan, flat, 3, Tunables.from_parser_result(r, 50))
+
+
+def _fresh(cache: PlacementCache) -> list[list[int]]:
+    res = apply_plan_many(
+        XS, cache.plan, cache.flat, cache.pool_replicas, cache.tunables
+    )
+    return [[d for d in row if d != -1] for row in res.osds().tolist()]
+
+
+def test_cache_follows_weight_changes() -> None:
+    for rule in (0, 1):
+        r = Parser((MAPS / "reweighted_map").read_text()).parse()
+        cache = _cache(r, rule)
+        assert cache.map(XS) == _fresh(cache)
+        # devices of the straw2 hosts: out, partly back, heavier than before
+        for d_id, w in [(0, 0.0), (17, 0.0), (0, 0.5), (19, 1.0), (17, 1.0)]:
+            r.devices[d_id].update_weight(w)
+            misses = cache.misses
+            assert cache.map(XS) == _fresh(cache), (rule, d_id, w)
+            assert cache.misses > misses
+
+
+def test_cache_follows_decreases_under_list_and_tree_buckets() -> None:
+    # a decrease shifts the draws of the siblings in list and tree buckets
+    text = (MAPS / "reweighted_map").read_text()
+    for alg in ("list", "tree"):
+        root = text.replace("id -10\n    alg straw2", f"id -10\n    alg {alg}")
+        assert root != text
+        for rule in (0, 1):
+            r = Parser(root).parse()
+            cache = _cache(r, rule)
+            cache.map(XS)
+            for d_id, w in [(0, 0.0), (17, 0.5), (5, 0.0)]:
+                r.devices[d_id].update_weight(w)
+                assert cache.map(XS) == _fresh(cache), (alg, rule, d_id, w)
+
+
+def test_cache_hits_without_changes() -> None:
+    r = Parser((MAPS / "reweighted_map").read_text()).parse()
+    cache = _cache(r, 0)
+    cache.map(XS)
+    cache.map(XS[:100])
+    assert cache.stats() == {
+        "epoch": cache.epoch,
+        "hits": 100,
+        "misses": len(XS),
+        "cached": len(XS),
+    }
@@ -0,0 +1,94 @@
+import hashlib
+from pathlib import Path
+from parser import Parser, ParserResult
+
+from batch import apply_plan_many
+from crush import Tunables, apply_plan, compile_rule
+from hierarchy import FlatHierarchy
+from snapshot import read_snapshot, save_snapshot
+
+MAPS = Path(__file__).with_name("maps")
+
+# straw2 weight sets of the first host, rack and the root
+CHOOSE_ARGS = """
+choose_args 0 {
+  {
+    bucket_id -1
+    weight_set [
+      [ 0.8 0.35 0.0 0.7 ]
+      [ 1.0 0.25 0.0 0.5 ]
+    ]
+  }
+  {
+    bucket_id -7
+    weight_set [
+      [ 1.9 2.0 ]
+    ]
+  }
+  {
+    bucket_id -10
+    weight_set [
+      [ 3.0 4.0 2.5 ]
+    ]
+  }
+}
+"""
+
+
+def _mappings(r: ParserResult, flat: FlatHierarchy) -> list[list[list[int]]]:
+    tunables = Tunables.from_parser_result(r, 50)
+    return [
+        apply_plan_many(range(1024), compile_rule(r.root, rule), flat, 3, tunables)
+        .osds()
+        .tolist()
+        for rule in r.rules
+    ]
+
+
+def _round_trip(text: str, tmp_path: Path) -> None:
+    r = Parser(text).parse()
+    flat = FlatHierarchy.from_parser_result(r)
+    digest = hashlib.sha256(text.encode()).digest()
+    path = str(tmp_path / "map.snap")
+    save_snapshot(r, flat, digest, path)
+
+    loaded = read_snapshot(path, digest)
+    assert loaded is not None
+    r2, flat2 = loaded
+    assert r2.weights == r.weights
+    assert r2.tunables == r.tunables
+    assert r2.choose_args == r.choose_args
+    assert r2.rules == r.rules
+    assert r2.blocks == r.blocks
+    assert sorted(r2.buckets) == sorted(r.buckets)
+    assert _mappings(r2, flat2) == _mappings(r, flat)
+    rebuilt = FlatHierarchy.from_parser_result(r2, attach=False)
+    assert _mappings(r2, rebuilt) == _mappings(r, flat)
+    tunables = Tunables.from_parser_result(r2, 50)
+    for rule in r2.rules:
+        plan = compile_rule(r2.root, rule)
+        assert [apply_plan(x, plan, 3, tunables) for x in range(256)] == (
+            apply_plan_many(range(256), plan, flat2, 3, tunables).to_list()
+        )
+
+    # the loaded devices keep their flat hierarchy in sync
+    r2.devices[0].update_weight(0.0)
+    r.devices[0].update_weight(0.0)
+    assert _mappings(r2, flat2) == _mappings(r, flat)
+
+    # another map, or another version of the format
+    assert read_snapshot(path, hashlib.sha256(b"other").digest()) is None
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    assert read_snapshot(path, digest) is None
+
+
+def test_round_trip(tmp_path: Path) -> None:
+    for name in ("reweighted_map", "descend_once_map", "default_map"):
+        _round_trip((MAPS / name).read_text(), tmp_path)
+
+
+def test_round_trip_weight_sets(tmp_path: Path) -> None:
+    text = (MAPS / "reweighted_map").read_text() + CHOOSE_ARGS
+    assert len(Parser(text).parse().choose_args) == 1
+    _round_trip(text, tmp_path)
@@ -0,0 +1,189 @@
+"""
+Fits `choose_args` weight sets of straw2 buckets so that every item of the
+hierarchy receives its weight share of the placements, the way Ceph's
+crush-compat balancer does. Unlike upmaps the result is part of the map and
+keeps working for inputs it wasn't fitted on.
+"""
+
+from dataclasses import dataclass
+from parser import (AlgType, Bucket, BucketID_T, ChooseArgs, WeightT,
+                    apply_choose_args)
+
+import numpy as np
+import numpy.typing as npt
+
+from batch import IntArray, apply_plan_many
+from crush import RulePlan, Tunables
+from hierarchy import NO_PARENT, FlatHierarchy
+
+FloatArray = npt.NDArray[np.float64]
+
+# smallest 16.16 weight, items with a positive weight must stay selectable
+_MIN_WEIGHT = 1 / 0x10000
+
+
+@dataclass
+class FitResult:
+    choose_args: ChooseArgs
+    # max |placements - expected placements| over the devices, before and after
+    deviation_before: float
+    deviation_after: float
+    iterations: int
+
+
+def _fixed(w: float) -> WeightT:
+    # weights on the 16.16 grid survive `format_choose_args` exactly
+    return WeightT(round(w * 0x10000) / 0x10000)
+
+
+def _format_weight(w: float) -> str:
+    s = f"{w:.16f}".rstrip("0")
+    return s + "0" if s.endswith(".") else s
+
+
+def format_choose_args(args_id: int, args: ChooseArgs) -> str:
+    """`choose_args` block as accepted by the parser"""
+    lines = [f"choose_args {args_id} {{"]
+    for bucket_id, weight_set in sorted(args.items(), reverse=True):
+        lines += ["  {", f"    bucket_id {bucket_id}", "    weight_set ["]
+        for weights in weight_set:
+            lines.append(f"      [ {' '.join(_format_weight(w) for w in weights)} ]")
+        lines += ["    ]", "  }"]
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _placements(
+    flat: FlatHierarchy, nodes: IntArray, positions: int, candidates: IntArray
+) -> tuple[FloatArray, FloatArray]:
+    """
+    (positions, len(flat)) placements of every node, buckets count the
+    placements of their subtree, and the placements the weights of the
+    `candidates` devices call for
+    """
+    counts = np.zeros((positions, len(flat)), dtype=np.float64)
+    for j in range(nodes.shape[1]):
+        column = nodes[:, j]
+        placed = column[column >= 0]
+        counts[min(j, positions - 1)] += np.bincount(placed, minlength=len(flat))
+
+    weights = np.zeros(len(flat), dtype=np.float64)
+    weights[candidates] = np.maximum(flat.weights[candidates], 0)
+    expected = np.zeros_like(counts)
+    if (total := weights.sum()) > 0:
+        placed = counts[:, flat.ids >= 0].sum(axis=1)
+        expected = placed[:, None] * weights[None, :] / total
+
+    # BFS order: children come after their parents
+    for i in range(len(flat) - 1, 0, -1):
+        if (parent := flat.parents[i]) == NO_PARENT:
+            continue
+        counts[:, parent] += counts[:, i]
+        expected[:, parent] += expected[:, i]
+    return counts, expected
+
+
+def _max_deviation(
+    flat: FlatHierarchy, counts: FloatArray, expected: FloatArray
+) -> float:
+    devices = flat.ids >= 0
+    diff = counts.sum(axis=0)[devices] - expected.sum(axis=0)[devices]
+    return float(np.abs(diff).max(initial=0))
+
+
+def fit_weight_sets(
+    plan: RulePlan,
+    flat: FlatHierarchy,
+    xs: range | list[int],
+    pool_replicas: int,
+    tunables: Tunables,
+    positions: int = 1,
+    iterations: int = 20,
+    step: float = 0.5,
+) -> FitResult:
+    """
+    Maps `xs` and scales the weight of every child of a straw2 bucket by
+    (expected / actual placements) ** `step`, `iterations` times, keeping the
+    best weight sets seen. Straw2 buckets get the sum of their children's
+    weights in their parent's set, other buckets are scaled as a whole.
+
+    With `positions` > 1 the i-th result of a mapping is fitted in the i-th
+    vector, which is exact for rules made of a single choose step.
+
+    The hierarchy keeps its weight sets, the fitted ones are returned for
+    `apply_choose_args`.
+    """
+    straw2 = [
+        i
+        for i, n in enumerate(flat.nodes)
+        if isinstance(n, Bucket) and n.alg == AlgType.straw2
+    ]
+    original: dict[int, list[list[WeightT]] | None] = {
+        i: flat.nodes[i].weight_set for i in straw2  # type: ignore
+    }
+
+    # node -> (positions,) weight in its parent's set, for children of straw2
+    # buckets
+    entry = np.zeros((positions, len(flat)), dtype=np.float64)
+    for b in straw2:
+        bucket: Bucket = flat.nodes[b]  # type: ignore
+        children = flat.children_of(b)
+        for p in range(positions):
+            if bucket.weight_set is None:
+                entry[p, children] = flat.weights[children]
+            else:
+                ws = bucket.weight_set[min(p, len(bucket.weight_set) - 1)]
+                entry[p, children] = ws
+
+    def args_of(entry: FloatArray) -> ChooseArgs:
+        res: ChooseArgs = {}
+        for b in straw2:
+            children = flat.children_of(b)
+            res[BucketID_T(int(flat.ids[b]))] = [
+                [_fixed(w) for w in entry[p, children].tolist()]
+                for p in range(positions)
+            ]
+        return res
+
+    candidates = flat.devices_under([flat.node_of(t) for t in plan.targets()])
+
+    def evaluate() -> tuple[FloatArray, FloatArray]:
+        res = apply_plan_many(xs, plan, flat, pool_replicas, tunables)
+        return _placements(flat, res.nodes, positions, candidates)
+
+    is_straw2 = np.zeros(len(flat), dtype=np.bool_)
+    is_straw2[straw2] = True
+    has_parent = flat.parents != NO_PARENT
+    in_straw2 = np.zeros(len(flat), dtype=np.bool_)
+    in_straw2[has_parent] = is_straw2[flat.parents[has_parent]]
+    scaled = in_straw2 & ~is_straw2
+    # bottom-up: a bucket's entry is summed after its children were updated
+    summed = [i for i in range(len(flat) - 1, 0, -1) if in_straw2[i] and is_straw2[i]]
+
+    counts, expected = evaluate()
+    deviation_before = best_deviation = _max_deviation(flat, counts, expected)
+    best = args_of(entry)
+    done = 0
+    try:
+        for done in range(1, iterations + 1):
+            ratio = np.where(counts > 0, expected / np.maximum(counts, 1e-9), 2.0)
+            ratio = np.clip(ratio, 0.5, 2.0) ** step
+            positive = entry > 0
+            entry[:, scaled] *= ratio[:, scaled]
+            entry = np.where(positive, np.maximum(entry, _MIN_WEIGHT), 0)
+            for b in summed:
+                entry[:, b] = entry[:, flat.children_of(b)].sum(axis=1)
+
+            args = args_of(entry)
+            apply_choose_args(plan.root, args)
+            flat.sync_weight_sets()
+            counts, expected = evaluate()
+            deviation = _max_deviation(flat, counts, expected)
+            if deviation < best_deviation:
+                best, best_deviation = args, deviation
+    finally:
+        for i, weight_set in original.items():
+            flat.nodes[i].weight_set = weight_set  # type: ignore
+        flat.sync_weight_sets()
+
+    return FitResult(best, deviation_before, best_deviation, done)